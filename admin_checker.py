@@ -1,14 +1,18 @@
+from functools import wraps
+
 from flask_login import  current_user
-from flask import  abort
+from flask import  abort, current_app
+import os
 
 
 def admin_only(func_to_protect):
     """
-    Check if current is admin and is authenticated
+    Check if current is admin and is authenticated. Put it under @route, which registers the function it is given
     :param func_to_protect: func
     :return: 403 error if unsuccessful or successful  func_to_protect(*args, **kwargs)
     """
 
+    @wraps(func_to_protect)
     def check_admin_status(*args, **kwargs):
         if current_user.is_authenticated and current_user.is_admin == 1:
 
@@ -17,4 +21,45 @@ def admin_only(func_to_protect):
             # If not, don't run the function and show a 403 error instead.
             return abort(403)
 
-    return check_admin_status
\ No newline at end of file
+    return check_admin_status
+
+
+# ------------Super admin status (process-local cache)----------------------
+
+def refresh_super_admin_status():
+    """
+    Queries db once for the super_admin_email account and caches the result on the current app.
+    Admin account email: 'admin@email.com'
+    Admin account password: 'admin123'
+    :return: dict with the super admin email, whether the account exists and whether it is an admin
+    """
+    from models import User
+
+    super_admin_email = os.environ.get('SUPER_ADMIN_EMAIL')
+    user = User.query.filter_by(email=super_admin_email).first() if super_admin_email else None
+    status = {
+        'email': super_admin_email,
+        'present': user is not None,
+        'is_admin': bool(user and user.is_admin),
+    }
+    current_app.extensions['super_admin_status'] = status
+    return status
+
+
+def super_admin_status():
+    """
+    Returns the cached super admin status, querying the db only if the cache is empty or was invalidated
+    :return: dict with 'email', 'present' and 'is_admin'
+    """
+    status = current_app.extensions.get('super_admin_status')
+    if status is None:
+        status = refresh_super_admin_status()
+    return status
+
+
+def invalidate_super_admin_status():
+    """
+    Drops the cached super admin status. Call after anything that can change admin state
+    (manage_admins, registering the super admin email, seeding)
+    """
+    current_app.extensions.pop('super_admin_status', None)
@@ -1,91 +1,387 @@
-from datetime import date
-from flask import Flask, abort, render_template, redirect, url_for, flash, request
+from datetime import date, datetime
+from flask import Flask, current_app, abort, render_template, redirect, url_for, flash, request, jsonify
 from flask_bootstrap import Bootstrap5
 from flask_ckeditor import CKEditor
 from flask_login import login_user, LoginManager, current_user, logout_user, login_required
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
 from forms import PostForm, RegisterForm, LoginForm, CreateAdminForm, CommentForm, LeaveCommentButton
 from models import db, Post, User, Comment
-from flask_migrate import Migrate
+from sqlalchemy import case, literal
+from sqlalchemy.orm import configure_mappers, defer, joinedload
+from flask_migrate import Migrate, stamp
+import click
+import gc
 import os
 from flask_login import current_user
-from admin_checker import admin_only
-from flask_gravatar import Gravatar
-import smtplib
-from email.mime.text import MIMEText
-
-# ----Vars--------------------------------------------------
-
-MAIL_ADDRESS = os.environ.get("EMAIL_KEY")
-MAIL_APP_PW = os.environ.get("PASSWORD_KEY")
-
-# ---------initialise flask app------------------------------
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.environ.get("SECRET_APP_KEY")
-ckeditor = CKEditor(app)
-Bootstrap5(app)
-
-# -----------------Configure DB-------------------------
-app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DB_URI", "sqlite:///posts.db")
-db.init_app(app)
-
-# Use for migration if needed
-# Migrate the db to (Optional)
-# migrate = Migrate(app, db)
-# ------------Configure Flask-Login----------------------
+from admin_checker import admin_only, refresh_super_admin_status, super_admin_status, invalidate_super_admin_status
+from seed_super_admin import set_super_admin
+import query_counter
+import user_cache
+import page_cache
+from page_cache import cached_page
+from conditional import conditional, touch_watermark, watermark
+import mail_queue
+import search
+import content
+from content import sanitize_html
+import bulk
+import passwords
+from passwords import HashingBusy
+import images
+import assets
+import vendor
+import avatars
+import compression
+import streaming
+import metrics
+import db_config
+import replicas
+import rate_limit
+from rate_limit import rate_limited
+from streaming import render_page
+
+# ---------Extensions, bound to the app by create_app------------------------------
+ckeditor = CKEditor()
+bootstrap = Bootstrap5()
 login_manager = LoginManager()
-login_manager.init_app(app)
+# Schema changes ship as migrations in migrations/, apply them with 'flask db upgrade' (see migrations/README)
+migrate = Migrate(
+    directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations'),
+    render_as_batch=True,
+    include_object=search.include_object,
+)
 
-# ---------For adding profile picture images in comments section-----
-gravatar = Gravatar(app,
-                    size=100,
-                    rating='g',
-                    default='retro',
-                    force_default=False,
-                    force_lower=False,
-                    use_ssl=False,
-                    base_url=None)
+# Views are registered on the app by create_app, see route()
+_routes = []
+
+
+def route(rule, **options):
+    """
+    Like app.route, for the views of this module, which create_app adds to every app it builds
+    """
+
+    def decorator(view):
+        _routes.append((rule, options, view))
+        return view
+
+    return decorator
+
+
+def load_config(app):
+    """
+    Reads the app's configuration from the environment
+
+    :param app: the Flask app
+    """
+    app.config['SECRET_KEY'] = os.environ.get("SECRET_APP_KEY")
+
+    # -----------------Configure DB-------------------------
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get("DB_URI", "sqlite:///posts.db")
+    # Connection pool (per gunicorn worker), unset values use the preset for the database in db_config.PRESETS
+    for key in ('DB_POOL_SIZE', 'DB_MAX_OVERFLOW', 'DB_POOL_TIMEOUT', 'DB_POOL_RECYCLE'):
+        if os.environ.get(key):
+            app.config[key] = int(os.environ[key])
+    if os.environ.get("DB_POOL_PRE_PING"):
+        app.config['DB_POOL_PRE_PING'] = os.environ["DB_POOL_PRE_PING"].lower() == "true"
+    # Postgres only, in milliseconds (0 disables): longest statement, and longest idle time inside a transaction
+    app.config['DB_STATEMENT_TIMEOUT'] = int(os.environ.get("DB_STATEMENT_TIMEOUT", 30000))
+    app.config['DB_IDLE_IN_TRANSACTION_TIMEOUT'] = int(os.environ.get("DB_IDLE_IN_TRANSACTION_TIMEOUT", 60000))
+    # SQLite only: WAL journal with synchronous=NORMAL, writers wait up to SQLITE_BUSY_TIMEOUT ms for a lock
+    app.config['SQLITE_JOURNAL_MODE'] = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+    app.config['SQLITE_SYNCHRONOUS'] = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+    app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000))
+    # Read replicas (comma separated URIs) serve the reads of GET requests. After writing, a user reads from the primary
+    # for DB_REPLICA_STICKY_SECONDS so replication lag never hides their own changes
+    if os.environ.get("DB_REPLICA_URIS"):
+        app.config['DB_REPLICA_URIS'] = [uri.strip() for uri in os.environ["DB_REPLICA_URIS"].split(",") if uri.strip()]
+    app.config['DB_REPLICA_STICKY_SECONDS'] = float(os.environ.get("DB_REPLICA_STICKY_SECONDS", 10))
+
+    # -----------------Pagination-------------------------
+    # Number of post summaries rendered per page of the home feed
+    app.config['POSTS_PER_PAGE'] = int(os.environ.get("POSTS_PER_PAGE", 10))
+
+    # -----------------Instrumentation-------------------------
+    # Prometheus metrics on /metrics (per-route latency, SQL, templates, SMTP). Only scrapes from this host are
+    # answered, unless METRICS_TOKEN is set: then scrapes from anywhere must send it as a Bearer token.
+    # PROFILER_ENABLED turns on the request profiler: requests sending 'X-Profile: <PROFILER_TOKEN>', plus a
+    # PROFILER_SAMPLE_RATE fraction of all requests, are profiled into instance/profiles
+    app.config['METRICS_TOKEN'] = os.environ.get("METRICS_TOKEN")
+    app.config['PROFILER_ENABLED'] = os.environ.get("PROFILER_ENABLED", "false").lower() == "true"
+    app.config['PROFILER_TOKEN'] = os.environ.get("PROFILER_TOKEN")
+    app.config['PROFILER_SAMPLE_RATE'] = float(os.environ.get("PROFILER_SAMPLE_RATE", 0))
+    app.config['PROFILER_BACKEND'] = os.environ.get("PROFILER_BACKEND", "cprofile")
+
+    # -----------------Query budget-------------------------
+    # Max SQL statements a page may issue; enforced in debug/testing mode only
+    app.config['QUERY_BUDGET'] = int(os.environ.get("QUERY_BUDGET", 10))
+
+    # ------------Outbound email queue----------------------
+    app.config['MAIL_ADDRESS'] = os.environ.get("EMAIL_KEY")
+    app.config['MAIL_APP_PW'] = os.environ.get("PASSWORD_KEY")
+    app.config['MAIL_SERVICE'] = os.environ.get("MAIL_SERVICE", "gmail")
+    # Set MAIL_SMTP_HOST to use any other SMTP server, e.g. a local stand-in during development
+    app.config['MAIL_SMTP_HOST'] = os.environ.get("MAIL_SMTP_HOST")
+    app.config['MAIL_SMTP_PORT'] = int(os.environ.get("MAIL_SMTP_PORT", 587))
+    app.config['MAIL_USE_TLS'] = os.environ.get("MAIL_USE_TLS", "true").lower() == "true"
+    app.config['MAIL_QUEUE_WORKER'] = os.environ.get("MAIL_QUEUE_WORKER", "thread")
+
+    # ------------Password hashing----------------------
+    # The first scheme hashes new passwords, older schemes/costs are upgraded on login.
+    # argon2 needs argon2-cffi and bcrypt needs bcrypt installed
+    # Each login costs one hash: higher costs are slower logins and fewer of them per core, see passwords.py
+    app.config['PASSWORD_SCHEMES'] = os.environ.get("PASSWORD_SCHEMES", "pbkdf2_sha256,argon2,bcrypt").split(",")
+    app.config['PASSWORD_PBKDF2_ROUNDS'] = int(os.environ.get("PASSWORD_PBKDF2_ROUNDS", 260000))
+    app.config['PASSWORD_BCRYPT_ROUNDS'] = int(os.environ.get("PASSWORD_BCRYPT_ROUNDS", 12))
+    app.config['PASSWORD_ARGON2_TIME_COST'] = int(os.environ.get("PASSWORD_ARGON2_TIME_COST", 3))
+    app.config['PASSWORD_ARGON2_MEMORY_COST'] = int(os.environ.get("PASSWORD_ARGON2_MEMORY_COST", 65536))
+    # Max concurrent hash operations per worker process, so logins cannot take every core
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+
+    # ------------Rate limiting----------------------
+    # Token buckets per client IP and per account on login, register and contact, rejected with 429 before any hashing,
+    # query or SMTP work. 'memory' counts per worker, 'sqlite' shares the buckets between the workers of a host.
+    # Override a route's limits with e.g. RATE_LIMIT_LOGIN='ip=20/minute,ip_account=5/minute,account=30/minute'
+    app.config['RATE_LIMIT_BACKEND'] = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+    if os.environ.get("RATE_LIMIT_SQLITE_PATH"):
+        app.config['RATE_LIMIT_SQLITE_PATH'] = os.environ["RATE_LIMIT_SQLITE_PATH"]
+    app.config['RATE_LIMITS'] = {
+        name: rate_limit.parse_limits(os.environ[f"RATE_LIMIT_{name.upper()}"])
+        for name in rate_limit.DEFAULT_LIMITS if os.environ.get(f"RATE_LIMIT_{name.upper()}")
+    }
+    # Reverse proxies in front of the app, so the client IP is taken from X-Forwarded-For
+    app.config['RATE_LIMIT_PROXY_COUNT'] = int(os.environ.get("RATE_LIMIT_PROXY_COUNT", 0))
+
+    # ---------For adding profile picture images in comments section-----
+    # Identicons generated by the app, their URL is stored on the user when it is created. After changing the prefix
+    # run 'flask avatars backfill --all'
+    app.config['AVATAR_URL_PREFIX'] = os.environ.get("AVATAR_URL_PREFIX", "/avatars")
+
+    # ------------User cache for Flask-Login----------------------
+    # Per-process, so keep the TTL short when running several gunicorn workers
+    app.config['USER_CACHE_SIZE'] = int(os.environ.get("USER_CACHE_SIZE", 1024))
+    app.config['USER_CACHE_TTL'] = float(os.environ.get("USER_CACHE_TTL", 30))
+
+    # ------------Page cache for anonymous visitors----------------------
+    # 'filesystem' shares the cache (and its invalidations) between the gunicorn workers of the host. 'memory' is per
+    # process, gunicorn.conf.py refuses it with more than one worker
+    app.config['PAGE_CACHE_BACKEND'] = os.environ.get("PAGE_CACHE_BACKEND", "filesystem")
+    app.config['PAGE_CACHE_TTL'] = int(os.environ.get("PAGE_CACHE_TTL", 300))
+    # Max cached pages, in memory per worker or on disk for the host
+    app.config['PAGE_CACHE_SIZE'] = int(os.environ.get("PAGE_CACHE_SIZE", 512))
+    if os.environ.get("PAGE_CACHE_DIR"):
+        app.config['PAGE_CACHE_DIR'] = os.environ["PAGE_CACHE_DIR"]
+
+    # ------------Response compression----------------------
+    # gzip, or brotli when the Brotli package is installed. Cached pages are stored compressed
+    app.config['COMPRESS_ENABLED'] = os.environ.get("COMPRESS_ENABLED", "true").lower() == "true"
+    app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get("COMPRESS_MIN_SIZE", 500))
+
+    # ------------Streaming pages----------------------
+    # Post and feed pages are sent while they render, except the ones stored in the page cache
+    app.config['STREAM_TEMPLATES'] = os.environ.get("STREAM_TEMPLATES", "true").lower() == "true"
+    # Comment rows fetched per round trip while a post page streams
+    app.config['COMMENTS_FETCH_SIZE'] = int(os.environ.get("COMMENTS_FETCH_SIZE", 100))
+    # Comments rendered with the post, the rest are loaded page by page from /post/<id>/comments as the reader scrolls
+    app.config['COMMENTS_PER_PAGE'] = int(os.environ.get("COMMENTS_PER_PAGE", 50))
+
+    # ------------Responsive images----------------------
+    # Resized WebP/AVIF/JPEG variants of the masthead backgrounds and post images,
+    # prebuild them with 'flask images build'
+    if os.environ.get("IMAGE_WIDTHS"):
+        app.config['IMAGE_WIDTHS'] = [int(width) for width in os.environ["IMAGE_WIDTHS"].split(",")]
+    if os.environ.get("IMAGE_CACHE_DIR"):
+        app.config['IMAGE_CACHE_DIR'] = os.environ["IMAGE_CACHE_DIR"]
+    # Post images are fetched by the server from public hosts only, IMAGE_ALLOWED_HOSTS narrows that to a list
+    if os.environ.get("IMAGE_ALLOWED_HOSTS"):
+        app.config['IMAGE_ALLOWED_HOSTS'] = [host.strip() for host in os.environ["IMAGE_ALLOWED_HOSTS"].split(",")]
+
+    # ------------Release----------------------
+    # Identifies the deployed code (e.g. the commit) in the ETags of pages, so a deploy invalidates browsers' copies.
+    # Unset, the templates are fingerprinted instead
+    app.config['APP_VERSION'] = os.environ.get("APP_VERSION")
+
+    # ------------Fingerprinted static assets----------------------
+    # Run 'flask assets build' on deploy, templates link the hashed copies through asset_url()
+    if os.environ.get("ASSETS_DIR"):
+        app.config['ASSETS_DIR'] = os.environ["ASSETS_DIR"]
+
+    # ------------Self-hosted third-party assets----------------------
+    # 'flask vendor build' (before 'flask assets build') downloads Bootstrap's JS, the used icons and the fonts into
+    # static/vendor, pages then load nothing from the CDNs. VENDOR_ASSETS=false goes back to the CDNs
+    app.config['VENDOR_ASSETS'] = os.environ.get("VENDOR_ASSETS", "true").lower() == "true"
+
+
+def create_app(config=None):
+    """
+    Builds the blog app. Nothing here touches the database, so building it is quick and safe before a fork: gunicorn
+    can preload it once in its master (see gunicorn.conf.py). Create a new database with 'flask create-db' and the
+    super admin with 'flask seed'.
+
+    :param config: settings overriding the ones read from the environment, e.g. {'TESTING': True}
+    :return: the Flask app
+    """
+    app = Flask(__name__)
+    load_config(app)
+    app.config.update(config or {})
+
+    ckeditor.init_app(app)
+    bootstrap.init_app(app)
+    # Replica binds first, db_config creates the engines
+    replicas.init_app(app)
+    db_config.init_app(app)
+    migrate.init_app(app, db)
+    metrics.init_app(app)
+    query_counter.init_app(app)
+    mail_queue.init_app(app)
+    passwords.init_app(app)
+    rate_limit.init_app(app)
+    login_manager.init_app(app)
+    avatars.init_app(app)
+    user_cache.init_app(app)
+    page_cache.init_app(app)
+    compression.init_app(app)
+    streaming.init_app(app)
+    images.init_app(app)
+    assets.init_app(app)
+    vendor.init_app(app)
+    app.add_template_filter(long_date)
+    # Full-text search index over posts and comments (FTS5 on SQLite, tsvector on Postgres)
+    search.init_app(app)
+    # Sanitized HTML and derived fields of posts and comments, computed when they are written
+    content.init_app(app)
+    # NDJSON export / import of users, posts and comments ('flask content export' / 'flask content import')
+    bulk.init_app(app)
+
+    for rule, options, view in _routes:
+        app.add_url_rule(rule, view_func=view, **options)
+    register_commands(app)
+    return app
+
+
+def warm_up(app):
+    """
+    Does the work otherwise left to the first requests, without touching the database: configures the ORM mappers
+    and compiles every template. gunicorn.conf.py calls it in the master of a preloaded app, so the workers are forked
+    ready. Everything built so far is then frozen out of the garbage collector, whose passes in the workers would
+    otherwise write to (and so copy) the shared memory
+
+    :param app: the Flask app
+    """
+    configure_mappers()
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        # Bootstrap-Flask also ships the macros of Bootstrap 3 and 4, which are never used
+        if not name.startswith(('bootstrap/', 'bootstrap4/')):
+            app.jinja_env.get_template(name)
+    gc.collect()
+    gc.freeze()
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    print(f"Loading user: {user_id}")
-    user = User.query.get(int(user_id))
+    """
+    Loads the logged in user, from the user cache when possible
+
+    :param user_id: the user id stored in the session
+    :return: a User bound to the current db session, or None if there is no such user
+    """
+    user_id = int(user_id)
+    cached_user = user_cache.current_cache().get(user_id)
+    if cached_user is not None:
+        # Attach the cached copy to this request's session without a query
+        return db.session.merge(cached_user, load=False)
+
+    user = db.session.get(User, user_id)
     if user:
-        print(f"Loaded user: {user}")
-    else:
-        print(f"No user found with ID: {user_id}")
+        user_cache.current_cache().put(user)
     return user
 
 
-# ------Create App-------------
-with app.app_context():
-    db.create_all()
+def long_date(value):
+    """
+    Template filter formatting a post date for display e.g. 'January 05, 2024'
+    """
+    return value.strftime("%B %d, %Y") if value else ""
+
 
+# ------Database setup-------------
 
-# ______________________________
+def create_db():
+    """
+    Creates the schema of a new, empty database and stamps it with the latest migration, so later releases upgrade
+    it with 'flask db upgrade'. Must run inside an app context
+
+    :return: True if created, False if the database already has tables
+    """
+    if db.inspect(db.engine).get_table_names():
+        return False
+    # The primary only: replicas get the schema by replication, and db keeps an (empty) metadata for the bind key of
+    # every replica any app of the process was configured with
+    db.create_all(bind_key=None)
+    search.ensure_schema()
+    stamp()
+    return True
 
 
-@app.before_request
-def check_for_admin():
+def register_commands(app):
     """
-    Queries db if super_user_email Admin is in DB
-    Admin account email: 'admin@email.com'
-    Admin account password: 'admin123'
-    :param: super_admin_email (undeletable admin)
+    Adds 'flask create-db', 'flask seed' and 'flask admin-status'
+
+    :param app: the Flask app
     """
 
-    super_admin_email = os.environ.get('SUPER_ADMIN_EMAIL')
-    # Search db for this email
-    user = User.query.filter_by(email=super_admin_email).first()
-    if not user:
-        print("😢User: Super ADMIN not found")
-    else:
-        print("🔐Admin Set and is in DB")
+    @app.cli.command('create-db')
+    def create_db_command():
+        """
+        Creates the tables of a new database
+        """
+        if not create_db():
+            raise click.ClickException(
+                "The database already has tables. Upgrade it with 'flask db upgrade', see migrations/README"
+            )
+        print("Created the database")
+
+    @app.cli.command('seed')
+    def seed_command():
+        """
+        Creates the SUPER_ADMIN_EMAIL account and a sample post, if it does not exist yet
+        """
+        if set_super_admin():
+            print(f"Created the super admin {os.environ['SUPER_ADMIN_EMAIL']}")
+        else:
+            print("Nothing to seed: SUPER_ADMIN_EMAIL is not set or the account already exists")
+
+    @app.cli.command('admin-status')
+    def admin_status_command():
+        """
+        Prints whether the SUPER_ADMIN_EMAIL account exists and is an admin
+        """
+        status = refresh_super_admin_status()
+        print(f"Super admin {status['email']}: present={status['present']} is_admin={status['is_admin']}")
 
 
-@app.route('/admin/manage', methods=['GET', 'POST'])
+# ______________________________
+
+
+@route('/health')
+def health():
+    """
+    Reports app health, the cached super admin state and the user/page cache and rate limiter counters without
+    touching the db
+
+    :return: JSON with 'status', 'super_admin', 'user_cache', 'page_cache' and 'rate_limit'
+    """
+    status = super_admin_status()
+    return jsonify(
+        status="ok",
+        super_admin={'present': status['present'], 'is_admin': status['is_admin']},
+        user_cache=user_cache.current_cache().stats(),
+        page_cache=current_app.extensions['page_cache'].stats() if 'page_cache' in current_app.extensions else None,
+        rate_limit=current_app.extensions['rate_limit'].stats() if 'rate_limit' in current_app.extensions else None
+    )
+
+
+@route('/admin/manage', methods=['GET', 'POST'])
+@admin_only
 def manage_admins():
     """
     Handles the addition or removal of admin privileges for users
@@ -93,7 +389,6 @@ def manage_admins():
     :return: Renders 'make-admin.html' with the form. If the operation is successful, it flashes a success message.
             If the user does not exist or other errors occur, it flashes an appropriate warning or error message.
     """
-    print("Entered manage_admins")
 
     form = CreateAdminForm()
     if form.validate_on_submit():
@@ -103,12 +398,16 @@ def manage_admins():
         if form.make_admin.data and user:
             user.is_admin = True
             db.session.commit()
+            user_cache.invalidate(user.id)
+            invalidate_super_admin_status()
             flash("User is now an admin.", "success")  # Green message
 
         # Check if 'Remove Admin' was clicked
         elif form.remove_admin.data and user:
             user.is_admin = False
             db.session.commit()
+            user_cache.invalidate(user.id)
+            invalidate_super_admin_status()
             flash("User is no longer an admin.", "danger")
 
         else:
@@ -116,7 +415,8 @@ def manage_admins():
     return render_template('make-admin.html', form=form)
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
+@rate_limited('register')
 def register():
     """
     Handles the user registration process.
@@ -160,7 +460,11 @@ def register():
             flash("You must agree to the terms and conditions to register.")
             return render_template("register.html", form=register_form)
 
-        hashed_and_salted_password = generate_password_hash(form_password, method='pbkdf2:sha256', salt_length=8)
+        try:
+            hashed_and_salted_password = passwords.hash_password(form_password)
+        except HashingBusy:
+            flash("The server is busy, please try again in a moment.")
+            return render_template("register.html", form=register_form), 503
 
         new_user = User(
             username=form_username,
@@ -168,9 +472,12 @@ def register():
             password=hashed_and_salted_password,
             agree_to_terms=form_agree_to_terms
         )
+        avatars.set_avatar(new_user)
 
         db.session.add(new_user)
         db.session.commit()
+        if form_email == os.environ.get('SUPER_ADMIN_EMAIL'):
+            invalidate_super_admin_status()
 
         login_user(new_user)
         flash("Log in successful")
@@ -180,7 +487,8 @@ def register():
     return render_template("register.html", form=register_form, current_user=current_user)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
+@rate_limited('login', account_field='email')
 def login():
     """
     Authenticates a user and initiates a session.
@@ -207,21 +515,32 @@ def login():
         if not existing_email:
             flash("That email does not exist, please try again.")
             return redirect(url_for('login'))
-            # Password incorrect
-        elif not check_password_hash(existing_email.password, form_password):
+
+        try:
+            password_matches, new_hash = passwords.verify_password(form_password, existing_email.password)
+        except HashingBusy:
+            flash("The server is busy, please try again in a moment.")
+            return render_template("login.html", form=login_form, current_user=current_user), 503
+
+        if not password_matches:
             flash('Password incorrect, please try again.')
             return redirect(url_for('login'))
         else:
+            # Transparently upgrade hashes made with an outdated scheme or cost
+            if new_hash:
+                existing_email.password = new_hash
+                db.session.commit()
+                user_cache.invalidate(existing_email.id)
+
             # Authenticate user with flask login
             login_user(existing_email)
 
             return redirect(url_for('get_all_posts'))
-    print("Rendering login template")
 
     return render_template("login.html", form=login_form, current_user=current_user)
 
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     """
     Log out current user  and redirects them to the url for get_all_posts func
@@ -232,24 +551,115 @@ def logout():
     return redirect(url_for('get_all_posts'))
 
 
-@app.route('/', methods=['GET', 'POST'])
+def feed_validators():
+    """
+    :return: the validators of the home feed: the newest post modification time, the newest comment change (the feed
+             shows comment counts), the post count, the last post deletion, so deleting the newest post cannot
+             move Last-Modified backwards, and the last backfill of rendered fields
+    """
+    last_updated, last_commented, post_count, last_deleted, last_rewritten = db.session.execute(
+        db.select(db.func.max(Post.updated_at), db.func.max(Post.comments_updated_at), db.func.count(Post.id),
+                  watermark('posts_deleted'), watermark('pages_rewritten'))
+    ).one()
+    changes = [value for value in (last_updated, last_commented, last_deleted, last_rewritten) if value is not None]
+    return (last_updated, last_commented, post_count, last_deleted, last_rewritten), max(changes) if changes else None
+
+
+def post_validators(post_id):
+    """
+    :param post_id: the post shown
+    :return: the validators of a post page from its edit and comment watermarks and the last backfill of rendered
+             fields, or None if the post does not exist
+    """
+    row = db.session.execute(
+        db.select(Post.updated_at, Post.comments_updated_at, watermark('pages_rewritten').label('rewritten_at'))
+        .where(Post.id == post_id)
+    ).first()
+    if row is None:
+        return None
+    changes = [value for value in (row.updated_at, row.comments_updated_at, row.rewritten_at) if value is not None]
+    return (post_id, row.updated_at, row.comments_updated_at, row.rewritten_at), max(changes)
+
+
+@route('/', methods=['GET', 'POST'])
+@cached_page('index', args=('before',))
+@conditional(feed_validators)
 def get_all_posts():
-    print("Entered get_all_posts")
+    """
+    Renders one page of the home feed, newest posts first.
 
-    result = db.session.execute(db.select(Post))
+    Uses keyset (cursor) pagination on the post id: the optional 'before' query argument is the id of the last post
+    on the previous page, so every page is a bounded index range scan no matter how many posts exist. Only the
+    columns index.html displays are selected, the post body is never loaded.
 
-    posts = result.scalars().all()
+    :return: Renders 'index.html' with the page of post summaries and the cursor for the next (older) page.
+    """
+
+    page_size = current_app.config['POSTS_PER_PAGE']
+    before = request.args.get('before', type=int)
+
+    query = (
+        db.select(
+            Post.id, Post.title, Post.subtitle, Post.date, Post.comment_count, Post.excerpt, Post.reading_time,
+            User.username.label('author_username')
+        )
+        .outerjoin(User, Post.author_id == User.id)
+        .order_by(Post.id.desc())
+        # Fetch one extra row to know whether an older page exists
+        .limit(page_size + 1)
+    )
+    if before is not None:
+        query = query.where(Post.id < before)
+
+    posts = db.session.execute(query).all()
+
+    next_cursor = None
+    if len(posts) > page_size:
+        posts = posts[:page_size]
+        next_cursor = posts[-1].id
 
-    return render_template("index.html", all_posts=posts, current_user=current_user)
+    return render_page("index.html", all_posts=posts, next_cursor=next_cursor, current_user=current_user)
 
 
-@app.route('/delete_comment/<int:comment_id>')
+@route('/search')
+@cached_page('search', args=('q', 'page'))
+def search_posts():
+    """
+    Full-text search over post titles, subtitles, bodies and comments, best matches first.
+
+    :return: Renders 'search.html' with one page of ranked results for the 'q' query argument.
+    """
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    page_size = current_app.config['POSTS_PER_PAGE']
+
+    results = []
+    if query:
+        # Fetch one extra row to know whether a next page exists
+        results = search.search_posts(query, limit=page_size + 1, offset=(page - 1) * page_size)
+    has_next = len(results) > page_size
+
+    return render_template(
+        "search.html",
+        query=query,
+        results=results[:page_size],
+        page=page,
+        has_next=has_next,
+        current_user=current_user
+    )
+
+
+@route('/delete_comment/<int:comment_id>')
 @login_required
 def delete_comment(comment_id):
     comment_to_delete = Comment.query.get_or_404(comment_id)
     if comment_to_delete.author_id == current_user.id:
         db.session.delete(comment_to_delete)
+        comment_to_delete.parent_post.comments_updated_at = datetime.utcnow()
+        comment_to_delete.parent_post.comment_count = Post.comment_count - 1
+        search.index_post(comment_to_delete.post_id)
         db.session.commit()
+        page_cache.invalidate_post(comment_to_delete.post_id)
         flash('Comment deleted.', 'info')
     else:
         flash('You do not have permission to delete this comment.', 'error')
@@ -260,7 +670,87 @@ def delete_comment(comment_id):
 
 
 
-@app.route("/post/<int:post_id>", methods=['GET', 'POST'])
+def iter_comments(post_id, after=None, limit=None):
+    """
+    Yields one page of the comments of a post, oldest first, fetched from the database in batches of
+    COMMENTS_FETCH_SIZE rows while the page renders, so the whole page is never held in memory.
+
+    Keyset pagination on the comment id: 'after' is the id of the last comment already shown, so every page is a
+    bounded range scan of the post_id index however deep into the thread it is.
+
+    :param post_id: the post
+    :param after: only yield comments with a greater id
+    :param limit: max comments to yield
+    :return: generator of rows with id, text_html (text if not processed yet), author_username, author_avatar_url and owned (whether the current user wrote
+             the comment, worked out in SQL)
+    """
+    if current_user.is_authenticated:
+        owned = (Comment.author_id == current_user.id).label('owned')
+    else:
+        owned = literal(False).label('owned')
+    query = (
+        db.select(
+            Comment.id, Comment.text_html,
+            # The raw text is only needed (and fetched) for comments not processed yet
+            case((Comment.text_html.is_(None), Comment.text), else_=None).label('text'),
+            User.username.label('author_username'), User.avatar_url.label('author_avatar_url'), owned
+        )
+        .outerjoin(User, Comment.author_id == User.id)
+        .where(Comment.post_id == post_id)
+        .order_by(Comment.id)
+        .limit(limit)
+        .execution_options(yield_per=current_app.config['COMMENTS_FETCH_SIZE'])
+    )
+    if after is not None:
+        query = query.where(Comment.id > after)
+    rows = db.session.execute(query)
+    try:
+        yield from rows
+    finally:
+        rows.close()
+
+
+@route('/post/<int:post_id>/comments')
+def post_comments(post_id):
+    """
+    One page of a post's comments as JSON, loaded by static/js/comments.js as the reader scrolls.
+
+    :param post_id: the post
+    :return: {"comments": [...], "next_cursor": id to pass as 'after' for the next page, or null on the last page}
+    """
+    db.first_or_404(db.select(Post.id).where(Post.id == post_id))
+    page_size = current_app.config['COMMENTS_PER_PAGE']
+    after = request.args.get('after', type=int)
+
+    # Fetch one extra row to know whether another page exists
+    rows = list(iter_comments(post_id, after=after, limit=page_size + 1))
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = rows[-1].id
+
+    response = jsonify(
+        comments=[
+            {
+                'id': row.id,
+                'html': row.text_html if row.text_html is not None else sanitize_html(row.text, "nofollow ugc"),
+                'author_username': row.author_username,
+                'avatar_url': avatars.avatar(row.author_avatar_url),
+                'delete_url': url_for('delete_comment', comment_id=row.id) if row.owned else None,
+            }
+            for row in rows
+        ],
+        next_cursor=next_cursor,
+    )
+    # Per-viewer (delete links), never shared by caches
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@route("/post/<int:post_id>", methods=['GET', 'POST'])
+@cached_page(lambda post_id: f"post:{post_id}")
+@conditional(post_validators)
 def show_post(post_id):
     """
     Displays a specific blog post and handles commenting on the post.
@@ -274,21 +764,18 @@ def show_post(post_id):
 
     :param post_id: The unique identifier of the blog post to be displayed.
     :return: Renders 'post.html' with details of the blog post, the current user's authentication status,
-             comment form visibility, existing comments, and IDs of comments owned by the current user.
+             comment form visibility and the post's comments, streamed from the database while the page renders.
     """
 
-    requested_post = db.get_or_404(Post, post_id)
+    # Only the post and its author are loaded here, the comments are fetched lazily by iter_comments. The raw body is
+    # left out, pages show body_html
+    requested_post = db.one_or_404(
+        db.select(Post).options(joinedload(Post.author), defer(Post.body)).where(Post.id == post_id)
+    )
     comment_form = CommentForm()
     leave_comment = LeaveCommentButton()
     show_form = False
 
-    blog_comments = requested_post.comments
-
-    # Check if the current user is authenticated before accessing the id
-    if current_user.is_authenticated:
-        owned_comment_ids = [comment.id for comment in blog_comments if current_user.id == comment.author_id]
-    else:
-        owned_comment_ids = []
     # If the 'Leave a Comment' button was clicked, show the comment form
     if 'comment_button' in request.form:
         if current_user.is_authenticated:
@@ -306,25 +793,31 @@ def show_post(post_id):
             comment_author=current_user
 
         )
+        content.process_comment(new_comment)
         db.session.add(new_comment)
+        requested_post.comments_updated_at = datetime.utcnow()
+        # In SQL, so concurrent comments cannot overwrite each other's count
+        requested_post.comment_count = Post.comment_count + 1
+        search.index_comment(requested_post.id, new_comment.text)
         db.session.commit()
+        page_cache.invalidate_post(post_id)
         flash("Your comment has been added.", "alert-info")
         return redirect(url_for('show_post', post_id=post_id))
 
-    return render_template(
+    return render_page(
         "post.html",
         post=requested_post,
         current_user=current_user,
         show_form=show_form,
         form=comment_form,
         leave_comment=leave_comment,
-        comments=blog_comments,
-        owned_comment_ids=owned_comment_ids
+        comments=iter_comments(post_id, limit=current_app.config['COMMENTS_PER_PAGE']),
+        comments_per_page=current_app.config['COMMENTS_PER_PAGE']
     )
 
 
+@route("/new-post", methods=["GET", "POST"])
 @admin_only
-@app.route("/new-post", methods=["GET", "POST"])
 def add_new_post():
     form = PostForm()
 
@@ -335,16 +828,20 @@ def add_new_post():
             body=form.body.data,
             img_url=form.img_url.data,
             author=current_user,
-            date=date.today().strftime("%B %d, %Y")
+            date=date.today()
         )
+        content.process_post(new_post)
         db.session.add(new_post)
+        db.session.flush()
+        search.index_post(new_post.id)
         db.session.commit()
+        page_cache.invalidate_post(new_post.id)
         return redirect(url_for("get_all_posts"))
     return render_template("make-post.html", form=form, logged_in=True, current_user=current_user)
 
 
+@route("/edit-post/<int:post_id>", methods=["GET", "POST"])
 @admin_only
-@app.route("/edit-post/<int:post_id>", methods=["GET", "POST"])
 def edit_post(post_id):
     """
     Handles the editing of a specific blog post.
@@ -374,13 +871,17 @@ def edit_post(post_id):
         post.img_url = edit_form.img_url.data
         post.author = current_user
         post.body = edit_form.body.data
+        content.process_post(post)
+        post.updated_at = datetime.utcnow()
+        search.index_post(post.id)
         db.session.commit()
+        page_cache.invalidate_post(post.id)
         return redirect(url_for("show_post", post_id=post.id))
     return render_template("make-post.html", form=edit_form, is_edit=True, current_user=current_user)
 
 
+@route("/delete/<int:post_id>", methods=["GET", "POST"])
 @admin_only
-@app.route("/delete/<int:post_id>", methods=["GET", "POST"])
 def delete_post(post_id):
     """
     Handles the deletion of a specific blog post.
@@ -394,11 +895,15 @@ def delete_post(post_id):
     """
     post_to_delete = db.get_or_404(Post, post_id)
     db.session.delete(post_to_delete)
+    search.remove_post(post_id)
+    touch_watermark('posts_deleted')
     db.session.commit()
+    page_cache.invalidate_post(post_id)
     return redirect(url_for('get_all_posts'))
 
 
-@app.route("/about", methods=["GET", "POST"])
+@route("/about", methods=["GET", "POST"])
+@cached_page('about')
 def about():
     """
     Renders the about page
@@ -409,18 +914,20 @@ def about():
 
 
 
-@app.route("/contact", methods=["GET", "POST"])
+@route("/contact", methods=["GET", "POST"])
+@rate_limited('contact', account_field='email')
 def contact():
     """
     Handles the display and processing of the contact form.
 
-    On a GET request, it displays the contact form. On a POST request, it gathers the form data and sends an email
-    with the details entered by the user. It uses the 'send_email' function to handle the email sending process.
+    On a GET request, it displays the contact form. On a POST request, it gathers the form data and queues an email
+    with the details entered by the user. It uses the 'send_email' function, which only enqueues the message, so the
+    request never waits on the SMTP server.
 
-    After a successful POST request, indicating that the email has been sent, it re-renders the contact page with a
+    After a successful POST request, indicating that the email has been queued, it re-renders the contact page with a
     confirmation message. Otherwise, it displays the contact form without the confirmation message.
 
-    :return: Renders 'contact.html'. If an email is successfully sent, the page includes a confirmation message.
+    :return: Renders 'contact.html'. If an email is successfully queued, the page includes a confirmation message.
     """
     if request.method == "POST":
         data = request.form
@@ -429,70 +936,28 @@ def contact():
     return render_template("contact.html", msg_sent=False)
 
 
-def send_email(name, email, phone, message, service='gmail'):
+def send_email(name, email, phone, message):
     """
-    Sends an email containing the details from a contact form.
+    Queues an email containing the details from a contact form.
 
-    This function creates and sends an HTML-formatted email using the specified email service provider. The email
-    includes the sender's name, email, and phone number, along with their message. It uses the SMTP settings
-    corresponding to the chosen email service provider. The email is sent from and to the application's configured
-    email address but includes a 'Reply-To' header set to the sender's email for easy responses.
+    This function renders the HTML email with the sender's name, email, and phone number, along with their message, and
+    stores it in the outbound email queue. The mail queue worker (see mail_queue.py) delivers it in the background using
+    the SMTP settings of the configured email service provider (MAIL_SERVICE: 'gmail', 'yahoo' or 'outlook', or an
+    explicit MAIL_SMTP_HOST). The email is sent from and to the application's configured email address but includes a
+    'Reply-To' header set to the sender's email for easy responses. Failed deliveries are retried with backoff.
 
     Parameters:
     - name (str): The sender's name as provided in the contact form.
     - email (str): The sender's email address as provided in the contact form.
     - phone (str): The sender's phone number as provided in the contact form.
     - message (str): The message body as provided in the contact form.
-    - service (str, optional): The email service provider to use for sending the email. Defaults to 'gmail'. Supported
-      options include 'gmail', 'yahoo', and 'outlook'.
-
-    The function attempts to send the email using the SMTP settings for the specified service. If the service is not
-    supported, it raises a ValueError. Any errors encountered during the sending process are caught and printed to the
-    console.
-
-    Raises:
-    - ValueError: If the specified email service provider is not supported.
 
     Example:
-    send_email("John Doe", "johndoe@example.com", "1234567890", "Your blog is awesome!", "yahoo")
+    send_email("John Doe", "johndoe@example.com", "1234567890", "Your blog is awesome!")
     """
-    email_message = f"New Message\n\nName: {name}\nEmail: {email}\nPhone: {phone}"
-
     email_content = render_template('email_template.html', name=name, email=email, phone=phone, message=message)
-
-    # -- MIMETEXT logic ---
-
-    msg = MIMEText(email_content, 'html')
-    msg['From'] = MAIL_ADDRESS
-    msg['To'] = MAIL_ADDRESS
-    msg['Subject'] = f"Message from {name}"
-    msg['Reply-To'] = email
-
-    # ---SMTP logic-----
-
-    smtp_settings = {
-        'gmail': ('smtp.gmail.com', 587),
-        'yahoo': ('smtp.mail.yahoo.com', 587),
-        'outlook': ('smtp.office365.com', 587)
-        # Add more services as needed
-    }
-
-    if service in smtp_settings:
-        smtp_server, smtp_port = smtp_settings[service]
-    else:
-        raise ValueError("Unsupported email service")
-
-    try:
-        with smtplib.SMTP(smtp_server, smtp_port) as connection:
-            connection.starttls()
-            connection.login(MAIL_ADDRESS, MAIL_APP_PW)
-            connection.sendmail(to_addrs=MAIL_ADDRESS, from_addr=email,msg=msg.as_string())
-    except Exception as e:
-        print(f"Error sending email: {e}")
-
-
-
+    mail_queue.enqueue_email(subject=f"Message from {name}", html=email_content, reply_to=email)
 
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5002)
+    create_app().run(debug=True, port=5002)
@@ -0,0 +1,248 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import tempfile
+
+from datetime import datetime
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # Optional, only gzip variants are built without it
+    brotli = None
+
+
+# ---------------------Build---------------------------------
+# 'flask assets build' copies every file under static/ to static/dist/ with a content hash in its name
+# (css/styles.css -> css/styles.3f2a1b9c0d4e.css), writes .gz/.br next to the text ones, and maps the original names to
+# the hashed ones in static/dist/manifest.json. A changed file gets a new name, so the old name can be cached forever.
+
+MANIFEST_NAME = 'manifest.json'
+
+# Suffix of each precompressed variant, in order of preference when serving
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+# Types worth precompressing, everything else (images, woff2) is compressed already
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.ico', '.map', '.xml')
+
+# Only keep a compressed variant when it saves at least this fraction of the size
+MIN_COMPRESSION_SAVING = 0.1
+
+IMMUTABLE_MAX_AGE = 31536000
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)(?!data:|[a-z]+://|//|#)([^'")?#]+)([^'")]*)\1\s*\)""")
+
+
+def hashed_name(path, data):
+    """
+    :return: path with the first 12 hex chars of data's sha256 before the extension
+    """
+    root, extension = posixpath.splitext(path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+
+
+def rewrite_css_urls(css_path, css, manifest):
+    """
+    Points relative url(...) references of a stylesheet at the fingerprinted files, so they keep resolving from
+    static/dist/ and change name when the file they reference changes
+    """
+    css_dir = posixpath.dirname(css_path)
+
+    def replace(match):
+        quote, reference, suffix = match.groups()
+        target = posixpath.normpath(posixpath.join(css_dir, reference))
+        if target not in manifest:
+            return match.group(0)
+        new_reference = posixpath.relpath(manifest[target], css_dir)
+        return f"url({quote}{new_reference}{suffix}{quote})"
+
+    return CSS_URL.sub(replace, css.decode('utf-8')).encode('utf-8')
+
+
+def compressed_variants(data):
+    """
+    :return: dict of encoding -> bytes for the encodings that make data meaningfully smaller
+    """
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    return {
+        encoding: compressed for encoding, compressed in variants.items()
+        if len(compressed) <= len(data) * (1 - MIN_COMPRESSION_SAVING)
+    }
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def build(static_folder, dist_dir, clean=False):
+    """
+    Fingerprints and precompresses every file of static_folder into dist_dir
+
+    :param clean: also delete files left in dist_dir by older builds. Keep them (the default) while pages cached by
+                  browsers or the page cache may still reference the previous names
+    :return: the new manifest, {original path: hashed path}, paths relative to static_folder / dist_dir
+    """
+    dist_dir = os.path.abspath(dist_dir)
+    sources = []
+    for directory, dirnames, filenames in os.walk(static_folder):
+        dirnames[:] = sorted(d for d in dirnames if os.path.abspath(os.path.join(directory, d)) != dist_dir)
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            sources.append(os.path.relpath(path, static_folder).replace(os.sep, '/'))
+
+    manifest = {}
+    written = {MANIFEST_NAME}
+    # Stylesheets last, so the files they reference already have their hashed names
+    for path in sorted(sources, key=lambda p: p.endswith('.css')):
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            data = f.read()
+        if path.endswith('.css'):
+            data = rewrite_css_urls(path, data, manifest)
+        hashed_path = hashed_name(path, data)
+        manifest[path] = hashed_path
+
+        target = os.path.join(dist_dir, hashed_path)
+        written.add(hashed_path)
+        if not os.path.exists(target):
+            _write(target, data)
+        if path.endswith(COMPRESSIBLE_EXTENSIONS):
+            for encoding, compressed in compressed_variants(data).items():
+                variant_path = hashed_path + ENCODING_SUFFIXES[encoding]
+                written.add(variant_path)
+                if not os.path.exists(target + ENCODING_SUFFIXES[encoding]):
+                    _write(target + ENCODING_SUFFIXES[encoding], compressed)
+
+    # The manifest goes last: until it is replaced, running workers keep using the previous build
+    _write(os.path.join(dist_dir, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+    if clean:
+        for directory, _, filenames in os.walk(dist_dir):
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(directory, filename), dist_dir).replace(os.sep, '/')
+                if path not in written:
+                    os.remove(os.path.join(directory, filename))
+    return manifest
+
+
+# ---------------------Serving---------------------------------
+
+class AssetManifest:
+    """
+    The original -> fingerprinted name mapping of the last 'flask assets build'. Without a build every name maps to
+    itself and asset_url() falls back to plain static URLs.
+    'digest' identifies the build and 'built_at' is when it was written (UTC), both None without a build
+    """
+
+    def __init__(self, path, auto_reload=False):
+        self.path = path
+        self.auto_reload = auto_reload
+        self.entries = {}
+        self.digest = None
+        self.built_at = None
+        self._mtime = None
+        self.load()
+
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            self.entries = json.loads(data)
+            self.digest = hashlib.sha256(data).hexdigest()[:12]
+            self.built_at = datetime.utcfromtimestamp(mtime / 1e9)
+            self._mtime = mtime
+        except (OSError, ValueError):
+            self.entries = {}
+            self.digest = None
+            self.built_at = None
+            self._mtime = None
+
+    def get(self, filename):
+        if self.auto_reload:
+            self.load()
+        return self.entries.get(filename)
+
+
+def asset_url(filename, **values):
+    """
+    Drop-in for url_for('static', filename=...): the fingerprinted URL of a static file when it was built, else its
+    plain static URL
+
+    :param filename: path relative to static/, e.g. 'css/styles.css'
+    :param values: passed on to url_for, e.g. _external=True
+    """
+    hashed_path = current_app.extensions['assets'].get(filename)
+    if hashed_path is None:
+        return url_for('static', filename=filename, **values)
+    return url_for('asset', filename=hashed_path, **values)
+
+
+def init_app(app):
+    """
+    Sets up fingerprinted assets from ASSETS_DIR (default static/dist), registers the /assets/ route, the 'asset_url'
+    template global and 'flask assets build'
+
+    :param app: the Flask app
+    :return: the AssetManifest
+    """
+    app.config.setdefault('ASSETS_DIR', os.path.join(app.static_folder, 'dist'))
+    dist_dir = app.config['ASSETS_DIR']
+    # Pick up rebuilds without a restart while developing
+    manifest = AssetManifest(os.path.join(dist_dir, MANIFEST_NAME), auto_reload=app.debug)
+    app.extensions['assets'] = manifest
+    app.add_template_global(asset_url)
+
+    @app.route('/assets/<path:filename>')
+    def asset(filename):
+        """
+        Serves a fingerprinted file, precompressed when the client accepts it. The name changes with the content, so
+        browsers may keep it for a year without revalidating
+        """
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding = None
+        for candidate, suffix in ENCODING_SUFFIXES.items():
+            if request.accept_encodings[candidate] and os.path.exists(os.path.join(dist_dir, filename + suffix)):
+                encoding = candidate
+                break
+
+        served_name = filename + ENCODING_SUFFIXES[encoding] if encoding else filename
+        response = send_from_directory(dist_dir, served_name, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+        response.cache_control.immutable = True
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if filename.endswith(COMPRESSIBLE_EXTENSIONS):
+            response.vary.add('Accept-Encoding')
+        return response
+
+    @app.cli.group('assets')
+    def assets_group():
+        """
+        Fingerprinted static assets
+        """
+
+    @assets_group.command('build')
+    @click.option('--clean', is_flag=True, help="Delete files of previous builds from the output directory.")
+    def build_command(clean):
+        """
+        Fingerprints and precompresses static/ into ASSETS_DIR, run it on every deploy
+        """
+        entries = build(app.static_folder, dist_dir, clean=clean)
+        manifest.load()
+        print(f"Built {len(entries)} assets into {dist_dir}"
+              f"{'' if brotli else ' (install Brotli for .br variants)'}")
+
+    return manifest
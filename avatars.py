@@ -0,0 +1,151 @@
+from functools import lru_cache
+import hashlib
+import hmac
+import re
+
+import click
+from flask import abort, current_app, request
+
+from assets import asset_url
+from conditional import touch_watermark
+from models import db, User
+import page_cache
+
+
+# ---------------------Identicons---------------------------------
+# Every user gets a generated avatar: a symmetric 5x5 pattern in a colour, both derived from a keyed hash of their
+# email. It is computed once, when the user is created, and stored as User.avatar_url. The SVG is a few hundred bytes,
+# never written to disk (whatever name is asked for): the most recently served ones are kept in a bounded in-process
+# LRU, and browsers and proxies keep them for a year. Nothing is fetched from a third party.
+
+GRID = 5
+NAME = re.compile(r"^[0-9a-f]{32}$")
+DEFAULT_AVATAR = 'assets/img/default-profile.jpg'
+IMMUTABLE_MAX_AGE = 31536000
+# Identicons kept in memory per process, a few hundred bytes each
+RENDERED_CACHE_SIZE = 1024
+
+
+def avatar_name(email):
+    """
+    Keyed with SECRET_KEY, so the name does not give away the email the way a plain hash (like Gravatar's) does
+
+    :return: 32 hex chars identifying the avatar of email
+    """
+    key = (current_app.config.get('SECRET_KEY') or "").encode('utf-8')
+    return hmac.new(key, email.strip().lower().encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+
+def avatar_url_for(email):
+    """
+    :return: the URL stored in User.avatar_url for a user with this email
+    """
+    return f"{current_app.config['AVATAR_URL_PREFIX']}/{avatar_name(email)}.svg"
+
+
+def set_avatar(user):
+    """
+    Sets the avatar_url of a new user, call before adding it to the session
+    """
+    user.avatar_url = avatar_url_for(user.email)
+
+
+@lru_cache(maxsize=RENDERED_CACHE_SIZE)
+def identicon_svg(name):
+    """
+    :param name: an avatar name (32 hex chars)
+    :return: the identicon as SVG bytes, the same for the same name
+    """
+    digest = bytes.fromhex(name)
+    hue = int.from_bytes(digest[:2], 'big') % 360
+    half = (GRID + 1) // 2
+    bits = int.from_bytes(digest[2:], 'big')
+    cells = []
+    for row in range(GRID):
+        for column in range(half):
+            if bits >> (row * half + column) & 1:
+                # Mirror the left half onto the right
+                cells.append((column, row))
+                if column != GRID - 1 - column:
+                    cells.append((GRID - 1 - column, row))
+    path = "".join(f"M{x} {y}h1v1h-1z" for x, y in cells)
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="-0.5 -0.5 {GRID + 1} {GRID + 1}" width="100" height="100" '
+        f'shape-rendering="crispEdges"><rect x="-0.5" y="-0.5" width="{GRID + 1}" height="{GRID + 1}" fill="#f0f0f0"/>'
+        f'<path fill="hsl({hue}, 55%, 50%)" d="{path}"/></svg>'
+    ).encode('utf-8')
+
+
+def avatar(url):
+    """
+    Template filter: the stored avatar URL of a comment's author, or the default picture for comments without one
+    (deleted authors, users created before avatars existed). e.g. {{ comment.author_avatar_url|avatar }}
+    """
+    return url or asset_url(DEFAULT_AVATAR)
+
+
+def backfill(batch_size=500, everything=False):
+    """
+    Sets avatar_url of the users who have none (of every user with everything=True), a batch per transaction
+
+    :return: number of users updated
+    """
+    count = 0
+    last_id = 0
+    while True:
+        query = db.select(User.id, User.email).where(User.id > last_id).order_by(User.id).limit(batch_size)
+        if not everything:
+            query = query.where(User.avatar_url.is_(None))
+        rows = db.session.execute(query).all()
+        if not rows:
+            if count:
+                # Comment threads show the avatars: drop the cached pages and make browsers revalidate theirs
+                touch_watermark('pages_rewritten')
+                db.session.commit()
+                page_cache.invalidate_all()
+            return count
+        db.session.execute(db.update(User), [{'id': row.id, 'avatar_url': avatar_url_for(row.email)} for row in rows])
+        db.session.commit()
+        count += len(rows)
+        last_id = rows[-1].id
+
+
+def init_app(app):
+    """
+    Registers the avatar route under AVATAR_URL_PREFIX (default /avatars), the 'avatar' template filter and
+    'flask avatars backfill'
+
+    :param app: the Flask app
+    """
+    app.config.setdefault('AVATAR_URL_PREFIX', '/avatars')
+    app.add_template_filter(avatar)
+
+    @app.route(f"{app.config['AVATAR_URL_PREFIX']}/<name>.svg")
+    def avatar_image(name):
+        """
+        Serves an identicon. Its name never changes meaning, so browsers may keep it for a year
+        """
+        if not NAME.match(name):
+            abort(404)
+        response = app.response_class(identicon_svg(name), mimetype='image/svg+xml')
+        response.set_etag(name)
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        return response.make_conditional(request)
+
+    @app.cli.group('avatars')
+    def avatars_group():
+        """
+        Generated user avatars
+        """
+
+    @avatars_group.command('backfill')
+    @click.option('--batch-size', default=500, show_default=True, help="Users updated per transaction.")
+    @click.option('--all', 'everything', is_flag=True,
+                  help="Recompute every user's avatar, e.g. after AVATAR_URL_PREFIX changed.")
+    def backfill_command(batch_size, everything):
+        """
+        Gives an avatar to the users created before avatars existed
+        """
+        print(f"Set the avatar of {backfill(batch_size, everything)} users")
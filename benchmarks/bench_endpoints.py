@@ -0,0 +1,427 @@
+"""
+Benchmarks the blog's hot endpoints: the home feed, a post with a long comment thread, a typical post, the comments
+JSON, login and posting a comment. Reports p50/p95/p99 latency, throughput, SQL statements per request and peak RSS,
+through Flask's test client (the app in this process) and/or a real gunicorn server.
+
+Baselines: --save-baseline writes the results to a JSON file, --baseline compares against one and exits with status
+1 when a p95 got more than --tolerance slower or an endpoint issues more queries than before. Baselines are only
+comparable on the same machine, database and volumes.
+
+Usage (from the repo root):
+    python benchmarks/bench_endpoints.py
+    python benchmarks/bench_endpoints.py --driver testclient --requests 500 --posts 2000
+    python benchmarks/bench_endpoints.py --driver gunicorn --workers 4 --concurrency 8
+    python benchmarks/bench_endpoints.py --db postgresql://localhost/blog_bench --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_endpoints.py --baseline benchmarks/baseline.json
+"""
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from seed_data import BENCH_PASSWORD, seed  # noqa: E402
+
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+# ---------------------Scenarios---------------------------------
+# (name, endpoint the /metrics series are labelled with, needs a logged in session, request builder)
+# A request builder takes the seeded ids and returns (method, path, form data or None)
+
+def _scenarios(seeded, email):
+    hot = seeded['hot_post_id']
+    post_ids = seeded['post_ids']
+    return [
+        ('GET /', 'get_all_posts', False, lambda: ('GET', '/', None)),
+        ('GET /post/<hot>', 'show_post', False, lambda: ('GET', f'/post/{hot}', None)),
+        ('GET /post/<id>', 'show_post', False, lambda: ('GET', f'/post/{random.choice(post_ids)}', None)),
+        ('GET /post/<hot>/comments', 'post_comments', False,
+         lambda: ('GET', f'/post/{hot}/comments?after={random.randint(0, 500)}', None)),
+        ('POST /login', 'login', False, lambda: ('POST', '/login', {'email': email, 'password': BENCH_PASSWORD})),
+        ('POST comment', 'show_post', True,
+         lambda: ('POST', f'/post/{hot}', {'body': "<p>Benchmark comment</p>", 'submit_button': "Submit Comment"})),
+    ]
+
+
+# ---------------------Drivers---------------------------------
+
+class TestClientDriver:
+    """
+    Calls the app in this process through Flask's test client, one request at a time
+    """
+
+    name = 'testclient'
+
+    def __init__(self, app):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        self.app = app
+        self.queries = 0
+
+        def count(*args):
+            self.queries += 1
+        event.listen(Engine, 'before_cursor_execute', count)
+
+    def session(self):
+        return TestClientSession(self.app.test_client())
+
+    def run(self, session_factory, build_request, count, concurrency):
+        session = session_factory()
+        latencies, errors = [], 0
+        queries_before = self.queries
+        started = time.perf_counter()
+        for _ in range(count):
+            elapsed, ok = session.timed(*build_request())
+            latencies.append(elapsed)
+            errors += not ok
+        wall = time.perf_counter() - started
+        return latencies, errors, wall, (self.queries - queries_before) / count
+
+    def peak_rss_mb(self):
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def close(self):
+        pass
+
+
+class TestClientSession:
+    def __init__(self, client):
+        self.client = client
+        self.csrf_token = None
+
+    def request(self, method, path, data=None):
+        if data is not None:
+            data = dict(data, csrf_token=self.csrf_token)
+        response = self.client.open(path, method=method, data=data)
+        body = response.get_data()
+        response.close()
+        return response.status_code, body
+
+    def timed(self, method, path, data=None):
+        started = time.perf_counter()
+        status, _ = self.request(method, path, data)
+        return time.perf_counter() - started, status < 400
+
+
+class GunicornDriver:
+    """
+    Starts 'gunicorn app:create_app()' on a free local port and drives it over HTTP from --concurrency threads
+    """
+
+    name = 'gunicorn'
+
+    def __init__(self, env, workers, port):
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.metrics_dir = tempfile.mkdtemp(prefix="bench-metrics-")
+        self.env = dict(env, PROMETHEUS_MULTIPROC_DIR=self.metrics_dir)
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'app:create_app()',
+             '--config', os.path.join(REPO_ROOT, 'gunicorn.conf.py'), '--workers', str(workers),
+             '--bind', f"127.0.0.1:{port}", '--chdir', REPO_ROOT, '--log-level', 'warning'],
+            env=self.env,
+        )
+        self._wait_until_ready()
+
+    def _wait_until_ready(self, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with status {self.process.returncode}")
+            try:
+                urllib.request.urlopen(self.base_url + '/health', timeout=1).read()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("gunicorn did not start in time")
+
+    def session(self):
+        return HttpSession(self.base_url)
+
+    def run(self, session_factory, build_request, count, concurrency, endpoint=None):
+        per_thread = max(1, count // concurrency)
+        # Logging the sessions in hits the same endpoints, so do it before taking the query counts
+        sessions = [session_factory() for _ in range(concurrency)]
+        before = self._endpoint_queries(endpoint)
+
+        def worker(session):
+            return [session.timed(*build_request()) for _ in range(per_thread)]
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = [result for thread_results in pool.map(worker, sessions) for result in thread_results]
+        wall = time.perf_counter() - started
+
+        after = self._endpoint_queries(endpoint)
+        queries = None
+        if before is not None and after is not None and after[1] > before[1]:
+            queries = (after[0] - before[0]) / (after[1] - before[1])
+        return [elapsed for elapsed, _ in results], sum(not ok for _, ok in results), wall, queries
+
+    def _endpoint_queries(self, endpoint):
+        """
+        :return: (sum, count) of http_request_db_queries for endpoint from /metrics, or None
+        """
+        if endpoint is None:
+            return None
+        try:
+            text = urllib.request.urlopen(self.base_url + '/metrics', timeout=5).read().decode()
+        except OSError:
+            return None
+        values = {}
+        for suffix in ('sum', 'count'):
+            match = re.search(rf'^http_request_db_queries_{suffix}{{endpoint="{endpoint}"}} (\S+)$', text, re.M)
+            values[suffix] = float(match.group(1)) if match else 0.0
+        return values['sum'], values['count']
+
+    def peak_rss_mb(self):
+        """
+        :return: the highest peak RSS (VmHWM) of the gunicorn workers, Linux only
+        """
+        peaks = []
+        for pid in _child_pids(self.process.pid):
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith('VmHWM:'):
+                            peaks.append(int(line.split()[1]) / 1024)
+            except OSError:
+                pass
+        return max(peaks) if peaks else None
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait(timeout=30)
+
+
+def _child_pids(pid):
+    children = []
+    try:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                with open(f"/proc/{entry}/stat") as f:
+                    # The parent pid is the 4th field, after the parenthesised command name
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        children.append(int(entry))
+    except OSError:
+        pass
+    return children
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect())
+        self.csrf_token = None
+
+    def request(self, method, path, data=None):
+        body = None
+        if data is not None:
+            body = urlencode(dict(data, csrf_token=self.csrf_token)).encode()
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method),
+                                  timeout=30) as response:
+                return response.status, response.read()
+        except HTTPError as e:
+            # Redirects (not followed) and error statuses
+            return e.code, e.read()
+
+    def timed(self, method, path, data=None):
+        started = time.perf_counter()
+        status, _ = self.request(method, path, data)
+        return time.perf_counter() - started, status < 400
+
+
+# ---------------------Sessions---------------------------------
+
+def prepared_session(driver, email, logged_in):
+    """
+    :return: a session holding a CSRF token, logged in as email if logged_in
+    """
+    session = driver.session()
+    status, body = session.request('GET', '/login')
+    match = CSRF_TOKEN.search(body.decode())
+    session.csrf_token = match.group(1) if match else None
+    if logged_in:
+        status, _ = session.request('POST', '/login', {'email': email, 'password': BENCH_PASSWORD})
+        if status != 302:
+            raise RuntimeError(f"Benchmark login failed with status {status}")
+    return session
+
+
+# ---------------------Reporting---------------------------------
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, wall, queries):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'rps': round(len(latencies) / wall, 1),
+        'queries': round(queries, 2) if queries is not None else None,
+    }
+
+
+def print_results(driver_name, results, peak_rss_mb):
+    print(f"\n{driver_name} (peak RSS {f'{peak_rss_mb:.0f} MB' if peak_rss_mb else 'n/a'})")
+    print(f"{'endpoint':<26} {'reqs':>6} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'queries':>8}")
+    for name, result in results.items():
+        queries = '-' if result['queries'] is None else f"{result['queries']:.1f}"
+        print(f"{name:<26} {result['requests']:>6} {result['errors']:>4} {result['p50_ms']:>8.2f} "
+              f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['rps']:>8.1f} {queries:>8}")
+
+
+def regressions(results, baseline, tolerance):
+    """
+    :return: list of human readable regressions of results against baseline
+    """
+    found = []
+    for driver_name, endpoints in results.items():
+        for name, result in endpoints['endpoints'].items():
+            previous = baseline.get(driver_name, {}).get('endpoints', {}).get(name)
+            if previous is None:
+                continue
+            if result['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                found.append(f"{driver_name} {name}: p95 {previous['p95_ms']} -> {result['p95_ms']} ms")
+            if None not in (result['queries'], previous['queries']) and result['queries'] > previous['queries'] + 0.01:
+                found.append(f"{driver_name} {name}: queries {previous['queries']} -> {result['queries']}")
+    return found
+
+
+# ---------------------Main---------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help="database URL, default a fresh SQLite file in a temp directory")
+    parser.add_argument('--no-seed', action='store_true', help="use the data already in --db")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--comments', type=int, default=10, help="comments per post")
+    parser.add_argument('--hot-comments', type=int, default=1000, help="comments on the hot post")
+    parser.add_argument('--driver', choices=('testclient', 'gunicorn', 'both'), default='both')
+    parser.add_argument('--requests', type=int, default=200, help="measured requests per endpoint")
+    parser.add_argument('--warmup', type=int, default=20, help="unmeasured requests per endpoint first")
+    parser.add_argument('--login-requests', type=int, default=20,
+                        help="measured logins, each costs a full password hash")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--concurrency', type=int, default=4, help="client threads against gunicorn")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--page-cache', default='none', help="PAGE_CACHE_BACKEND, 'none' measures the views")
+    parser.add_argument('--only', help="comma separated endpoint names to run, e.g. 'GET /,POST /login'")
+    parser.add_argument('--baseline', help="compare with this baseline file, exit 1 on regressions")
+    parser.add_argument('--save-baseline', help="write the results to this file")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed p95 slowdown against the baseline")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="blog-bench-")
+    env = {
+        'DB_URI': args.db or f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'SECRET_APP_KEY': os.environ.get('SECRET_APP_KEY', 'benchmark-secret'),
+        'SUPER_ADMIN_EMAIL': 'admin@example.com',
+        'PAGE_CACHE_BACKEND': args.page_cache,
+        'MAIL_QUEUE_WORKER': 'none',
+        # The scenarios log in far more often than the login rate limit allows
+        'RATE_LIMIT_BACKEND': 'none',
+    }
+    # The app reads its configuration from the environment when it is built
+    os.environ.update(env)
+    env = dict(os.environ)
+
+    from app import create_app, create_db
+
+    app = create_app()
+    with app.app_context():
+        create_db()
+        if args.no_seed:
+            from models import db, Post
+            post_ids = db.session.execute(db.select(Post.id).order_by(Post.id)).scalars().all()
+            seeded = {'hot_post_id': post_ids[-1], 'post_ids': post_ids, 'login_email': "bench-user-0@example.com"}
+        else:
+            started = time.perf_counter()
+            seeded = seed(args.users, args.posts, args.comments, args.hot_comments)
+            print(f"Seeded {len(seeded['post_ids'])} posts in {time.perf_counter() - started:.1f}s")
+
+    scenarios = _scenarios(seeded, seeded['login_email'])
+    if args.only:
+        wanted = set(args.only.split(','))
+        scenarios = [scenario for scenario in scenarios if scenario[0] in wanted]
+
+    drivers = []
+    if args.driver in ('testclient', 'both'):
+        drivers.append(lambda: TestClientDriver(app))
+    if args.driver in ('gunicorn', 'both'):
+        drivers.append(lambda: GunicornDriver(env, args.workers, args.port))
+
+    all_results = {}
+    for make_driver in drivers:
+        driver = make_driver()
+        try:
+            results = {}
+            for name, endpoint, logged_in, build_request in scenarios:
+                count = args.login_requests if name == 'POST /login' else args.requests
+
+                def session_factory():
+                    return prepared_session(driver, seeded['login_email'], logged_in)
+
+                extra = {'endpoint': endpoint} if isinstance(driver, GunicornDriver) else {}
+                driver.run(session_factory, build_request, min(args.warmup, count), 1, **extra)
+                results[name] = summarize(*driver.run(session_factory, build_request, count, args.concurrency,
+                                                      **extra))
+            peak_rss = driver.peak_rss_mb()
+        finally:
+            driver.close()
+        print_results(driver.name, results, peak_rss)
+        all_results[driver.name] = {'endpoints': results, 'peak_rss_mb': peak_rss}
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(all_results, f, indent=2, sort_keys=True)
+        print(f"\nBaseline written to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(all_results, baseline, args.tolerance)
+        if found:
+            print("\nRegressions against the baseline:")
+            for line in found:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Reports how many logins per second each password scheme can verify, on one thread and through the bounded pool.
+
+Usage (from the repo root):
+    python benchmarks/bench_password_hashing.py
+    python benchmarks/bench_password_hashing.py --schemes argon2,bcrypt --seconds 5 --concurrency 8
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import PasswordHasher, HashingBusy, context_settings  # noqa: E402
+
+
+DEFAULT_COSTS = {
+    'PASSWORD_PBKDF2_ROUNDS': 260000,
+    'PASSWORD_BCRYPT_ROUNDS': 12,
+    'PASSWORD_ARGON2_TIME_COST': 3,
+    'PASSWORD_ARGON2_MEMORY_COST': 65536,
+}
+
+
+def logins_per_second(hasher, stored_hash, seconds, concurrency):
+    """
+    Verifies the same password from 'concurrency' client threads for 'seconds'
+
+    :return: (verified per second, rejected with HashingBusy per second)
+    """
+    deadline = time.perf_counter() + seconds
+    counts = {'ok': 0, 'busy': 0}
+
+    def client():
+        ok = busy = 0
+        while time.perf_counter() < deadline:
+            try:
+                hasher.verify_and_update("correct horse battery staple", stored_hash)
+                ok += 1
+            except HashingBusy:
+                busy += 1
+        return ok, busy
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        for ok, busy in clients.map(lambda _: client(), range(concurrency)):
+            counts['ok'] += ok
+            counts['busy'] += busy
+    elapsed = time.perf_counter() - started
+    return counts['ok'] / elapsed, counts['busy'] / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--schemes', default="pbkdf2_sha256,argon2,bcrypt")
+    parser.add_argument('--seconds', type=float, default=3.0, help="duration of each measurement")
+    parser.add_argument('--workers', type=int, default=2, help="hashing pool size (PASSWORD_HASH_WORKERS)")
+    parser.add_argument('--concurrency', type=int, default=4, help="concurrent login attempts in the pooled run")
+    args = parser.parse_args()
+
+    settings = context_settings(DEFAULT_COSTS)
+    print(f"{'scheme':<15} {'1 thread/s':>11} {'pooled/s':>10} {'busy/s':>8}")
+    for scheme in args.schemes.split(","):
+        try:
+            hasher = PasswordHasher([scheme], settings, workers=args.workers, max_pending=args.concurrency * 2)
+        except RuntimeError as e:
+            print(f"{scheme:<15} skipped: {e}")
+            continue
+        stored_hash = hasher.hash("correct horse battery staple")
+        single, _ = logins_per_second(hasher, stored_hash, args.seconds, 1)
+        pooled, busy = logins_per_second(hasher, stored_hash, args.seconds, args.concurrency)
+        hasher.shutdown()
+        print(f"{scheme:<15} {single:>11.1f} {pooled:>10.1f} {busy:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Measures how fast the blog starts: importing app.py, create_app(), warm_up() and the first requests, each run in a
+fresh interpreter. Also times the first request of a process forked from the built app, which is what a gunicorn
+worker of the preloaded app (see gunicorn.conf.py) pays, against the first request of a cold one.
+
+Usage (from the repo root):
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 20 --no-warm-up
+    python benchmarks/bench_startup.py --db postgresql://localhost/blog_bench --no-seed
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+# ---------------------Measurement---------------------------------
+# Runs in the fresh interpreter started for every run, it prints the timings as JSON
+
+def _timed(timings, name, func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    timings[name] = time.perf_counter() - started
+    return result
+
+
+def _get(client, path):
+    response = client.get(path)
+    response.get_data()
+    if response.status_code != 200:
+        raise RuntimeError(f"GET {path} answered {response.status_code}")
+
+
+def measure(post_id, warm_up):
+    """
+    :return: dict of phase -> seconds
+    """
+    timings = {}
+    started = time.perf_counter()
+    import app as app_module
+    timings['import app'] = time.perf_counter() - started
+
+    app = _timed(timings, 'create_app()', app_module.create_app)
+    if warm_up:
+        _timed(timings, 'warm_up()', app_module.warm_up, app)
+
+    if hasattr(os, 'fork'):
+        # Fork before any request, like gunicorn forks its workers from the master
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            import db_config
+
+            db_config.dispose_engines(app)
+            forked = {}
+            _timed(forked, 'forked: first GET /', _get, app.test_client(), '/')
+            os.write(write_fd, json.dumps(forked).encode())
+            os._exit(0)
+        os.close(write_fd)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_fd) as f:
+            timings.update(json.load(f))
+
+    client = app.test_client()
+    _timed(timings, 'first GET /', _get, client, '/')
+    _timed(timings, 'second GET /', _get, client, '/')
+    _timed(timings, 'first GET /post/<id>', _get, client, f'/post/{post_id}')
+    _timed(timings, 'second GET /post/<id>', _get, client, f'/post/{post_id}')
+    return timings
+
+
+# ---------------------Runner---------------------------------
+
+def run_once(env, post_id, warm_up):
+    """
+    Measures one startup in a new interpreter
+
+    :return: dict of phase -> seconds
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--measure', '--post-id', str(post_id)]
+    if not warm_up:
+        command.append('--no-warm-up')
+    output = subprocess.run(command, env=env, cwd=REPO_ROOT, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def report(runs):
+    phases = list(runs[0])
+    print(f"{'phase':<26} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    for phase in phases:
+        values = [run[phase] * 1000 for run in runs]
+        print(f"{phase:<26} {statistics.median(values):>10.1f} {min(values):>8.1f} {max(values):>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help="database URL, default a fresh SQLite file in a temp directory")
+    parser.add_argument('--no-seed', action='store_true', help="use the data already in --db")
+    parser.add_argument('--posts', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=10, help="fresh interpreters started")
+    parser.add_argument('--no-warm-up', dest='warm_up', action='store_false',
+                        help="skip warm_up(), gunicorn.conf.py runs it in the master of the preloaded app")
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--post-id', type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.post_id, args.warm_up)))
+        return
+
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    env = {
+        'DB_URI': args.db or f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'SECRET_APP_KEY': os.environ.get('SECRET_APP_KEY', 'benchmark-secret'),
+        # Measure the views, not the caches
+        'PAGE_CACHE_BACKEND': 'none',
+        'MAIL_QUEUE_WORKER': 'none',
+        'RATE_LIMIT_BACKEND': 'none',
+    }
+    os.environ.update(env)
+    env = dict(os.environ)
+
+    from app import create_app, create_db
+    from models import db, Post
+
+    app = create_app()
+    with app.app_context():
+        if not args.no_seed:
+            from seed_data import seed
+
+            create_db()
+            seed(users=5, posts=args.posts, comments_per_post=5, hot_comments=100)
+        post_id = db.session.execute(db.select(db.func.max(Post.id))).scalar()
+
+    runs = [run_once(env, post_id, args.warm_up) for _ in range(args.runs)]
+    print(f"\n{args.runs} startups{'' if args.warm_up else ', without warm_up()'}")
+    report(runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Fills the configured database (DB_URI) with benchmark data: the super admin and sample post from seed_super_admin.py,
+then users, posts and comments in bulk, plus one "hot" post with a long comment thread.
+
+Usage (from the repo root, on an empty database):
+    DB_URI=sqlite:////tmp/bench.db SUPER_ADMIN_EMAIL=admin@example.com python benchmarks/seed_data.py --posts 500
+"""
+from datetime import date, timedelta
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Every benchmark user logs in with this password
+BENCH_PASSWORD = "benchmark-password"
+
+
+def seed(users=50, posts=200, comments_per_post=10, hot_comments=1000, batch_size=1000):
+    """
+    Inserts the benchmark data. Must run inside an app context on a database without benchmark data yet.
+
+    :param users: regular users, bench-user-<n>@example.com
+    :param posts: posts, spread over the admin and the users
+    :param comments_per_post: comments on every post but the hot one
+    :param hot_comments: comments on the hot post (the newest one)
+    :param batch_size: rows per INSERT round trip
+    :return: dict with 'hot_post_id', 'post_ids' and 'login_email' for the drivers
+    """
+    from models import db, User, Post, Comment
+    from seed_super_admin import set_super_admin
+    import avatars
+    import content
+    import passwords
+    import search
+
+    set_super_admin()
+
+    # One hash for everyone: hashing is the slow part of login and is measured there, not while seeding
+    password_hash = passwords.hash_password(BENCH_PASSWORD)
+    _insert(db, User, [
+        {'email': f"bench-user-{n}@example.com", 'username': f"bench-user-{n}", 'password': password_hash,
+         'agree_to_terms': True, 'is_admin': False,
+         'avatar_url': avatars.avatar_url_for(f"bench-user-{n}@example.com")}
+        for n in range(users)
+    ], batch_size)
+    author_ids = db.session.execute(db.select(User.id).order_by(User.id)).scalars().all()
+
+    paragraph = ("<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit. Suspendisse et elementum tellus. "
+                 "Morbi at luctus tellus, sed <strong>tincidunt</strong> nulla.</p>")
+    today = date.today()
+    _insert(db, Post, [
+        {'title': f"Benchmark post {n}", 'subtitle': f"Subtitle of benchmark post {n}",
+         'body': paragraph * (5 + n % 20), 'img_url': "", 'author_id': author_ids[n % len(author_ids)],
+         'date': today - timedelta(days=posts - n)}
+        for n in range(posts)
+    ], batch_size)
+    post_ids = db.session.execute(
+        db.select(Post.id).where(Post.title.like("Benchmark post %")).order_by(Post.id)
+    ).scalars().all()
+    hot_post_id = post_ids[-1]
+
+    def comment_rows():
+        for post_id in post_ids:
+            count = hot_comments if post_id == hot_post_id else comments_per_post
+            for n in range(count):
+                yield {'post_id': post_id, 'author_id': author_ids[n % len(author_ids)],
+                       'text': f"<p>Benchmark comment {n} on post {post_id}.</p>"}
+
+    _insert(db, Comment, comment_rows(), batch_size)
+    db.session.execute(
+        db.update(Post).values(
+            comment_count=db.select(db.func.count(Comment.id)).where(Comment.post_id == Post.id).scalar_subquery()
+        )
+    )
+    db.session.commit()
+    content.backfill(batch_size)
+    search.reindex_all()
+
+    return {'hot_post_id': hot_post_id, 'post_ids': post_ids, 'login_email': "bench-user-0@example.com"}
+
+
+def _insert(db, model, rows, batch_size):
+    """
+    executemany INSERTs of batch_size rows, committed per batch
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            db.session.execute(db.insert(model), batch)
+            db.session.commit()
+            batch = []
+    if batch:
+        db.session.execute(db.insert(model), batch)
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--comments', type=int, default=10, help="comments per post")
+    parser.add_argument('--hot-comments', type=int, default=1000, help="comments on the hot post")
+    args = parser.parse_args()
+
+    from app import create_app, create_db
+
+    app = create_app()
+    with app.app_context():
+        create_db()
+        seeded = seed(args.users, args.posts, args.comments, args.hot_comments)
+    print(f"Seeded {len(seeded['post_ids'])} posts, hot post {seeded['hot_post_id']}")
+
+
+if __name__ == "__main__":
+    main()
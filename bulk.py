@@ -0,0 +1,321 @@
+from datetime import date, datetime
+from time import perf_counter
+import json
+import sys
+
+import click
+
+from models import db, User, Post, Comment
+import avatars
+import content
+import page_cache
+import search
+
+
+# ---------------------Format---------------------------------
+# NDJSON, one record per line with a "type" of 'user', 'post' or 'comment'. Records point at each other by their
+# natural keys (a user's email, a post's title) rather than ids, so an export imports into a database that already
+# has content. Exports list users, then posts, then comments; an import only needs a record's user and post to come
+# before it in the file.
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def _keyset(select, id_column, batch_size):
+    """
+    Runs 'select' in batches ordered by id_column, one query per batch, so memory stays flat however big the table is
+    """
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select.where(id_column > last_id).order_by(id_column).limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+        # Nothing is changed, let go of the rows of the last batch
+        db.session.expunge_all()
+
+
+def export_records(batch_size=EXPORT_BATCH_SIZE):
+    """
+    Generates every user, post and comment as an export record (a dict)
+
+    :param batch_size: rows fetched per query
+    """
+    users = db.select(User.id, User.email, User.username, User.password, User.agree_to_terms, User.is_admin)
+    for row in _keyset(users, User.id, batch_size):
+        yield {'type': 'user', 'email': row.email, 'username': row.username, 'password': row.password,
+               'agree_to_terms': row.agree_to_terms, 'is_admin': bool(row.is_admin)}
+
+    posts = db.select(
+        Post.id, Post.title, Post.subtitle, Post.date, Post.body, Post.img_url, User.email.label('author_email')
+    ).outerjoin(User, User.id == Post.author_id)
+    for row in _keyset(posts, Post.id, batch_size):
+        yield {'type': 'post', 'title': row.title, 'subtitle': row.subtitle, 'date': row.date.isoformat(),
+               'body': row.body, 'img_url': row.img_url, 'author_email': row.author_email}
+
+    comments = db.select(
+        Comment.id, Comment.text, Post.title.label('post_title'), User.email.label('author_email')
+    ).join(Post, Post.id == Comment.post_id).outerjoin(User, User.id == Comment.author_id)
+    for row in _keyset(comments, Comment.id, batch_size):
+        yield {'type': 'comment', 'post_title': row.post_title, 'author_email': row.author_email, 'text': row.text}
+
+
+def read_records(lines):
+    """
+    Parses NDJSON lines lazily, skipping blank ones
+
+    :raise click.ClickException: on a line that is not a JSON object with a known type
+    """
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise click.ClickException(f"Line {number}: invalid JSON ({e})")
+        if not isinstance(record, dict) or record.get('type') not in ('user', 'post', 'comment'):
+            raise click.ClickException(f"Line {number}: expected an object with a type of user, post or comment")
+        yield number, record
+
+
+# ---------------------Import---------------------------------
+
+class Importer:
+    """
+    Inserts records in batches of batch_size rows (one executemany INSERT and one commit per batch).
+
+    Duplicates are skipped: users whose email or username exists, posts whose title exists (titles are unique) and
+    the comments of skipped posts, so running the same import twice adds nothing. Keeps comment_count and the search
+    index of every post it touches up to date.
+    """
+
+    def __init__(self, batch_size=1000, progress=None):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.pending = {'user': [], 'post': [], 'comment': []}
+        self.inserted = {'user': 0, 'post': 0, 'comment': 0}
+        self.skipped = {'user': 0, 'post': 0, 'comment': 0}
+        # Titles of posts that were in the database before the import, their comments are already there too
+        self.skipped_titles = set()
+        # Posts that existed before the import and got comments, reindexed at the end with the new posts
+        self.touched_post_ids = set()
+        self.last_post_id = db.session.execute(db.select(db.func.max(Post.id))).scalar() or 0
+        self.started = perf_counter()
+
+    @property
+    def rows(self):
+        return sum(self.inserted.values()) + sum(self.skipped.values())
+
+    def add(self, number, record):
+        """
+        Queues one record, flushing its batch (and the batches it depends on) when full
+        """
+        kind = record['type']
+        try:
+            row = getattr(self, f"_{kind}_row")(record)
+        except (KeyError, TypeError, ValueError) as e:
+            raise click.ClickException(f"Line {number}: invalid {kind} record ({e!r})")
+        self.pending[kind].append(row)
+        if len(self.pending[kind]) >= self.batch_size:
+            self.flush(kind)
+
+    def flush(self, kind=None):
+        """
+        Inserts the queued rows of 'kind' (all kinds if None). Comments need their posts and authors, and posts
+        their authors, so those are flushed first.
+        """
+        order = ('user', 'post', 'comment')
+        for dependency in order[:order.index(kind) + 1] if kind else order:
+            rows = self.pending[dependency]
+            if rows:
+                self.pending[dependency] = []
+                getattr(self, f"_insert_{dependency}s")(rows)
+                db.session.commit()
+                if self.progress:
+                    self.progress(self)
+
+    def finish(self):
+        """
+        Flushes what is left, then rebuilds the search index of every new or commented post
+
+        :return: number of posts indexed
+        """
+        self.flush()
+        indexed = search.reindex_all(self.batch_size, after_id=self.last_post_id)
+        for post_id in self.touched_post_ids:
+            search.index_post(post_id)
+        db.session.commit()
+        page_cache.invalidate_all()
+        return indexed + len(self.touched_post_ids)
+
+    # ---------------------Rows---------------------------------
+
+    @staticmethod
+    def _user_row(record):
+        return {'email': record['email'], 'username': record['username'], 'password': record['password'],
+                'agree_to_terms': bool(record.get('agree_to_terms', True)), 'is_admin': bool(record.get('is_admin')),
+                'avatar_url': avatars.avatar_url_for(record['email'])}
+
+    @staticmethod
+    def _post_row(record):
+        return {'title': record['title'], 'subtitle': record['subtitle'], 'date': date.fromisoformat(record['date']),
+                'body': record['body'], 'img_url': record.get('img_url') or "",
+                'author_email': record.get('author_email'), **content.post_fields(record['body'])}
+
+    @staticmethod
+    def _comment_row(record):
+        return {'post_title': record['post_title'], 'author_email': record.get('author_email'),
+                'text': record['text'], **content.comment_fields(record['text'])}
+
+    # ---------------------Inserts---------------------------------
+
+    @staticmethod
+    def _unique(rows, key):
+        """
+        Drops rows repeating the key of an earlier row in the batch
+        """
+        seen = set()
+        for row in rows:
+            if row[key] not in seen:
+                seen.add(row[key])
+                yield row
+
+    @staticmethod
+    def _lookup(column, values, id_column):
+        """
+        :return: dict of value -> id for the values present in the database
+        """
+        values = {value for value in values if value is not None}
+        if not values:
+            return {}
+        return dict(db.session.execute(db.select(column, id_column).where(column.in_(values))).all())
+
+    def _insert_users(self, rows):
+        unique = list(self._unique(self._unique(rows, 'email'), 'username'))
+        emails = self._lookup(User.email, (row['email'] for row in unique), User.id)
+        usernames = self._lookup(User.username, (row['username'] for row in unique), User.id)
+        new = [row for row in unique if row['email'] not in emails and row['username'] not in usernames]
+        if new:
+            db.session.execute(db.insert(User), new)
+        self.inserted['user'] += len(new)
+        self.skipped['user'] += len(rows) - len(new)
+
+    def _insert_posts(self, rows):
+        existing = self._lookup(Post.title, (row['title'] for row in rows), Post.id)
+        authors = self._lookup(User.email, (row['author_email'] for row in rows), User.id)
+        new = []
+        for row in self._unique(rows, 'title'):
+            if row['title'] in existing:
+                # A title repeated within the file keeps the comments of both, on the post imported first
+                if existing[row['title']] <= self.last_post_id:
+                    self.skipped_titles.add(row['title'])
+                continue
+            author_email = row.pop('author_email')
+            row['author_id'] = authors.get(author_email)
+            new.append(row)
+        if new:
+            db.session.execute(db.insert(Post), new)
+        self.inserted['post'] += len(new)
+        self.skipped['post'] += len(rows) - len(new)
+
+    def _insert_comments(self, rows):
+        posts = self._lookup(Post.title, (row['post_title'] for row in rows), Post.id)
+        authors = self._lookup(User.email, (row['author_email'] for row in rows), User.id)
+        new = []
+        counts = {}
+        for row in rows:
+            post_id = posts.get(row['post_title'])
+            # Checked here rather than when queued: the post may have been skipped in the batch just flushed
+            if post_id is None or row['post_title'] in self.skipped_titles:
+                continue
+            new.append({'post_id': post_id, 'author_id': authors.get(row['author_email']), 'text': row['text'],
+                        'text_html': row['text_html']})
+            counts[post_id] = counts.get(post_id, 0) + 1
+        if new:
+            db.session.execute(db.insert(Comment), new)
+            # Same bookkeeping as adding a comment through the site, one UPDATE per distinct post
+            posts_table = Post.__table__
+            now = datetime.utcnow()
+            db.session.execute(
+                posts_table.update().where(posts_table.c.id == db.bindparam('b_post_id')).values(
+                    comment_count=posts_table.c.comment_count + db.bindparam('b_count'),
+                    comments_updated_at=now,
+                ),
+                [{'b_post_id': post_id, 'b_count': count} for post_id, count in counts.items()],
+            )
+            self.touched_post_ids.update(post_id for post_id in counts if post_id <= self.last_post_id)
+        self.inserted['comment'] += len(new)
+        self.skipped['comment'] += len(rows) - len(new)
+
+
+def _rate(rows, elapsed):
+    return f"{rows / elapsed:,.0f} rows/s" if elapsed > 0 else "- rows/s"
+
+
+def init_app(app):
+    """
+    Registers the 'flask content export', 'flask content import' and 'flask content backfill' commands
+
+    :param app: the Flask app
+    """
+
+    @app.cli.group('content')
+    def content_group():
+        """
+        Bulk export, import and processing of users, posts and comments
+        """
+
+    @content_group.command('export')
+    @click.argument('output', type=click.File('w', encoding='utf-8'), default='-')
+    @click.option('--batch-size', default=EXPORT_BATCH_SIZE, show_default=True, help="Rows fetched per query.")
+    def export_command(output, batch_size):
+        """
+        Writes every user, post and comment to OUTPUT (default stdout), one JSON object per line
+        """
+        started = perf_counter()
+        rows = 0
+        for record in export_records(batch_size):
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            rows += 1
+        elapsed = perf_counter() - started
+        click.echo(f"Exported {rows} rows in {elapsed:.1f}s ({_rate(rows, elapsed)})", err=True)
+
+    @content_group.command('backfill')
+    @click.option('--batch-size', default=500, show_default=True, help="Rows processed per transaction.")
+    @click.option('--all', 'everything', is_flag=True, help="Reprocess every row, e.g. after changing the allowlist.")
+    def backfill_command(batch_size, everything):
+        """
+        Fills the sanitized HTML and derived fields of the posts and comments written before they existed
+        """
+        started = perf_counter()
+        posts, comments = content.backfill(batch_size, everything)
+        elapsed = perf_counter() - started
+        click.echo(f"Processed {posts} posts and {comments} comments in {elapsed:.1f}s "
+                   f"({_rate(posts + comments, elapsed)})")
+
+    @content_group.command('import')
+    @click.argument('source', type=click.File('r', encoding='utf-8'), default='-')
+    @click.option('--batch-size', default=1000, show_default=True, help="Rows per INSERT and commit.")
+    def import_command(source, batch_size):
+        """
+        Imports the users, posts and comments in SOURCE (default stdin), an NDJSON file written by 'content export'.
+        Existing users (same email or username) and posts (same title) are skipped.
+        """
+        def progress(importer):
+            elapsed = perf_counter() - importer.started
+            click.echo(f"\r{importer.rows} rows, {_rate(importer.rows, elapsed)}", nl=False, err=True)
+
+        importer = Importer(batch_size, progress=progress if sys.stderr.isatty() else None)
+        for number, record in read_records(source):
+            importer.add(number, record)
+        indexed = importer.finish()
+        elapsed = perf_counter() - importer.started
+        if importer.progress:
+            click.echo(err=True)
+        for kind in ('user', 'post', 'comment'):
+            click.echo(f"{kind.capitalize()}s: {importer.inserted[kind]} imported, {importer.skipped[kind]} skipped")
+        click.echo(f"{importer.rows} rows in {elapsed:.1f}s ({_rate(importer.rows, elapsed)}), "
+                   f"reindexed {indexed} posts")
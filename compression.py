@@ -0,0 +1,194 @@
+import gzip
+import zlib
+
+from flask import current_app, g, request
+
+try:
+    import brotli
+except ImportError:  # Optional, responses are only gzipped without it
+    brotli = None
+
+
+# Body types worth compressing, images and fonts are compressed already
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/xml', 'text/javascript', 'application/javascript',
+    'application/json', 'application/xml', 'image/svg+xml',
+}
+
+
+def available_encodings():
+    """
+    :return: the encodings this process can produce, preferred first
+    """
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(encodings=None):
+    """
+    :param encodings: the encodings to choose from, default available_encodings()
+    :return: the first of encodings the request's Accept-Encoding allows, or None
+    """
+    for encoding in encodings or available_encodings():
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress(data, encoding, level):
+    """
+    :param level: gzip level (1-9) or brotli quality (0-11)
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def precompress(data, config):
+    """
+    Compresses data once in every available encoding, at the higher COMPRESS_STORED_* levels since the result is
+    served many times (used by the page cache)
+
+    :return: dict of encoding -> compressed bytes, empty if data is under COMPRESS_MIN_SIZE
+    """
+    if not config['COMPRESS_ENABLED'] or len(data) < config['COMPRESS_MIN_SIZE']:
+        return {}
+    levels = {'br': config['COMPRESS_STORED_BR_LEVEL'], 'gzip': config['COMPRESS_STORED_GZIP_LEVEL']}
+    return {encoding: compress(data, encoding, levels[encoding]) for encoding in available_encodings()}
+
+
+def compressible(response):
+    """
+    :return: True if the response's body may be compressed
+    """
+    return (
+        response.mimetype in COMPRESSIBLE_MIMETYPES
+        and 200 <= response.status_code < 300
+        and response.status_code not in (204, 206)
+        and 'Content-Encoding' not in response.headers
+        and not response.direct_passthrough
+        and not response.cache_control.no_transform
+    )
+
+
+def reflects_secret(response):
+    """
+    BREACH: when a compressed body holds a secret and also echoes request input, an attacker who can make the
+    victim's browser send requests recovers the secret byte by byte from the compressed sizes. The secret here is the
+    CSRF token of the session, the input is the query string or form fields (the /search query, re-rendered forms).
+
+    :return: True if the response may contain this request's CSRF token and the request carries input it can echo
+    """
+    if not (request.args or request.form):
+        return False
+    token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+    if token is None:
+        return False
+    # A streamed body is not known yet, assume the token is in it
+    return response.is_streamed or token.encode('utf-8') in response.get_data()
+
+
+def set_encoded_body(response, data, encoding):
+    """
+    Replaces the response body with its encoded form and sets the matching headers. The ETag becomes weak since the
+    bytes differ from the identity body, which conditional.is_not_modified compares weakly.
+    """
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    _weaken_etag(response)
+    return response
+
+
+def _weaken_etag(response):
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+class _StreamCompressor:
+    """
+    Compresses a streamed body chunk by chunk, flushing after each one so the browser can render what arrived
+    """
+
+    def __init__(self, encoding, level):
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            # wbits=31: zlib stream with a gzip header and trailer
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        self.encoding = encoding
+
+    def compress(self, chunk):
+        if self.encoding == 'br':
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+def _compressed_stream(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            if chunk:
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    """
+    after_request hook compressing text responses with the best encoding the client accepts.
+    Buffered bodies under COMPRESS_MIN_SIZE are left alone. Streamed bodies are compressed chunk by chunk when
+    COMPRESS_STREAMS is on, since their size is unknown until they end. Pages holding the CSRF token next to request
+    input are sent uncompressed (see reflects_secret).
+    """
+    config = current_app.config
+    if not config['COMPRESS_ENABLED'] or not compressible(response):
+        return response
+    # The body depends on Accept-Encoding whether or not this response gets compressed
+    response.vary.add('Accept-Encoding')
+
+    encoding = negotiate()
+    if encoding is None or reflects_secret(response):
+        return response
+    level = config['COMPRESS_BR_LEVEL'] if encoding == 'br' else config['COMPRESS_GZIP_LEVEL']
+
+    if response.is_streamed:
+        if not config['COMPRESS_STREAMS']:
+            return response
+        response.response = _compressed_stream(response.response, _StreamCompressor(encoding, level))
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = encoding
+        _weaken_etag(response)
+        return response
+
+    data = response.get_data()
+    if len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+    return set_encoded_body(response, compress(data, encoding, level), encoding)
+
+
+def init_app(app):
+    """
+    Compresses text responses with gzip, or brotli when the Brotli package is installed.
+
+    COMPRESS_MIN_SIZE (bytes) skips small bodies, COMPRESS_GZIP_LEVEL / COMPRESS_BR_LEVEL set the on-the-fly levels
+    and COMPRESS_STREAMS turns compression of streamed responses on or off.
+
+    :param app: the Flask app
+    """
+    app.config.setdefault('COMPRESS_ENABLED', True)
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_GZIP_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BR_LEVEL', 4)
+    app.config.setdefault('COMPRESS_STORED_GZIP_LEVEL', 9)
+    app.config.setdefault('COMPRESS_STORED_BR_LEVEL', 9)
+    app.config.setdefault('COMPRESS_STREAMS', True)
+    app.after_request(compress_response)
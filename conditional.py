@@ -0,0 +1,157 @@
+from datetime import datetime, timezone
+from functools import wraps
+import hashlib
+import os
+
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+
+from models import db, Watermark
+
+
+def make_etag(*parts):
+    """
+    Builds a strong ETag value from the parts that determine a page's content
+
+    :param parts: values such as ids and modification timestamps
+    :return: hex digest to pass to response.set_etag
+    """
+    return hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+
+
+# ---------------------Release---------------------------------
+# A page also changes when the code rendering it does: after a deploy with new templates or new fingerprinted asset
+# URLs (see assets.py), validators computed from the data alone would answer 304 and leave browsers with HTML pointing
+# at assets that no longer exist. So every ETag includes the release, and no Last-Modified predates it.
+
+def release():
+    """
+    :return: (version, released_at): the version of the templates and of the asset build the pages are rendered with,
+             and when the newest of them was written (UTC). APP_VERSION, when set (e.g. the deployed commit), replaces
+             the templates' version and so also covers changes to the views
+    """
+    templates = current_app.extensions.get('release')
+    if templates is None:
+        version, released_at = _templates_version(current_app)
+        templates = {'version': current_app.config.get('APP_VERSION') or version, 'released_at': released_at}
+        current_app.extensions['release'] = templates
+    assets = current_app.extensions.get('assets')
+    if assets is None or assets.digest is None:
+        return templates['version'], templates['released_at']
+    return f"{templates['version']}:{assets.digest}", max(templates['released_at'], assets.built_at)
+
+
+def _templates_version(app):
+    """
+    :return: (sha256 of the app's templates, modification time of the newest one)
+    """
+    digest = hashlib.sha256()
+    newest = 0
+    folder = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, folder).encode() + b"\0")
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+            newest = max(newest, os.stat(path).st_mtime)
+    return digest.hexdigest()[:12], datetime.utcfromtimestamp(newest)
+
+
+# ---------------------Watermarks---------------------------------
+
+def touch_watermark(name):
+    """
+    Records, in the caller's transaction, a change that leaves no row to carry its time, e.g. 'posts_deleted'
+
+    :param name: the watermark
+    """
+    now = datetime.utcnow()
+    if not db.session.execute(db.update(Watermark).where(Watermark.name == name).values(changed_at=now)).rowcount:
+        db.session.add(Watermark(name=name, changed_at=now))
+
+
+def watermark(name):
+    """
+    :return: a scalar subquery of the watermark's time, to read it in the same query as the other validators
+    """
+    return db.select(Watermark.changed_at).where(Watermark.name == name).scalar_subquery()
+
+
+# ---------------------Conditional GETs---------------------------------
+
+def _viewer():
+    """
+    Pages render differently per user (delete buttons, admin links), so the viewer is part of every ETag
+    """
+    if current_user.is_authenticated:
+        return f"user:{current_user.id}:{int(bool(current_user.is_admin))}"
+    return "anon"
+
+
+def is_not_modified(etag, last_modified):
+    """
+    Checks the request's If-None-Match / If-Modified-Since headers against the page's current validators
+
+    :param etag: the current ETag value
+    :param last_modified: the current modification datetime (UTC) or None
+    :return: True if the client's copy is still fresh
+    """
+    if request.if_none_match:
+        # Weak comparison, per RFC 9110, so compressed variants of the same page also match
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified is not None:
+        # HTTP dates have a one second resolution, compare both as naive UTC
+        if last_modified.tzinfo is not None:
+            last_modified = last_modified.astimezone(timezone.utc).replace(tzinfo=None)
+        return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    return False
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Let browsers keep the page but revalidate it on every use
+    response.cache_control.no_cache = True
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    return response
+
+
+def conditional(validators):
+    """
+    Decorator answering conditional GETs with 304 Not Modified before the view queries or renders anything.
+    Put it under @app.route and @cached_page.
+
+    :param validators: function called with the view's kwargs, returning (etag_parts, last_modified) from a cheap
+                       query, or None if the view should just run (e.g. the post does not exist)
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # Flashed messages are rendered into the page, so never let the browser reuse its copy then
+            if request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+
+            current = validators(**kwargs)
+            if current is None:
+                return view(*args, **kwargs)
+
+            etag_parts, last_modified = current
+            version, released_at = release()
+            etag = make_etag(version, _viewer(), *etag_parts)
+            last_modified = released_at if last_modified is None else max(last_modified, released_at)
+            if is_not_modified(etag, last_modified):
+                return set_validators(current_app.response_class(status=304), etag, last_modified)
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                set_validators(response, etag, last_modified)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,236 @@
+from html import escape
+from html.parser import HTMLParser
+from math import ceil
+from urllib.parse import urlsplit
+import hashlib
+
+from markupsafe import Markup
+
+from conditional import touch_watermark
+from models import db, Post, Comment
+import page_cache
+from search import strip_html
+
+
+# ---------------------Sanitizing---------------------------------
+# Post bodies and comments come from CKEditor as HTML and are shown with |safe. They are cleaned once, when written,
+# against an allowlist: other tags are dropped (their text is kept), script-like ones with their content, and only
+# the listed attributes survive, with links and images restricted to safe URL schemes.
+
+ALLOWED_TAGS = {
+    'a', 'abbr', 'b', 'blockquote', 'br', 'caption', 'code', 'del', 'div', 'em', 'figcaption', 'figure',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'li', 'ol', 'p', 'pre', 's', 'small', 'span',
+    'strike', 'strong', 'sub', 'sup', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul',
+}
+ALLOWED_ATTRIBUTES = {
+    'a': {'href', 'title'},
+    'abbr': {'title'},
+    'img': {'src', 'alt', 'title', 'width', 'height'},
+    'td': {'colspan', 'rowspan'},
+    'th': {'colspan', 'rowspan', 'scope'},
+    'ol': {'start'},
+}
+URL_ATTRIBUTES = {'href', 'src'}
+ALLOWED_SCHEMES = {'', 'http', 'https', 'mailto'}
+# Dropped together with everything inside them
+DROPPED_WITH_CONTENT = {'script', 'style', 'iframe', 'object', 'embed', 'template', 'noscript', 'svg', 'math'}
+VOID_TAGS = {'br', 'hr', 'img'}
+
+# Average adult silent reading speed
+WORDS_PER_MINUTE = 200
+EXCERPT_LENGTH = 280
+
+
+def _safe_url(value):
+    # Browsers ignore whitespace and control characters inside schemes ('java\tscript:'), so does this check
+    cleaned = "".join(ch for ch in value if ch > ' ')
+    try:
+        return urlsplit(cleaned).scheme.lower() in ALLOWED_SCHEMES
+    except ValueError:
+        return False
+
+
+class _Sanitizer(HTMLParser):
+    """
+    Re-serialises an HTML fragment keeping only the allowlisted tags and attributes, with every tag closed
+    """
+
+    def __init__(self, link_rel):
+        super().__init__(convert_charrefs=True)
+        self.link_rel = link_rel
+        self.parts = []
+        self.open_tags = []
+        self._dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_WITH_CONTENT:
+            self._dropping += 1
+            return
+        if self._dropping or tag not in ALLOWED_TAGS:
+            return
+        allowed = ALLOWED_ATTRIBUTES.get(tag, set())
+        kept = []
+        for name, value in attrs:
+            if name not in allowed or value is None:
+                continue
+            if name in URL_ATTRIBUTES and not _safe_url(value):
+                continue
+            kept.append(f' {name}="{escape(value, quote=True)}"')
+        if tag == 'a' and self.link_rel:
+            kept.append(f' rel="{self.link_rel}"')
+        self.parts.append(f"<{tag}{''.join(kept)}>")
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS and self.open_tags and self.open_tags[-1] == tag:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_WITH_CONTENT:
+            self._dropping = max(0, self._dropping - 1)
+            return
+        if self._dropping or tag not in self.open_tags:
+            return
+        # Close whatever was left open inside it, so the output stays well nested
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.parts.append(f"</{open_tag}>")
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if not self._dropping:
+            self.parts.append(escape(data, quote=False))
+
+    def close(self):
+        super().close()
+        while self.open_tags:
+            self.parts.append(f"</{self.open_tags.pop()}>")
+        return "".join(self.parts)
+
+
+def sanitize_html(html, link_rel=None):
+    """
+    :param html: untrusted HTML fragment
+    :param link_rel: rel added to every link, e.g. 'nofollow ugc' for comments
+    :return: the fragment with only allowlisted markup left, as Markup
+    """
+    sanitizer = _Sanitizer(link_rel)
+    sanitizer.feed(html or "")
+    return Markup(sanitizer.close())
+
+
+# ---------------------Derived fields---------------------------------
+
+def content_hash(html):
+    """
+    :return: sha256 hex digest of the raw HTML as written, to skip reprocessing unchanged content
+    """
+    return hashlib.sha256((html or "").encode('utf-8')).hexdigest()
+
+
+def excerpt(text, length=EXCERPT_LENGTH):
+    """
+    :param text: plain text
+    :return: at most 'length' characters of it, cut at a word boundary with an ellipsis when shortened
+    """
+    if len(text) <= length:
+        return text
+    cut = text[:length + 1].rsplit(" ", 1)[0] if " " in text[:length + 1] else text[:length]
+    return cut.rstrip(" ,.;:-") + "…"
+
+
+def post_fields(body):
+    """
+    Everything stored alongside a post body
+
+    :param body: the post body as written (CKEditor HTML)
+    :return: dict of Post column -> value: body_html, excerpt, word_count, reading_time (minutes) and content_hash
+    """
+    body_html = sanitize_html(body)
+    text = strip_html(body_html)
+    word_count = len(text.split())
+    return {
+        'body_html': str(body_html),
+        'excerpt': excerpt(text),
+        'word_count': word_count,
+        'reading_time': max(1, ceil(word_count / WORDS_PER_MINUTE)),
+        'content_hash': content_hash(body),
+    }
+
+
+def comment_fields(text):
+    """
+    :param text: the comment as written (CKEditor HTML)
+    :return: dict of Comment column -> value: text_html
+    """
+    return {'text_html': str(sanitize_html(text, link_rel="nofollow ugc"))}
+
+
+def process_post(post):
+    """
+    Fills the derived columns of a new or edited post, unless its body is unchanged
+    """
+    if post.content_hash != content_hash(post.body) or post.body_html is None:
+        for column, value in post_fields(post.body).items():
+            setattr(post, column, value)
+
+
+def process_comment(comment):
+    """
+    Fills the derived columns of a new comment
+    """
+    for column, value in comment_fields(comment.text).items():
+        setattr(comment, column, value)
+
+
+# ---------------------Backfill---------------------------------
+
+def backfill(batch_size=500, everything=False):
+    """
+    Processes stored posts and comments, committing after every batch of rows
+
+    :param batch_size: rows per transaction
+    :param everything: reprocess all rows (e.g. after changing the allowlist), not just the unprocessed ones
+    :return: (posts processed, comments processed)
+    """
+    def run(model, source, target, fields):
+        count = 0
+        last_id = 0
+        while True:
+            query = db.select(model.id, source).where(model.id > last_id).order_by(model.id).limit(batch_size)
+            if not everything:
+                query = query.where(target.is_(None))
+            rows = db.session.execute(query).all()
+            if not rows:
+                return count
+            db.session.execute(
+                db.update(model),
+                [{'id': row.id, **fields(row[1])} for row in rows],
+            )
+            db.session.commit()
+            count += len(rows)
+            last_id = rows[-1].id
+
+    processed = (
+        run(Post, Post.body, Post.body_html, post_fields),
+        run(Comment, Comment.text, Comment.text_html, comment_fields),
+    )
+    if any(processed):
+        # Pages show the rewritten fields: drop the cached copies and make browsers revalidate theirs
+        touch_watermark('pages_rewritten')
+        db.session.commit()
+        page_cache.invalidate_all()
+    return processed
+
+
+def init_app(app):
+    """
+    Registers the 'sanitize_html' template filter, for the rows written before the derived columns existed (until
+    'flask content backfill' has run): pages show the stored HTML when there is one and sanitize on the spot otherwise
+
+    :param app: the Flask app
+    """
+    app.add_template_filter(sanitize_html)
@@ -0,0 +1,196 @@
+from time import perf_counter
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from models import db
+import metrics
+
+
+# ---------------------Presets---------------------------------
+# Pool settings per database, any DB_* config that is set overrides them.
+# SQLite: connections are cheap and local, and never go stale.
+# Postgres: every connection is a server process, so keep few per worker, check them before use (pool_pre_ping) and
+# replace them before firewalls / pgbouncer drop idle ones (pool_recycle).
+
+PRESETS = {
+    'sqlite': {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30, 'pool_recycle': -1, 'pool_pre_ping': False},
+    'default': {'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 10, 'pool_recycle': 1800, 'pool_pre_ping': True},
+}
+
+_POOL_CONFIG = {
+    'pool_size': 'DB_POOL_SIZE',
+    'max_overflow': 'DB_MAX_OVERFLOW',
+    'pool_timeout': 'DB_POOL_TIMEOUT',
+    'pool_recycle': 'DB_POOL_RECYCLE',
+    'pool_pre_ping': 'DB_POOL_PRE_PING',
+}
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool recording how long every checkout waits (db_pool_checkout_wait_seconds), the checkouts that time out
+    and the connections in use, labelled with the pool's name (the bind key, 'default' for the main database)
+    """
+    name = 'default'
+
+    def connect(self):
+        started = perf_counter()
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            metrics.DB_POOL_TIMEOUTS.labels(self.name).inc()
+            raise
+        finally:
+            metrics.DB_POOL_CHECKOUT_WAIT.labels(self.name).observe(perf_counter() - started)
+
+    def recreate(self):
+        # engine.dispose() swaps in a fresh pool, keep the label
+        pool = super().recreate()
+        pool.name = self.name
+        return pool
+
+
+def _is_sqlite_memory(url):
+    return url.database in (None, "", ":memory:")
+
+
+def engine_options(uri, config):
+    """
+    Builds the SQLAlchemy engine options of one database from the DB_* / SQLITE_* config
+
+    :param uri: the database URI
+    :param config: the app config
+    :return: dict for SQLALCHEMY_ENGINE_OPTIONS (or a SQLALCHEMY_BINDS entry)
+    """
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    options = {}
+
+    if backend == 'sqlite':
+        # How long a writer waits for another one's lock before 'database is locked'
+        options['connect_args'] = {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000}
+        if _is_sqlite_memory(url):
+            # Flask-SQLAlchemy shares one connection (StaticPool), there is no pool to tune
+            return options
+    elif backend == 'postgresql':
+        timeouts = {
+            'statement_timeout': config['DB_STATEMENT_TIMEOUT'],
+            'idle_in_transaction_session_timeout': config['DB_IDLE_IN_TRANSACTION_TIMEOUT'],
+        }
+        options['connect_args'] = {
+            'connect_timeout': config['DB_CONNECT_TIMEOUT'],
+            # Notice a dead server or a dropped connection in about a minute instead of the OS's two hours
+            'keepalives': 1,
+            'keepalives_idle': 30,
+            'keepalives_interval': 10,
+            'keepalives_count': 3,
+        }
+        server_options = " ".join(f"-c {name}={value}" for name, value in timeouts.items() if value)
+        if server_options:
+            options['connect_args']['options'] = server_options
+
+    options['poolclass'] = TimedQueuePool
+    preset = PRESETS.get(backend, PRESETS['default'])
+    for option, key in _POOL_CONFIG.items():
+        value = config[key]
+        options[option] = preset[option] if value is None else value
+    return options
+
+
+def _sqlite_pragmas(config):
+    """
+    :return: a 'connect' listener applying SQLITE_JOURNAL_MODE and SQLITE_SYNCHRONOUS to every new connection
+    """
+    journal_mode = config['SQLITE_JOURNAL_MODE']
+    synchronous = config['SQLITE_SYNCHRONOUS']
+
+    def set_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers carry on while a write is in progress, and with synchronous=NORMAL a commit no longer
+        # waits for an fsync (a power cut can lose the last commits, but never corrupts the database)
+        if journal_mode:
+            cursor.execute(f"PRAGMA journal_mode={journal_mode}")
+        if synchronous:
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+        cursor.close()
+
+    return set_pragmas
+
+
+def _track_checkouts(engine, name):
+    """
+    Keeps db_pool_connections_in_use of the engine's pool. Pool listeners survive engine.dispose()
+    """
+    in_use = metrics.DB_POOL_CHECKED_OUT.labels(name)
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        in_use.inc()
+
+    def checkin(dbapi_connection, connection_record):
+        in_use.dec()
+
+    event.listen(engine, 'checkout', checkout)
+    event.listen(engine, 'checkin', checkin)
+
+
+def init_app(app):
+    """
+    Configures and creates the app's engines, the main one and the binds (this calls db.init_app).
+
+    Pool settings come from DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT (seconds), DB_POOL_RECYCLE (seconds, -1 for
+    never) and DB_POOL_PRE_PING, and fall back to the PRESETS of the database. Postgres connections also get
+    DB_STATEMENT_TIMEOUT and DB_IDLE_IN_TRANSACTION_TIMEOUT (milliseconds, 0 for none) and DB_CONNECT_TIMEOUT
+    (seconds). SQLite connections get SQLITE_JOURNAL_MODE (WAL), SQLITE_SYNCHRONOUS (NORMAL) and
+    SQLITE_BUSY_TIMEOUT (milliseconds). Options set in SQLALCHEMY_ENGINE_OPTIONS win over all of these.
+
+    Every gunicorn worker has its own pool: pool_size should cover the worker's threads, so a request never waits
+    for a connection. db_pool_checkout_wait_seconds on /metrics shows when it does.
+
+    :param app: the Flask app
+    """
+    for key in _POOL_CONFIG.values():
+        app.config.setdefault(key, None)
+    app.config.setdefault('DB_STATEMENT_TIMEOUT', 30000)
+    app.config.setdefault('DB_IDLE_IN_TRANSACTION_TIMEOUT', 60000)
+    app.config.setdefault('DB_CONNECT_TIMEOUT', 10)
+    app.config.setdefault('SQLITE_JOURNAL_MODE', 'WAL')
+    app.config.setdefault('SQLITE_SYNCHRONOUS', 'NORMAL')
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+    }
+    # Binds given as a plain URI (e.g. the read replicas) get the same treatment
+    binds = app.config.get('SQLALCHEMY_BINDS', {})
+    for key, uri in binds.items():
+        if isinstance(uri, str):
+            binds[key] = {'url': uri, **engine_options(uri, app.config)}
+    db.init_app(app)
+
+    set_pragmas = _sqlite_pragmas(app.config)
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if isinstance(engine.pool, TimedQueuePool):
+                engine.pool.name = key or 'default'
+                _track_checkouts(engine, engine.pool.name)
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', set_pragmas)
+
+
+def dispose_engines(app):
+    """
+    Forgets the pooled connections of the app's engines without closing them. Call in a forked child, e.g. a gunicorn
+    worker of a preloaded app: the parent's connections stay the parent's, the child opens its own
+
+    :param app: the Flask app
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
@@ -0,0 +1,57 @@
+"""
+gunicorn settings, read when gunicorn is started from the repo root: gunicorn 'app:create_app()'
+
+The app is preloaded: the master imports, builds and warms it up once (see app.warm_up), then forks the workers.
+They share that memory copy-on-write and start serving right away instead of each importing everything again.
+The hooks give every worker its own database connections and remove the metrics of the workers that exit.
+"""
+import os
+
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# More than 1 switches to the gthread worker, keep DB_POOL_SIZE at least this high
+threads = int(os.environ.get("GUNICORN_THREADS", 1))
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+
+
+def on_starting(server):
+    """
+    Runs in the master first. A memory page cache is per worker: the others would serve pages for the whole
+    PAGE_CACHE_TTL after an edit invalidated them in one
+    """
+    if server.cfg.workers > 1 and os.environ.get("PAGE_CACHE_BACKEND") == "memory":
+        raise RuntimeError("PAGE_CACHE_BACKEND=memory only works with one worker, use 'filesystem' (the default)")
+
+
+def when_ready(server):
+    """
+    Runs in the master before the first fork
+    """
+    if not server.cfg.preload_app:
+        return
+    from app import warm_up
+
+    warm_up(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    """
+    Runs in every new worker
+    """
+    if not server.cfg.preload_app:
+        return
+    from db_config import dispose_engines
+
+    # Pooled connections opened in the master must not be shared with the workers
+    dispose_engines(server.app.wsgi())
+
+
+def child_exit(server, worker):
+    """
+    Runs in the master when a worker exits
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
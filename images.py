@@ -0,0 +1,525 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urljoin, urlparse, urlsplit
+import hashlib
+import http.client
+import io
+import ipaddress
+import json
+import os
+import re
+import socket
+import ssl
+import tempfile
+import time
+
+import click
+from flask import abort, current_app, redirect, send_from_directory, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from PIL import Image, ImageOps
+
+from assets import asset_url
+from models import db, Post
+
+
+# ---------------------Variants---------------------------------
+# Every source image (a file under static/ or a post's img_url) is resized to IMAGE_WIDTHS in each of IMAGE_FORMATS.
+# Variant files are named after the sha256 of the source bytes, e.g. '3f2a...c1-960.webp', so their URLs never change
+# meaning and can be cached by browsers forever.
+
+FORMATS = {
+    # format: (Pillow format name, file extension, mime type, save options)
+    'avif': ('AVIF', 'avif', 'image/avif', {'quality': 60}),
+    'webp': ('WEBP', 'webp', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+EXTENSIONS = {extension: name for name, (_, extension, _, _) in FORMATS.items()}
+
+VARIANT_NAME = re.compile(r'^[0-9a-f]{40}-\d+\.(avif|webp|jpg)$')
+
+# One year, the longest max-age caches honour
+IMMUTABLE_MAX_AGE = 31536000
+
+
+def available_formats(formats):
+    """
+    :param formats: configured format names, best first
+    :return: the ones Pillow can encode here. AVIF needs a Pillow build or plugin with an AVIF encoder
+    """
+    Image.init()
+    return [name for name in formats if name in FORMATS and FORMATS[name][0] in Image.SAVE]
+
+
+# ---------------------Fetching remote sources---------------------------------
+# A post's img_url is fetched by the server, so it must not reach the host's own network: every host is resolved,
+# refused unless all its addresses are public, and connected to at the address that was checked (a second DNS lookup
+# could answer differently). Redirects are followed only after the same checks.
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+def public_address(host, port):
+    """
+    :return: an address of host to connect to
+    :raises ValueError: if host resolves to a private, loopback, link-local or otherwise non-public address
+    :raises OSError: if host cannot be resolved
+    """
+    addresses = [info[4][0] for info in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"{host} resolves to the non-public address {address}")
+    return addresses[0]
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection to an already resolved address, the Host header still names the host
+    """
+
+    def __init__(self, host, address, **kwargs):
+        super().__init__(host, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    """
+    HTTPS connection to an already resolved address, the certificate is checked against the host name
+    """
+
+    def __init__(self, host, address, **kwargs):
+        self.ssl_context = ssl.create_default_context()
+        super().__init__(host, context=self.ssl_context, **kwargs)
+        self.address = address
+
+    def connect(self):
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        self.sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+
+def fetch_image(url, timeout, max_bytes, max_redirects=3, allowed_hosts=()):
+    """
+    Downloads a remote image from a public host
+
+    :param allowed_hosts: if not empty, the only hosts (redirect targets included) images are fetched from
+    :return: the image bytes
+    :raises OSError: if the host cannot be reached or does not answer 200
+    :raises ValueError: if the URL or a redirect targets a refused host, or the response is not an image or is
+            larger than max_bytes
+    """
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Not an http(s) URL: {url}")
+        if allowed_hosts and parts.hostname not in allowed_hosts:
+            raise ValueError(f"{parts.hostname} is not in IMAGE_ALLOWED_HOSTS")
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        connection_class = _PinnedHTTPSConnection if parts.scheme == 'https' else _PinnedHTTPConnection
+        connection = connection_class(parts.hostname, public_address(parts.hostname, port), port=port,
+                                      timeout=timeout)
+        try:
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            connection.request('GET', path, headers={'User-Agent': 'blog-image-pipeline'})
+            response = connection.getresponse()
+            if response.status in REDIRECT_STATUSES and response.getheader('Location'):
+                url = urljoin(url, response.getheader('Location'))
+                continue
+            if response.status != 200:
+                raise OSError(f"{url} answered {response.status}")
+            content_type = response.getheader('Content-Type', '')
+            if not content_type.startswith('image/'):
+                raise ValueError(f"{url} is not an image ({content_type})")
+            data = response.read(max_bytes + 1)
+        finally:
+            connection.close()
+        if len(data) > max_bytes:
+            raise ValueError(f"{url} is larger than {max_bytes} bytes")
+        return data
+    raise ValueError(f"More than {max_redirects} redirects fetching {url}")
+
+
+def source_id_for(source):
+    """
+    :param source: a path under static/ ('assets/img/home-bg.jpg') or an http(s) URL
+    :return: the id records and signed URLs use, 'static:<path>' or the URL itself
+    """
+    if urlparse(source).scheme in ('http', 'https'):
+        return source
+    return 'static:' + source.lstrip('/')
+
+
+class ImagePipeline:
+    """
+    Builds, stores and looks up the resized variants of source images.
+
+    Files live under IMAGE_CACHE_DIR: 'variants/<2 chars>/<name>' for the images and 'sources/<sha256 of source id>.json'
+    for what was built from each source. Everything is written to a temp file and renamed, so several workers (or a
+    'flask images build' run) can share the directory.
+
+    Requests never build: the on-demand route queues the build on a background thread of the process (build_later)
+    and serves the original image until the variants exist.
+    """
+
+    # Sources whose last build failed, remembered so they are not fetched again on every page view
+    MAX_FAILED = 1024
+
+    def __init__(self, app):
+        self.app = app
+        self.directory = app.config['IMAGE_CACHE_DIR']
+        self.widths = sorted(app.config['IMAGE_WIDTHS'])
+        self.formats = available_formats(app.config['IMAGE_FORMATS'])
+        if 'jpeg' not in self.formats:
+            # Every browser can show the JPEG fallback in <img>
+            self.formats.append('jpeg')
+        self._records = {}
+        self._lock = Lock()
+        # source id -> Future of its queued or running background build, removed when the build finishes
+        self._pending = {}
+        # source id -> monotonic time of its last failed background build
+        self._failed = OrderedDict()
+        self._executor = None
+        self._executor_pid = None
+
+    # ---Records---
+
+    def _record_path(self, source_id):
+        return os.path.join(self.directory, 'sources', hashlib.sha256(source_id.encode()).hexdigest() + '.json')
+
+    def variant_path(self, name):
+        return os.path.join(self.directory, 'variants', name[:2], name)
+
+    def record(self, source_id):
+        """
+        :return: the build record of source_id ({'digest', 'width', 'height', 'widths', 'formats'}) or None if its
+                 variants were not built yet, or a static source changed since
+        """
+        record = self._records.get(source_id)
+        if record is None:
+            try:
+                with open(self._record_path(source_id)) as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self._records[source_id] = record
+        if source_id.startswith('static:') and record.get('mtime') != self._static_mtime(source_id):
+            self._records.pop(source_id, None)
+            return None
+        return record
+
+    def _static_path(self, source_id):
+        relative_path = source_id[len('static:'):]
+        static_folder = os.path.realpath(self.app.static_folder)
+        path = os.path.realpath(os.path.join(static_folder, relative_path))
+        if not path.startswith(static_folder + os.sep):
+            raise ValueError(f"Not a static file: {relative_path}")
+        return path
+
+    def _static_mtime(self, source_id):
+        try:
+            return os.stat(self._static_path(source_id)).st_mtime_ns
+        except (OSError, ValueError):
+            return None
+
+    # ---Building---
+
+    def load_source(self, source_id):
+        """
+        :return: the source image bytes
+        :raises OSError: if the file cannot be read or the URL cannot be fetched
+        :raises ValueError: if the URL is refused (see fetch_image), or the remote response is not an image or is
+                larger than IMAGE_MAX_SOURCE_BYTES
+        """
+        if source_id.startswith('static:'):
+            with open(self._static_path(source_id), 'rb') as f:
+                return f.read()
+
+        config = self.app.config
+        return fetch_image(source_id, config['IMAGE_FETCH_TIMEOUT'], config['IMAGE_MAX_SOURCE_BYTES'],
+                           max_redirects=config['IMAGE_FETCH_MAX_REDIRECTS'],
+                           allowed_hosts=config['IMAGE_ALLOWED_HOSTS'])
+
+    def build(self, source_id, force=False):
+        """
+        Creates every variant of source_id that is missing, then records it. Runs in 'flask images build' or on the
+        background build threads, which never build one source twice at the same time
+
+        :return: the build record
+        """
+        record = None if force else self.record(source_id)
+        if record is not None:
+            return record
+
+        data = self.load_source(source_id)
+        digest = hashlib.sha256(data).hexdigest()[:40]
+        with Image.open(io.BytesIO(data)) as original:
+            image = ImageOps.exif_transpose(original)
+            image.load()
+
+        # Never upscale: widths above the original collapse to the original width
+        widths = sorted({min(width, image.width) for width in self.widths})
+        for width in widths:
+            resized = None
+            for format_name in self.formats:
+                name = f"{digest}-{width}.{FORMATS[format_name][1]}"
+                if os.path.exists(self.variant_path(name)):
+                    continue
+                if resized is None:
+                    height = max(1, round(image.height * width / image.width))
+                    resized = image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+                self._write(self.variant_path(name), self._encode(resized, format_name))
+
+        record = {'digest': digest, 'width': image.width, 'height': image.height,
+                  'widths': widths, 'formats': list(self.formats)}
+        if source_id.startswith('static:'):
+            record['mtime'] = self._static_mtime(source_id)
+        self._write(self._record_path(source_id), json.dumps(record).encode())
+        self._records[source_id] = record
+        return record
+
+    # ---Background builds---
+
+    def build_later(self, source_id):
+        """
+        Queues a build of source_id on this process' build threads (IMAGE_BUILD_WORKERS), unless it is queued already,
+        its last build failed less than IMAGE_BUILD_RETRY_SECONDS ago or IMAGE_BUILD_QUEUE_SIZE builds are waiting
+
+        :return: the Future of the build, or None if nothing was queued
+        """
+        config = self.app.config
+        with self._lock:
+            future = self._pending.get(source_id)
+            if future is not None:
+                return future
+            failed_at = self._failed.get(source_id)
+            if failed_at is not None and time.monotonic() - failed_at < config['IMAGE_BUILD_RETRY_SECONDS']:
+                return None
+            if len(self._pending) >= config['IMAGE_BUILD_QUEUE_SIZE']:
+                return None
+            if self._executor is None or self._executor_pid != os.getpid():
+                # Threads do not survive a fork, a preloaded gunicorn worker starts its own
+                self._executor = ThreadPoolExecutor(max_workers=config['IMAGE_BUILD_WORKERS'],
+                                                    thread_name_prefix="image-build")
+                self._executor_pid = os.getpid()
+            future = self._executor.submit(self._build_in_background, source_id)
+            self._pending[source_id] = future
+        future.add_done_callback(lambda _: self._build_finished(source_id))
+        return future
+
+    def _build_in_background(self, source_id):
+        try:
+            return self.build(source_id)
+        except Exception as e:
+            self.app.logger.warning(f"Could not build image variants of {source_id}: {e}")
+            with self._lock:
+                self._failed[source_id] = time.monotonic()
+                self._failed.move_to_end(source_id)
+                while len(self._failed) > self.MAX_FAILED:
+                    self._failed.popitem(last=False)
+            return None
+
+    def _build_finished(self, source_id):
+        with self._lock:
+            self._pending.pop(source_id, None)
+
+    @staticmethod
+    def _encode(image, format_name):
+        pillow_format, _, _, options = FORMATS[format_name]
+        if format_name == 'jpeg' and image.mode != 'RGB':
+            # JPEG has no alpha channel, flatten transparent images onto white
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+            image = background
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        output = io.BytesIO()
+        image.save(output, pillow_format, **options)
+        return output.getvalue()
+
+    @staticmethod
+    def _write(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    # ---URLs---
+
+    def signed_source(self, source_id):
+        """
+        :return: a token naming source_id that only this app can create, so the on-demand route cannot be used to fetch
+                 arbitrary URLs
+        """
+        return URLSafeSerializer(self.app.secret_key, salt='images').dumps(source_id)
+
+    def unsign_source(self, token):
+        return URLSafeSerializer(self.app.secret_key, salt='images').loads(token)
+
+    def responsive(self, source):
+        """
+        :param source: a path under static/ or an http(s) URL
+        :return: dict with 'src' (fallback URL for <img>), 'srcset' (JPEG srcset) and 'sources' (list of
+                 (mime type, srcset) for <picture>, best format first)
+        """
+        source_id = source_id_for(source)
+        record = self.record(source_id)
+        if record is not None:
+            # Built already: link straight to the content-addressed files
+            def url(width, format_name):
+                return url_for('image_variant', name=f"{record['digest']}-{width}.{FORMATS[format_name][1]}")
+            widths, formats = record['widths'], record['formats']
+            src = url(widths[-1], 'jpeg')
+        else:
+            # Not built yet: the on-demand route builds it on the first request
+            token = self.signed_source(source_id)
+
+            def url(width, format_name):
+                return url_for('image_on_demand', token=token, width=width, extension=FORMATS[format_name][1])
+            widths, formats = self.widths, self.formats
+            src = source if source_id == source else asset_url(source.lstrip('/'))
+
+        def srcset(format_name):
+            return ", ".join(f"{url(width, format_name)} {width}w" for width in widths)
+
+        return {
+            'src': src,
+            'srcset': srcset('jpeg'),
+            'sources': [(FORMATS[name][2], srcset(name)) for name in formats if name != 'jpeg'],
+        }
+
+
+def current_pipeline():
+    return current_app.extensions['images']
+
+
+def responsive_image(source):
+    """
+    Template helper, see ImagePipeline.responsive. Returns None for an empty source
+    """
+    if not source:
+        return None
+    return current_pipeline().responsive(source)
+
+
+def static_sources(app, folder='assets/img'):
+    """
+    :return: the static images under folder, as paths relative to static/
+    """
+    directory = os.path.join(app.static_folder, folder)
+    return sorted(
+        f"{folder}/{name}" for name in os.listdir(directory)
+        if name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp'))
+    )
+
+
+def init_app(app):
+    """
+    Sets up the image pipeline from IMAGE_WIDTHS, IMAGE_FORMATS, IMAGE_CACHE_DIR, IMAGE_FETCH_TIMEOUT,
+    IMAGE_MAX_SOURCE_BYTES, IMAGE_FETCH_MAX_REDIRECTS, IMAGE_ALLOWED_HOSTS (empty: any public host) and the
+    IMAGE_BUILD_* settings of the background builds, and registers its routes, the 'responsive_image' template global
+    and 'flask images build'
+
+    :param app: the Flask app
+    :return: the ImagePipeline
+    """
+    app.config.setdefault('IMAGE_WIDTHS', [480, 960, 1440, 1920])
+    app.config.setdefault('IMAGE_FORMATS', ['avif', 'webp', 'jpeg'])
+    app.config.setdefault('IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'images'))
+    app.config.setdefault('IMAGE_FETCH_TIMEOUT', 10)
+    app.config.setdefault('IMAGE_MAX_SOURCE_BYTES', 20 * 1024 * 1024)
+    app.config.setdefault('IMAGE_FETCH_MAX_REDIRECTS', 3)
+    app.config.setdefault('IMAGE_ALLOWED_HOSTS', [])
+    app.config.setdefault('IMAGE_BUILD_WORKERS', 1)
+    app.config.setdefault('IMAGE_BUILD_QUEUE_SIZE', 100)
+    app.config.setdefault('IMAGE_BUILD_RETRY_SECONDS', 600)
+
+    pipeline = ImagePipeline(app)
+    app.extensions['images'] = pipeline
+    app.add_template_global(responsive_image)
+
+    @app.route('/img/<name>')
+    def image_variant(name):
+        """
+        Serves a built variant. The name is derived from the image content, so it can be cached forever
+        """
+        if not VARIANT_NAME.match(name):
+            abort(404)
+        response = send_from_directory(os.path.dirname(pipeline.variant_path(name)), name,
+                                       max_age=IMMUTABLE_MAX_AGE, conditional=True)
+        response.cache_control.immutable = True
+        return response
+
+    @app.route('/img/src/<token>/<int:width>.<extension>')
+    def image_on_demand(token, width, extension):
+        """
+        Redirects to the immutable variant once it is built. Until then, queues the build in the background and
+        redirects to the original image
+        """
+        if extension not in EXTENSIONS:
+            abort(404)
+        try:
+            source_id = pipeline.unsign_source(token)
+        except BadSignature:
+            abort(404)
+        record = pipeline.record(source_id)
+        if record is None:
+            pipeline.build_later(source_id)
+            if source_id.startswith('static:'):
+                response = redirect(asset_url(source_id[len('static:'):]))
+            else:
+                response = redirect(source_id)
+            # The variant may exist on the next request
+            response.cache_control.no_cache = True
+            return response
+
+        format_name = EXTENSIONS[extension]
+        if format_name not in record['formats']:
+            format_name = 'jpeg'
+        # The largest built width not above the requested one (the smallest if none is)
+        built_width = max((w for w in record['widths'] if w <= width), default=record['widths'][0])
+        name = f"{record['digest']}-{built_width}.{FORMATS[format_name][1]}"
+        response = redirect(url_for('image_variant', name=name))
+        # The post's img_url can change, so only cache the redirect for a day
+        response.cache_control.public = True
+        response.cache_control.max_age = 86400
+        return response
+
+    @app.cli.group('images')
+    def images_group():
+        """
+        Responsive image variants
+        """
+
+    @images_group.command('build')
+    @click.option('--force', is_flag=True, help="Rebuild sources that were built already.")
+    @click.option('--skip-posts', is_flag=True, help="Only build the static images, do not fetch post images.")
+    def build_command(force, skip_posts):
+        """
+        Builds the variants of every static background and every post's img_url
+        """
+        sources = [source_id_for(path) for path in static_sources(app)]
+        if not skip_posts:
+            img_urls = db.session.execute(db.select(Post.img_url).distinct()).scalars()
+            sources += [source_id_for(url) for url in img_urls if url]
+
+        built = failed = 0
+        for source_id in sources:
+            try:
+                record = pipeline.build(source_id, force=force)
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                failed += 1
+                print(f"FAILED {source_id}: {e}")
+            else:
+                built += 1
+                print(f"{source_id}: {record['width']}x{record['height']} -> "
+                      f"{', '.join(map(str, record['widths']))} ({', '.join(record['formats'])})")
+        print(f"Built {built} images, {failed} failed")
+
+    return pipeline
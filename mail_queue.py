@@ -0,0 +1,270 @@
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from threading import Event, Lock, Thread
+import smtplib
+
+import click
+from flask import current_app
+
+import metrics
+from models import db, OutboundEmail
+
+
+SMTP_SETTINGS = {
+    'gmail': ('smtp.gmail.com', 587),
+    'yahoo': ('smtp.mail.yahoo.com', 587),
+    'outlook': ('smtp.office365.com', 587)
+    # Add more services as needed
+}
+
+
+def enqueue_email(subject, html, reply_to):
+    """
+    Stores a message in the outbound_emails table and wakes up this process' delivery worker.
+    The caller returns right away, the SMTP work happens in the background.
+
+    :param subject: the email subject
+    :param html: the rendered HTML body
+    :param reply_to: address replies should go to (the contact form sender)
+    :return: the queued OutboundEmail
+    """
+    queued = OutboundEmail(subject=subject, html=html, reply_to=reply_to)
+    db.session.add(queued)
+    db.session.commit()
+
+    worker = current_app.extensions['mail_queue']
+    if current_app.config['MAIL_QUEUE_WORKER'] == 'thread':
+        worker.start()
+    worker.wake()
+    return queued
+
+
+def smtp_server(app):
+    """
+    :return: (host, port) from MAIL_SMTP_HOST / MAIL_SMTP_PORT, else from the MAIL_SERVICE preset
+    :raises ValueError: if MAIL_SERVICE is not a supported service
+    """
+    if app.config['MAIL_SMTP_HOST']:
+        return app.config['MAIL_SMTP_HOST'], app.config['MAIL_SMTP_PORT']
+    service = app.config['MAIL_SERVICE']
+    if service not in SMTP_SETTINGS:
+        raise ValueError("Unsupported email service")
+    return SMTP_SETTINGS[service]
+
+
+def build_message(app, queued):
+    """
+    :param queued: an OutboundEmail
+    :return: the MIMEText to send
+    """
+    msg = MIMEText(queued.html, 'html')
+    msg['From'] = app.config['MAIL_ADDRESS']
+    msg['To'] = app.config['MAIL_ADDRESS']
+    msg['Subject'] = queued.subject
+    msg['Reply-To'] = queued.reply_to
+    return msg
+
+
+class MailWorker:
+    """
+    Delivers queued emails in batches over one authenticated SMTP connection per batch, retrying failures with
+    exponential backoff.
+
+    Rows are claimed with a conditional UPDATE that also leases them (next_attempt_at moves into the future), so several
+    workers (one thread per gunicorn worker, or 'flask mail-worker' processes) can share the table, and rows claimed by
+    a worker that died are picked up again once the lease expires.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._wakeup = Event()
+        self._stopping = Event()
+        self._thread = None
+        self._lock = Lock()
+
+    # ---Thread control---
+
+    def start(self):
+        """
+        Starts the background delivery thread of this process, if it is not running yet
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = Thread(target=self.run, name="mail-queue-worker", daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        """
+        Delivery loop: drains every due message, then sleeps until woken up or the poll interval elapses
+        """
+        poll_interval = self.app.config['MAIL_QUEUE_POLL_INTERVAL']
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            try:
+                while self.process_batch() and not self._stopping.is_set():
+                    pass
+            except Exception:
+                self.app.logger.exception("Mail queue worker failed, retrying after the poll interval")
+            self._wakeup.wait(poll_interval)
+
+    # ---Delivery---
+
+    def claim_batch(self):
+        """
+        :return: list of OutboundEmail rows due for delivery that this worker now holds the lease on
+        """
+        config = self.app.config
+        now = datetime.utcnow()
+        lease_until = now + timedelta(seconds=config['MAIL_QUEUE_LEASE_SECONDS'])
+        due_ids = db.session.execute(
+            db.select(OutboundEmail.id)
+            .where(OutboundEmail.status.in_(('pending', 'sending')), OutboundEmail.next_attempt_at <= now)
+            .order_by(OutboundEmail.id)
+            .limit(config['MAIL_QUEUE_BATCH_SIZE'])
+        ).scalars().all()
+
+        claimed_ids = []
+        for email_id in due_ids:
+            result = db.session.execute(
+                db.update(OutboundEmail)
+                .where(OutboundEmail.id == email_id, OutboundEmail.next_attempt_at <= now,
+                       OutboundEmail.status.in_(('pending', 'sending')))
+                .values(status='sending', next_attempt_at=lease_until)
+            )
+            if result.rowcount == 1:
+                claimed_ids.append(email_id)
+        db.session.commit()
+
+        if not claimed_ids:
+            return []
+        return db.session.execute(
+            db.select(OutboundEmail).where(OutboundEmail.id.in_(claimed_ids)).order_by(OutboundEmail.id)
+        ).scalars().all()
+
+    def process_batch(self):
+        """
+        Claims and sends one batch
+
+        :return: the number of messages claimed, 0 when the queue has nothing due
+        """
+        with self.app.app_context():
+            batch = self.claim_batch()
+            if not batch:
+                return 0
+            try:
+                with metrics.smtp_timer():
+                    self.deliver(batch)
+            except Exception as e:
+                # Connecting or logging in failed, the connection dropped, or something unexpected went wrong: retry
+                # what was not sent, counting the attempt so that MAIL_QUEUE_MAX_ATTEMPTS ends the retries
+                if not isinstance(e, (smtplib.SMTPException, OSError)):
+                    self.app.logger.exception("Unexpected error delivering a batch of emails")
+                for queued in batch:
+                    if queued.status == 'sending':
+                        self.schedule_retry(queued, e)
+            db.session.commit()
+            return len(batch)
+
+    def deliver(self, batch):
+        """
+        Sends every message of batch over a single SMTP connection, recording each message's outcome
+        """
+        config = self.app.config
+        host, port = smtp_server(self.app)
+        with smtplib.SMTP(host, port, timeout=config['MAIL_SMTP_TIMEOUT']) as connection:
+            if config['MAIL_USE_TLS']:
+                connection.starttls()
+            if config['MAIL_APP_PW']:
+                connection.login(config['MAIL_ADDRESS'], config['MAIL_APP_PW'])
+            for queued in batch:
+                try:
+                    msg = build_message(self.app, queued)
+                    connection.sendmail(to_addrs=config['MAIL_ADDRESS'], from_addr=queued.reply_to,
+                                        msg=msg.as_string())
+                except smtplib.SMTPServerDisconnected:
+                    # The connection is gone, process_batch retries the rest of the batch
+                    raise
+                except smtplib.SMTPException as e:
+                    self.schedule_retry(queued, e)
+                except OSError:
+                    # Socket error, same as a disconnection (SMTPException is an OSError, hence the order)
+                    raise
+                except Exception as e:
+                    # Only this message failed, e.g. it could not be built, go on with the others
+                    self.app.logger.exception(f"Unexpected error sending email {queued.id}")
+                    self.schedule_retry(queued, e)
+                else:
+                    queued.status = 'sent'
+                    queued.sent_at = datetime.utcnow()
+                    queued.last_error = None
+
+    def schedule_retry(self, queued, error):
+        """
+        Puts a failed message back in the queue after an exponential backoff, or marks it failed after
+        MAIL_QUEUE_MAX_ATTEMPTS attempts
+        """
+        config = self.app.config
+        queued.attempts += 1
+        queued.last_error = str(error)
+        if queued.attempts >= config['MAIL_QUEUE_MAX_ATTEMPTS']:
+            queued.status = 'failed'
+            self.app.logger.error(f"Giving up on email {queued.id} after {queued.attempts} attempts: {error}")
+            return
+        delay = min(config['MAIL_QUEUE_BACKOFF_SECONDS'] * 2 ** (queued.attempts - 1),
+                    config['MAIL_QUEUE_MAX_BACKOFF_SECONDS'])
+        queued.status = 'pending'
+        queued.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        self.app.logger.warning(f"Error sending email {queued.id}, retrying in {delay}s: {error}")
+
+
+def init_app(app):
+    """
+    Sets up the mail queue.
+
+    MAIL_QUEUE_WORKER='thread' (default) delivers from a daemon thread started in each process on its first enqueue.
+    Set it to 'none' to only enqueue from the web app and run the delivery loop with 'flask mail-worker' instead.
+
+    :param app: the Flask app
+    :return: the MailWorker
+    """
+    app.config.setdefault('MAIL_ADDRESS', None)
+    app.config.setdefault('MAIL_APP_PW', None)
+    app.config.setdefault('MAIL_SERVICE', 'gmail')
+    app.config.setdefault('MAIL_SMTP_HOST', None)
+    app.config.setdefault('MAIL_SMTP_PORT', 587)
+    app.config.setdefault('MAIL_USE_TLS', True)
+    app.config.setdefault('MAIL_SMTP_TIMEOUT', 30)
+    app.config.setdefault('MAIL_QUEUE_WORKER', 'thread')
+    app.config.setdefault('MAIL_QUEUE_BATCH_SIZE', 20)
+    app.config.setdefault('MAIL_QUEUE_POLL_INTERVAL', 30)
+    app.config.setdefault('MAIL_QUEUE_LEASE_SECONDS', 300)
+    app.config.setdefault('MAIL_QUEUE_MAX_ATTEMPTS', 6)
+    app.config.setdefault('MAIL_QUEUE_BACKOFF_SECONDS', 30)
+    app.config.setdefault('MAIL_QUEUE_MAX_BACKOFF_SECONDS', 3600)
+
+    worker = MailWorker(app)
+    app.extensions['mail_queue'] = worker
+
+    @app.cli.command('mail-worker')
+    @click.option('--once', is_flag=True, help="Deliver everything that is due, then exit.")
+    def mail_worker_command(once):
+        """
+        Runs the outbound email delivery loop in the foreground
+        """
+        if once:
+            while worker.process_batch():
+                pass
+        else:
+            worker.run()
+
+    return worker
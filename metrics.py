@@ -0,0 +1,242 @@
+from contextlib import contextmanager
+from time import perf_counter, strftime
+import cProfile
+import os
+import random
+
+from flask import Response, abort, before_render_template, g, has_request_context, request, template_rendered
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import generate_latest
+from prometheus_client import multiprocess
+
+import query_counter
+
+try:
+    import pyinstrument
+except ImportError:  # Optional, PROFILER_BACKEND='pyinstrument' needs it
+    pyinstrument = None
+
+
+# ---------------------Metrics---------------------------------
+# Process-wide, so they are created once however many apps are built. Under gunicorn set PROMETHEUS_MULTIPROC_DIR
+# so /metrics reports every worker, not just the one that answers the scrape.
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', "Time from the start of a request until its last byte was sent",
+    ['endpoint', 'method', 'status'],
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_db_queries', "SQL statements issued per request", ['endpoint'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+REQUEST_DB_TIME = Histogram('http_request_db_seconds', "Time spent in SQL statements per request", ['endpoint'])
+DB_QUERY_LATENCY = Histogram('db_query_duration_seconds', "Time of each SQL statement", ['endpoint'])
+TEMPLATE_RENDER_TIME = Histogram('template_render_seconds', "Time to render a template", ['template'])
+SMTP_SEND_TIME = Histogram('smtp_send_seconds', "Time to deliver one batch of queued emails over SMTP", ['outcome'])
+PROFILES_TAKEN = Counter('profiler_profiles_total', "Requests profiled", ['endpoint'])
+
+# Connection pools, recorded by db_config.TimedQueuePool. A steady non-zero checkout wait means the pool is smaller
+# than the number of threads using it
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds', "Time to get a connection from the pool, including connecting", ['pool'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+DB_POOL_TIMEOUTS = Counter('db_pool_checkout_timeouts_total', "Checkouts that gave up after pool_timeout", ['pool'])
+DB_POOL_CHECKED_OUT = Gauge(
+    'db_pool_connections_in_use', "Connections currently checked out of the pool", ['pool'], multiprocess_mode='livesum'
+)
+
+# Rate limiter decisions, recorded by rate_limit.RateLimiter: 'bucket' is the one that was empty ('ip', 'ip_account'
+# or 'account', outcome 'rejected') or unavailable (outcome 'error'), 'all' for allowed requests
+RATE_LIMIT_DECISIONS = Counter(
+    'rate_limit_decisions_total', "Requests checked by the rate limiter", ['limit', 'bucket', 'outcome']
+)
+# Requests let through unchecked because the limiter's backend failed: any increase means the limits are off
+RATE_LIMIT_FAIL_OPEN = Counter(
+    'rate_limit_fail_open_total', "Requests allowed because the rate limiter backend was unavailable", ['limit']
+)
+
+
+
+def _local_request():
+    # From the loopback interface and not relayed by a reverse proxy on this host (which adds a forwarding header)
+    forwarded = any(name in request.headers for name in ('X-Forwarded-For', 'X-Real-Ip', 'Forwarded'))
+    return request.remote_addr in ('127.0.0.1', '::1') and not forwarded
+
+
+def _endpoint():
+    # The rule's endpoint, not the path, so metrics have one series per view instead of one per URL
+    return request.endpoint if request.url_rule is not None else 'unmatched'
+
+
+# ---------------------SQLAlchemy---------------------------------
+# Statements are counted and timed by query_counter, which calls this after each one
+
+def _observe_query(elapsed):
+    if has_request_context() and 'request_metrics' in g:
+        DB_QUERY_LATENCY.labels(g.request_metrics['endpoint']).observe(elapsed)
+    else:
+        DB_QUERY_LATENCY.labels('none').observe(elapsed)
+
+
+# ---------------------Templates---------------------------------
+
+def _before_render(app, template, context, **extra):
+    if has_request_context():
+        g.setdefault('template_render_start', {})[template.name] = perf_counter()
+
+
+def _rendered(app, template, context, **extra):
+    if has_request_context():
+        started = g.get('template_render_start', {}).pop(template.name, None)
+        if started is not None:
+            TEMPLATE_RENDER_TIME.labels(template.name or 'string').observe(perf_counter() - started)
+
+
+# ---------------------SMTP---------------------------------
+
+@contextmanager
+def smtp_timer():
+    """
+    Times the block as one SMTP delivery, labelled 'error' if it raises
+    """
+    started = perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        SMTP_SEND_TIME.labels(outcome).observe(perf_counter() - started)
+
+
+# ---------------------Profiler---------------------------------
+
+class _RequestProfiler:
+    """
+    Profiles one request with cProfile or pyinstrument and writes the result to PROFILER_DIR
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        if backend == 'pyinstrument':
+            self._profiler = pyinstrument.Profiler()
+            self._profiler.start()
+        else:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    def stop(self, directory, endpoint):
+        """
+        :return: path of the written profile, a pstats file (open with snakeviz / python -m pstats) or an HTML report
+        """
+        os.makedirs(directory, exist_ok=True)
+        name = f"{strftime('%Y%m%d-%H%M%S')}-{endpoint}-{os.getpid()}-{random.getrandbits(24):06x}"
+        if self.backend == 'pyinstrument':
+            self._profiler.stop()
+            path = os.path.join(directory, name + '.html')
+            with open(path, 'w') as f:
+                f.write(self._profiler.output_html())
+        else:
+            self._profiler.disable()
+            path = os.path.join(directory, name + '.prof')
+            self._profiler.dump_stats(path)
+        return path
+
+
+def _should_profile(app):
+    """
+    A request is profiled when PROFILER_ENABLED is on and either it sends 'X-Profile: <PROFILER_TOKEN>' or it is
+    picked at random with probability PROFILER_SAMPLE_RATE
+    """
+    config = app.config
+    if not config['PROFILER_ENABLED']:
+        return False
+    token = config['PROFILER_TOKEN']
+    if token and request.headers.get('X-Profile') == token:
+        return True
+    return config['PROFILER_SAMPLE_RATE'] > 0 and random.random() < config['PROFILER_SAMPLE_RATE']
+
+
+def init_app(app):
+    """
+    Instruments the app: per-route latency, SQL statement count and time, template render time and SMTP time,
+    served in the Prometheus text format on METRICS_PATH (default /metrics, disable with METRICS_ENABLED=False).
+    If METRICS_TOKEN is set, scrapes must send 'Authorization: Bearer <METRICS_TOKEN>'. Without it only scrapes made
+    directly from this host are answered.
+
+    Also sets up the opt-in request profiler, see _should_profile. PROFILER_BACKEND is 'cprofile' (default) or
+    'pyinstrument' (needs pyinstrument installed), profiles are written to PROFILER_DIR.
+
+    :param app: the Flask app
+    """
+    app.config.setdefault('METRICS_ENABLED', True)
+    app.config.setdefault('METRICS_PATH', '/metrics')
+    app.config.setdefault('METRICS_TOKEN', None)
+    app.config.setdefault('PROFILER_ENABLED', False)
+    app.config.setdefault('PROFILER_SAMPLE_RATE', 0.0)
+    app.config.setdefault('PROFILER_TOKEN', None)
+    app.config.setdefault('PROFILER_BACKEND', 'cprofile')
+    app.config.setdefault('PROFILER_DIR', os.path.join(app.instance_path, 'profiles'))
+
+    if app.config['PROFILER_BACKEND'] == 'pyinstrument' and pyinstrument is None:
+        raise RuntimeError("PROFILER_BACKEND='pyinstrument' needs the pyinstrument package installed")
+
+    query_counter.observe_queries(_observe_query)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+    @app.before_request
+    def start_request_metrics():
+        g.request_metrics = {'start': perf_counter(), 'endpoint': _endpoint()}
+        # query_counter's totals for the request start here, whatever ran before (e.g. in other before_request)
+        g.request_metrics['queries'] = g.get('query_count', 0)
+        g.request_metrics['db_time'] = g.get('query_time', 0.0)
+        if _should_profile(app):
+            g.request_profiler = _RequestProfiler(app.config['PROFILER_BACKEND'])
+
+    @app.after_request
+    def record_request_metrics(response):
+        request_metrics = g.get('request_metrics')
+        if request_metrics is None:
+            return response
+        profiler = g.pop('request_profiler', None)
+        method, status = request.method, str(response.status_code)
+        # g outlives the request context, the statements of a streamed body are still counted in it
+        request_globals = g._get_current_object()
+
+        def record():
+            # Runs once the body has been sent, so streamed pages are measured until their last byte
+            endpoint = request_metrics['endpoint']
+            REQUEST_LATENCY.labels(endpoint, method, status).observe(perf_counter() - request_metrics['start'])
+            queries = request_globals.get('query_count', 0) - request_metrics['queries']
+            db_time = request_globals.get('query_time', 0.0) - request_metrics['db_time']
+            REQUEST_QUERIES.labels(endpoint).observe(queries)
+            REQUEST_DB_TIME.labels(endpoint).observe(db_time)
+            if profiler is not None:
+                path = profiler.stop(app.config['PROFILER_DIR'], endpoint)
+                PROFILES_TAKEN.labels(endpoint).inc()
+                app.logger.info(f"Profiled {method} {endpoint}: {path}")
+
+        response.call_on_close(record)
+        return response
+
+    if app.config['METRICS_ENABLED']:
+        @app.route(app.config['METRICS_PATH'])
+        def metrics():
+            """
+            Prometheus scrape endpoint
+            """
+            token = app.config['METRICS_TOKEN']
+            if token:
+                if request.headers.get('Authorization') != f"Bearer {token}":
+                    abort(403)
+            elif not _local_request():
+                abort(403)
+            if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+                registry = CollectorRegistry()
+                multiprocess.MultiProcessCollector(registry)
+            else:
+                registry = REGISTRY
+            return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,31 @@
+"""add blog_posts.updated_at and blog_posts.comments_updated_at
+
+Revision ID: 0002_post_modification_times
+Revises: 0001_baseline
+Create Date: 2026-10-18 15:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_post_modification_times'
+down_revision = '0001_baseline'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows get the migration time, so their first conditional GET after upgrading is a full response
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=False, server_default=sa.func.now()))
+        batch_op.add_column(
+            sa.Column('comments_updated_at', sa.DateTime(), nullable=False, server_default=sa.func.now())
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.drop_column('comments_updated_at')
+        batch_op.drop_column('updated_at')
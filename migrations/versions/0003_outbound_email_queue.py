@@ -0,0 +1,42 @@
+"""add the outbound_emails queue table
+
+Revision ID: 0003_outbound_email_queue
+Revises: 0002_post_modification_times
+Create Date: 2026-10-18 15:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003_outbound_email_queue'
+down_revision = '0002_post_modification_times'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Older app versions ran db.create_all() at startup, which may have created the table already
+    if sa.inspect(op.get_bind()).has_table('outbound_emails'):
+        return
+    op.create_table(
+        'outbound_emails',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('subject', sa.String(length=250), nullable=False),
+        sa.Column('html', sa.Text(), nullable=False),
+        sa.Column('reply_to', sa.String(length=250), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('sent_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_outbound_emails_status_next_attempt_at', 'outbound_emails', ['status', 'next_attempt_at'])
+
+
+def downgrade():
+    op.drop_index('ix_outbound_emails_status_next_attempt_at', table_name='outbound_emails')
+    op.drop_table('outbound_emails')
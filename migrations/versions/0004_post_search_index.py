@@ -0,0 +1,45 @@
+"""add the post_search full-text index (FTS5 on SQLite, tsvector + GIN on Postgres)
+
+Revision ID: 0004_post_search_index
+Revises: 0003_outbound_email_queue
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '0004_post_search_index'
+down_revision = '0003_outbound_email_queue'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The index starts empty, fill it with 'flask search-reindex'
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS post_search "
+            "USING fts5(title, subtitle, body, comments, tokenize='porter unicode61')"
+        )
+    elif dialect == 'postgresql' and not sa.inspect(op.get_bind()).has_table('post_search'):
+        op.create_table(
+            'post_search',
+            sa.Column('post_id', sa.Integer(), nullable=False),
+            sa.Column('document', postgresql.TSVECTOR(), nullable=False),
+            sa.ForeignKeyConstraint(['post_id'], ['blog_posts.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('post_id')
+        )
+        op.create_index('ix_post_search_document', 'post_search', ['document'], postgresql_using='gin')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("DROP TABLE IF EXISTS post_search")
+    elif dialect == 'postgresql':
+        op.drop_index('ix_post_search_document', table_name='post_search')
+        op.drop_table('post_search')
@@ -0,0 +1,119 @@
+"""index foreign keys, make blog_posts.date a real DATE and cascade comment deletes
+
+Revision ID: 0005_indexes_real_dates_cascade
+Revises: 0004_post_search_index
+Create Date: 2026-10-18 16:30:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005_indexes_real_dates_cascade'
+down_revision = '0004_post_search_index'
+branch_labels = None
+depends_on = None
+
+# The format add_new_post used to store dates in, e.g. "January 05, 2024"
+DISPLAY_DATE_FORMAT = "%B %d, %Y"
+
+# Gives SQLite's unnamed foreign keys a name inside batch mode so they can be dropped
+NAMING_CONVENTION = {"fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s"}
+
+
+def parse_display_date(value):
+    """
+    :return: the date, or None if value is in none of the formats the app stored
+    """
+    for fmt in (DISPLAY_DATE_FORMAT, "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value.strip(), fmt).date()
+        except (AttributeError, ValueError):
+            pass
+    return None
+
+
+def upgrade():
+    connection = op.get_bind()
+
+    # ---blog_posts.date: String -> Date---
+    posts = sa.table('blog_posts', sa.column('id', sa.Integer), sa.column('date', sa.String),
+                     sa.column('published_on', sa.Date))
+    display_dates = connection.execute(sa.select(posts.c.id, posts.c.date)).all()
+    published_on = {post_id: parse_display_date(display_date) for post_id, display_date in display_dates}
+    # Stop before changing anything (SQLite DDL is not transactional) rather than making up publication dates
+    unparsed = [(post_id, display_date) for post_id, display_date in display_dates if published_on[post_id] is None]
+    if unparsed:
+        listing = "\n".join(f"  post {post_id}: {display_date!r}" for post_id, display_date in unparsed)
+        raise RuntimeError(
+            f"Cannot convert the date of {len(unparsed)} post(s) to a DATE, fix them (e.g. as 'January 05, 2024') "
+            f"and run the upgrade again:\n{listing}"
+        )
+
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.add_column(sa.Column('published_on', sa.Date(), nullable=True))
+
+    for post_id, date in published_on.items():
+        connection.execute(posts.update().where(posts.c.id == post_id).values(published_on=date))
+
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.drop_column('date')
+        batch_op.alter_column('published_on', new_column_name='date', existing_type=sa.Date(), nullable=False)
+
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.create_index('ix_blog_posts_date', ['date'])
+        batch_op.create_index('ix_blog_posts_author_id', ['author_id'])
+
+    # ---comments: indexed foreign keys, ON DELETE CASCADE from blog_posts---
+    if connection.dialect.name == 'sqlite':
+        old_fk_name = 'fk_comments_post_id_blog_posts'
+    else:
+        # Postgres' default name for the unnamed constraint
+        old_fk_name = 'comments_post_id_fkey'
+
+    with op.batch_alter_table('comments', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint(old_fk_name, type_='foreignkey')
+        batch_op.create_foreign_key(
+            'fk_comments_post_id_blog_posts', 'blog_posts', ['post_id'], ['id'], ondelete='CASCADE'
+        )
+        batch_op.create_index('ix_comments_post_id', ['post_id'])
+        batch_op.create_index('ix_comments_author_id', ['author_id'])
+
+    # Comments orphaned by deletes made before the cascade existed
+    connection.execute(sa.text(
+        "DELETE FROM comments WHERE post_id IS NOT NULL AND post_id NOT IN (SELECT id FROM blog_posts)"
+    ))
+
+
+def downgrade():
+    connection = op.get_bind()
+
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.drop_index('ix_comments_author_id')
+        batch_op.drop_index('ix_comments_post_id')
+        batch_op.drop_constraint('fk_comments_post_id_blog_posts', type_='foreignkey')
+        batch_op.create_foreign_key(
+            'comments_post_id_fkey' if connection.dialect.name != 'sqlite' else 'fk_comments_post_id_blog_posts',
+            'blog_posts', ['post_id'], ['id']
+        )
+
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.drop_index('ix_blog_posts_author_id')
+        batch_op.drop_index('ix_blog_posts_date')
+        batch_op.add_column(sa.Column('display_date', sa.String(length=250), nullable=True))
+
+    posts = sa.table('blog_posts', sa.column('id', sa.Integer), sa.column('date', sa.Date),
+                     sa.column('display_date', sa.String))
+    for post_id, published_on in connection.execute(sa.select(posts.c.id, posts.c.date)).all():
+        connection.execute(
+            posts.update().where(posts.c.id == post_id)
+            .values(display_date=published_on.strftime(DISPLAY_DATE_FORMAT))
+        )
+
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.drop_column('date')
+        batch_op.alter_column('display_date', new_column_name='date', existing_type=sa.String(length=250),
+                              nullable=False)
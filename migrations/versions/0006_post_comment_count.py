@@ -0,0 +1,32 @@
+"""add blog_posts.comment_count
+
+Revision ID: 0006_post_comment_count
+Revises: 0005_indexes_real_dates_cascade
+Create Date: 2026-10-18 18:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006_post_comment_count'
+down_revision = '0005_indexes_real_dates_cascade'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), nullable=False, server_default='0'))
+
+    # Backfill from the comments that exist now, the app keeps it up to date from here on
+    op.execute(
+        "UPDATE blog_posts SET comment_count = "
+        "(SELECT COUNT(*) FROM comments WHERE comments.post_id = blog_posts.id)"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.drop_column('comment_count')
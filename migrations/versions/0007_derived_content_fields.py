@@ -0,0 +1,41 @@
+"""add sanitized HTML and derived fields of posts and comments
+
+Revision ID: 0007_derived_content_fields
+Revises: 0006_post_comment_count
+Create Date: 2026-10-18 21:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007_derived_content_fields'
+down_revision = '0006_post_comment_count'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Nullable: existing rows are processed by 'flask content backfill', pages sanitize them on view until then
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.add_column(sa.Column('body_html', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('excerpt', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('word_count', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('reading_time', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.add_column(sa.Column('text_html', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.drop_column('text_html')
+
+    with op.batch_alter_table('blog_posts') as batch_op:
+        batch_op.drop_column('content_hash')
+        batch_op.drop_column('reading_time')
+        batch_op.drop_column('word_count')
+        batch_op.drop_column('excerpt')
+        batch_op.drop_column('body_html')
@@ -0,0 +1,28 @@
+"""add users.avatar_url
+
+Revision ID: 0008_user_avatar_url
+Revises: 0007_derived_content_fields
+Create Date: 2026-10-18 23:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008_user_avatar_url'
+down_revision = '0007_derived_content_fields'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Nullable: existing users get theirs from 'flask avatars backfill' (the name is keyed with the app's SECRET_KEY,
+    # so it cannot be computed here), and show the default picture until then
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.add_column(sa.Column('avatar_url', sa.String(length=250), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('avatar_url')
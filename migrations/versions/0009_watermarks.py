@@ -0,0 +1,29 @@
+"""add the watermarks table
+
+Revision ID: 0009_watermarks
+Revises: 0008_user_avatar_url
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009_watermarks'
+down_revision = '0008_user_avatar_url'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'watermarks',
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('changed_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('name'),
+    )
+
+
+def downgrade():
+    op.drop_table('watermarks')
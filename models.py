@@ -1,11 +1,28 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from flask_login import UserMixin
+from datetime import datetime
+import sqlite3
 
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+
+# Reads of GET requests can go to read replicas, see replicas.py
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """
+    SQLite ignores foreign keys (and so ON DELETE CASCADE) unless enabled on every connection
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
 
 
 # STEP 2 Define a Model
@@ -17,6 +34,8 @@ class User(db.Model, UserMixin):
     password = db.Column(db.String(250), nullable=False)
     agree_to_terms = db.Column(db.Boolean, nullable= False)
     is_admin = db.Column(db.Boolean ,default=False)
+    # Generated avatar, set once when the user is created (avatars.set_avatar). NULL shows the default picture
+    avatar_url = db.Column(db.String(250))
 
     # 🟩 DEFINE RELATIONSHIPS
     # ---------- one-to-many relationship ----------
@@ -33,31 +52,56 @@ class Post(db.Model):
     __tablename__ = "blog_posts"
     id = db.Column(db.Integer, primary_key=True)
     # 🟩Foreign Key (New column) |t creates a unique key  link between a Post object and a User object
-    author_id = db.Column(db.Integer, ForeignKey("users.id"))
+    author_id = db.Column(db.Integer, ForeignKey("users.id"), index=True)
 
     # 🟩 DEFINE RELATIONSHIPS
     # Connect the Post back to the User, 'parent' is the attribute in User that relates to the Post.
     author = relationship("User", back_populates="posts")
 
     # ***************Parent Relationship with comments*************#
-    comments = relationship("Comment", back_populates="parent_post") # One-to-many with comments
+    # One-to-many with comments. The db deletes a post's comments (ON DELETE CASCADE), so the ORM does not load them
+    comments = relationship("Comment", back_populates="parent_post", cascade="all, delete-orphan", passive_deletes=True)
 
 
 
     title = db.Column(db.String(250), unique=True, nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
-    date = db.Column(db.String(250), nullable=False)
+    # Publication date, displayed with the 'long_date' template filter
+    date = db.Column(db.Date, nullable=False, index=True)
     body = db.Column(db.Text, nullable=False)
     img_url = db.Column(db.String(250), nullable=False)
 
+    # 🟩 Modification watermarks (UTC), used for the ETag / Last-Modified of pages showing the post
+    # updated_at changes when the post itself is edited, comments_updated_at when a comment is added or deleted
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.func.now())
+    comments_updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.func.now())
+
+    # 🟩 Denormalised number of comments, incremented / decremented in SQL with every comment added or deleted
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # 🟩 Derived from body when the post is written (content.process_post), so pages never process it on view:
+    # the sanitized HTML, a plain text excerpt for the feed, word count, reading time in minutes and the hash of
+    # the body they were derived from. NULL for rows not processed yet ('flask content backfill')
+    body_html = db.Column(db.Text)
+    excerpt = db.Column(db.Text)
+    word_count = db.Column(db.Integer)
+    reading_time = db.Column(db.Integer)
+    content_hash = db.Column(db.String(64))
+
 
 class Comment(db.Model):
     __tablename__ = "comments"
     id = db.Column(db.Integer, primary_key=True)
     # 🟩Foreign Key (New column) |t creates a unique key  link between a Post object and a User object
-    author_id = db.Column(db.Integer, ForeignKey("users.id"))
-    post_id = db.Column(db.Integer, ForeignKey("blog_posts.id"))
+    author_id = db.Column(db.Integer, ForeignKey("users.id"), index=True)
+    post_id = db.Column(
+        db.Integer,
+        ForeignKey("blog_posts.id", ondelete="CASCADE", name="fk_comments_post_id_blog_posts"),
+        index=True
+    )
     text = db.Column(db.Text, nullable=False)
+    # Sanitized text, written with the comment (content.process_comment)
+    text_html = db.Column(db.Text)
 
 
 
@@ -68,10 +112,26 @@ class Comment(db.Model):
 
 
 
-
-
-
-
-
-
-
+# Contact form messages waiting to be delivered by the mail queue worker (see mail_queue.py)
+class OutboundEmail(db.Model):
+    __tablename__ = "outbound_emails"
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(250), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    reply_to = db.Column(db.String(250), nullable=False)
+    # 'pending' -> 'sending' (claimed by a worker until next_attempt_at) -> 'sent' or 'failed'
+    status = db.Column(db.String(20), nullable=False, default="pending")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index("ix_outbound_emails_status_next_attempt_at", "status", "next_attempt_at"),)
+
+
+# Modification times of changes no remaining row carries, e.g. 'posts_deleted', so validators never move backwards
+class Watermark(db.Model):
+    __tablename__ = "watermarks"
+    name = db.Column(db.String(50), primary_key=True)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
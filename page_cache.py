@@ -0,0 +1,370 @@
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from urllib.parse import urlencode
+import hashlib
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import time
+
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+
+import compression
+import replicas
+from conditional import is_not_modified, release
+
+
+# ---------------------Backends---------------------------------
+# A backend stores entries under (tag, key). The tag groups the pages that are invalidated together
+# ('index', 'post:3', ...) and the key is the request path plus the query arguments the view reads.
+
+class MemoryBackend:
+    """
+    In-process LRU backend. Fast, but every gunicorn worker has its own copy and only sees its own invalidations, so
+    only use it with a single process (gunicorn.conf.py refuses it with several workers)
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = Lock()
+
+    def get(self, tag, key):
+        with self._lock:
+            item = self._entries.get((tag, key))
+            if item is None:
+                return None
+            expires_at, entry = item
+            if expires_at <= time.time():
+                self._remove((tag, key))
+                return None
+            self._entries.move_to_end((tag, key))
+            return entry
+
+    def set(self, tag, key, entry, ttl):
+        with self._lock:
+            self._entries[(tag, key)] = (time.time() + ttl, entry)
+            self._entries.move_to_end((tag, key))
+            self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def delete_tag(self, tag):
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                self._entries.pop((tag, key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def _remove(self, tag_key):
+        self._entries.pop(tag_key, None)
+        tag, key = tag_key
+        keys = self._tags.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+
+class FileSystemBackend:
+    """
+    On-disk backend, one directory per tag. Shared by every worker on the host, so invalidations are seen by all of them.
+    Every file's mtime is its expiry time: every PRUNE_INTERVAL writes of a process, the expired files are deleted and
+    then the ones expiring first until at most maxsize are left
+    """
+
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, directory, maxsize=512):
+        self.directory = directory
+        self.maxsize = maxsize
+        self._writes = 0
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _tag_dir(self, tag):
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_-]', '-', tag))
+
+    def _path(self, tag, key):
+        return os.path.join(self._tag_dir(tag), hashlib.sha256(key.encode()).hexdigest() + '.cache')
+
+    def get(self, tag, key):
+        try:
+            with open(self._path(tag, key), 'rb') as f:
+                expires_at, entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires_at <= time.time():
+            self._unlink(self._path(tag, key))
+            return None
+        return entry
+
+    def set(self, tag, key, entry, ttl):
+        tag_dir = self._tag_dir(tag)
+        os.makedirs(tag_dir, exist_ok=True)
+        # Write to a temp file and rename so readers never see a half written entry
+        fd, tmp_path = tempfile.mkstemp(dir=tag_dir)
+        expires_at = time.time() + ttl
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((expires_at, entry), f)
+        os.utime(tmp_path, (expires_at, expires_at))
+        os.replace(tmp_path, self._path(tag, key))
+        with self._lock:
+            self._writes += 1
+            prune = self._writes % self.PRUNE_INTERVAL == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """
+        Deletes the expired entries, then the ones expiring first while there are more than maxsize
+        """
+        now = time.time()
+        files = []
+        for tag_dir in os.scandir(self.directory):
+            if not tag_dir.is_dir():
+                continue
+            try:
+                entries = list(os.scandir(tag_dir.path))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.name.endswith('.cache'):
+                    continue
+                try:
+                    expires_at = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if expires_at <= now:
+                    self._unlink(entry.path)
+                else:
+                    files.append((expires_at, entry.path))
+        if len(files) > self.maxsize:
+            files.sort()
+            for _, path in files[:len(files) - self.maxsize]:
+                self._unlink(path)
+
+    @staticmethod
+    def _unlink(path):
+        # Another worker may have removed it already
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def delete_tag(self, tag):
+        shutil.rmtree(self._tag_dir(tag), ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+
+# ---------------------Page cache---------------------------------
+# With read replicas, invalidating a tag also stores this key in it for the replicas' lag: a page rendered from a
+# replica meanwhile may predate the write, so it is only kept until the replicas have caught up. ALL_TAGS holds the
+# one of invalidate_all()
+
+RECENT_WRITE_KEY = '!recent-write'
+ALL_TAGS = '!all'
+
+
+class PageCache:
+    """
+    Full-response cache for anonymous GET requests
+    """
+
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'backend': type(self.backend).__name__, 'hits': self.hits, 'misses': self.misses}
+
+
+def cacheable_request():
+    """
+    Only anonymous GETs without pending flash messages are served from / stored in the page cache,
+    since everything else renders per-user content
+    """
+    return (
+        'page_cache' in current_app.extensions
+        and request.method == 'GET'
+        and '_flashes' not in session
+        and not current_user.is_authenticated
+    )
+
+
+def cache_key(args):
+    """
+    :param args: the query arguments the view reads
+    :return: the cache key of the current request: the release (pages of a previous deploy are never served), its path
+             and those arguments in a fixed order, or None when it has other arguments (or one of them several
+             times), which would only fill the cache with copies
+    """
+    if any(name not in args or len(request.args.getlist(name)) > 1 for name in request.args):
+        return None
+    query = urlencode([(name, request.args[name]) for name in args if name in request.args])
+    version, _ = release()
+    return f"{version}:{request.path}?{query}" if query else f"{version}:{request.path}"
+
+
+def cached_page(tag, args=()):
+    """
+    Decorator caching the full response of a view for anonymous visitors. Put it under @app.route.
+
+    :param tag: invalidation group of the page, either a string or a function called with the view's kwargs
+                e.g. lambda post_id: f"post:{post_id}"
+    :param args: names of the query arguments the view reads, requests with any other are not cached
+    """
+
+    query_args = tuple(args)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not cacheable_request():
+                return view(*args, **kwargs)
+            key = cache_key(query_args)
+            if key is None:
+                return view(*args, **kwargs)
+
+            cache = current_app.extensions['page_cache']
+            page_tag = tag(**kwargs) if callable(tag) else tag
+
+            entry = cache.backend.get(page_tag, key)
+            if entry is not None:
+                cache.hits += 1
+                response = _response_from_entry(entry)
+                # Entries are evicted on every write, so their stored validators are current
+                etag, _ = response.get_etag()
+                if etag and is_not_modified(etag, response.last_modified):
+                    response = current_app.response_class(status=304, headers=_validator_headers(response))
+                return response
+
+            cache.misses += 1
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                body = response.get_data()
+                entry = {
+                    'body': body,
+                    # Compressed once here instead of on every hit
+                    'encoded': compression.precompress(body, current_app.config),
+                    'status': response.status_code,
+                    'headers': [('Content-Type', response.content_type)] + _validator_headers(response),
+                }
+                cache.backend.set(page_tag, key, entry, _entry_ttl(cache, page_tag))
+                return _response_from_entry(entry)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def _entry_ttl(cache, page_tag):
+    """
+    :return: the page cache TTL, or the replicas' lag for a page a replica rendered right after its tag was invalidated
+    """
+    if replicas.read_from_replica() and (
+        cache.backend.get(page_tag, RECENT_WRITE_KEY) or cache.backend.get(ALL_TAGS, RECENT_WRITE_KEY)
+    ):
+        return min(cache.ttl, replicas.replica_lag())
+    return cache.ttl
+
+
+def _response_from_entry(entry):
+    """
+    :return: the cached response, in the stored encoding the client prefers if there is one
+    """
+    response = current_app.response_class(entry['body'], status=entry['status'], headers=entry['headers'])
+    encoded = entry.get('encoded') or {}
+    if encoded:
+        encoding = compression.negotiate(tuple(encoded))
+        if encoding is not None:
+            compression.set_encoded_body(response, encoded[encoding], encoding)
+        else:
+            response.vary.add('Accept-Encoding')
+    return response
+
+
+def _validator_headers(response):
+    """
+    :return: the ETag / Last-Modified / Cache-Control headers of response, as a list of (name, value)
+    """
+    return [
+        (name, response.headers[name])
+        for name in ('ETag', 'Last-Modified', 'Cache-Control')
+        if name in response.headers
+    ]
+
+
+def invalidate_post(post_id):
+    """
+    Evicts the page of one post plus every page of the home feed and search results.
+    Call after any write to the post or its comments
+    """
+    cache = current_app.extensions.get('page_cache')
+    if cache is not None:
+        for page_tag in (f"post:{post_id}", 'index', 'search'):
+            cache.backend.delete_tag(page_tag)
+            _mark_recent_write(cache, page_tag)
+
+
+def invalidate_all():
+    """
+    Evicts every cached page. Call after changes to many pages at once, e.g. the backfill and import commands. From
+    the CLI this reaches the server's cache when it is shared (filesystem backend)
+    """
+    cache = current_app.extensions.get('page_cache')
+    if cache is not None:
+        cache.backend.clear()
+        _mark_recent_write(cache, ALL_TAGS)
+
+
+def _mark_recent_write(cache, page_tag):
+    lag = replicas.replica_lag()
+    if lag:
+        cache.backend.set(page_tag, RECENT_WRITE_KEY, True, lag)
+
+
+def init_app(app):
+    """
+    Sets up the page cache from PAGE_CACHE_BACKEND ('filesystem' (default), 'memory' or 'none'), PAGE_CACHE_TTL,
+    PAGE_CACHE_SIZE (max entries) and PAGE_CACHE_DIR (filesystem backend).
+    'filesystem' is shared by every worker of the host, so an edit invalidates their pages too. 'memory' is per
+    process, for running a single one
+
+    :param app: the Flask app
+    :return: the PageCache or None if disabled
+    """
+    app.config.setdefault('PAGE_CACHE_BACKEND', 'filesystem')
+    app.config.setdefault('PAGE_CACHE_TTL', 300)
+    app.config.setdefault('PAGE_CACHE_SIZE', 512)
+    app.config.setdefault('PAGE_CACHE_DIR', os.path.join(app.instance_path, 'page_cache'))
+
+    backend_name = app.config['PAGE_CACHE_BACKEND']
+    if backend_name == 'none':
+        app.extensions.pop('page_cache', None)
+        return None
+    if backend_name == 'memory':
+        backend = MemoryBackend(maxsize=app.config['PAGE_CACHE_SIZE'])
+    elif backend_name == 'filesystem':
+        backend = FileSystemBackend(app.config['PAGE_CACHE_DIR'], maxsize=app.config['PAGE_CACHE_SIZE'])
+    else:
+        raise ValueError(f"Unsupported page cache backend: {backend_name}")
+
+    cache = PageCache(backend, ttl=app.config['PAGE_CACHE_TTL'])
+    app.extensions['page_cache'] = cache
+    return cache
@@ -0,0 +1,161 @@
+"""
+Password hashing with passlib on a bounded thread pool.
+
+The pool only helps workers that serve several requests at once (gunicorn 'gthread' or 'gevent'): every backend
+releases the GIL while hashing, so the pool caps how many cores logins take and PASSWORD_HASH_MAX_PENDING fails
+excess logins fast while the other threads keep rendering pages. A sync worker handles one request at a time, there
+the pool only adds a thread hop and each login blocks its worker for the whole hash.
+
+The hash cost sets the price of a login: the default PASSWORD_PBKDF2_ROUNDS, 260000, is what werkzeug used for the
+existing hashes. Raising it slows every login and cuts the logins a core can verify in proportion (600000 rounds
+took the login p95 of benchmarks/bench_endpoints.py from about 140 ms to 340 ms), measure before changing it.
+"""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import BoundedSemaphore
+
+from flask import current_app
+from passlib.context import CryptContext
+from werkzeug.security import check_password_hash
+
+
+# Hashes made by werkzeug's generate_password_hash before this module existed, e.g. 'pbkdf2:sha256:260000$salt$hash'
+LEGACY_WERKZEUG_PREFIXES = ('pbkdf2:', 'scrypt:')
+
+
+class HashingBusy(Exception):
+    """
+    Raised when the hashing pool is saturated, so the request can fail fast instead of queueing behind other logins
+    """
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies passwords with passlib, on a small bounded thread pool.
+
+    The first scheme in 'schemes' is used for new hashes, the others (and legacy werkzeug hashes) are only verified and
+    get upgraded on the next successful login, as do hashes made with a lower cost than the configured one.
+
+    See the module docstring for when the pool helps.
+    """
+
+    def __init__(self, schemes, settings=None, workers=2, max_pending=8, timeout=10):
+        """
+        :param schemes: passlib scheme names, e.g. ['argon2', 'bcrypt', 'pbkdf2_sha256'], the first one is the default
+        :param settings: passlib CryptContext keyword settings, e.g. {'bcrypt__rounds': 12}
+        :param workers: threads hashing concurrently
+        :param max_pending: max hash operations running or waiting, more raise HashingBusy
+        :param timeout: seconds to wait for a hash operation before giving up with HashingBusy
+        """
+        self.context = CryptContext(schemes=schemes, deprecated="auto", **(settings or {}))
+        default_handler = self.context.handler()
+        if hasattr(default_handler, 'has_backend') and not default_handler.has_backend():
+            raise RuntimeError(
+                f"No backend for password scheme '{default_handler.name}', "
+                f"install argon2-cffi (argon2) or bcrypt (bcrypt)"
+            )
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hasher")
+        self._slots = BoundedSemaphore(max_pending)
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy("Too many password hash operations in progress")
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash is done, not until the caller gives up waiting: a hash that timed out
+        # still occupies the pool, so max_pending bounds the work actually queued
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashingBusy("Password hashing timed out")
+
+    def hash(self, password):
+        """
+        :return: a new hash of password with the default scheme and cost
+        """
+        return self._run(self.context.hash, password)
+
+    def verify_and_update(self, password, stored_hash):
+        """
+        Checks password against stored_hash
+
+        :return: (matches, new_hash). new_hash is a replacement hash to store when the password matches but
+                 stored_hash uses an outdated scheme or cost, else None
+        """
+        return self._run(self._verify_and_update, password, stored_hash)
+
+    def _verify_and_update(self, password, stored_hash):
+        if stored_hash.startswith(LEGACY_WERKZEUG_PREFIXES):
+            if not check_password_hash(stored_hash, password):
+                return False, None
+            return True, self.context.hash(password)
+        return self.context.verify_and_update(password, stored_hash)
+
+    def needs_update(self, stored_hash):
+        return stored_hash.startswith(LEGACY_WERKZEUG_PREFIXES) or self.context.needs_update(stored_hash)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def context_settings(config):
+    """
+    Builds the passlib settings from PASSWORD_PBKDF2_ROUNDS, PASSWORD_BCRYPT_ROUNDS, PASSWORD_ARGON2_TIME_COST and
+    PASSWORD_ARGON2_MEMORY_COST. Each cost is also the minimum, so hashes made with a lower cost get rehashed.
+    """
+    return {
+        'pbkdf2_sha256__default_rounds': config['PASSWORD_PBKDF2_ROUNDS'],
+        'pbkdf2_sha256__min_rounds': config['PASSWORD_PBKDF2_ROUNDS'],
+        'bcrypt__default_rounds': config['PASSWORD_BCRYPT_ROUNDS'],
+        'bcrypt__min_rounds': config['PASSWORD_BCRYPT_ROUNDS'],
+        'argon2__time_cost': config['PASSWORD_ARGON2_TIME_COST'],
+        'argon2__memory_cost': config['PASSWORD_ARGON2_MEMORY_COST'],
+    }
+
+
+def init_app(app):
+    """
+    Creates the app's PasswordHasher from the PASSWORD_* config
+
+    :param app: the Flask app
+    :return: the PasswordHasher
+    """
+    app.config.setdefault('PASSWORD_SCHEMES', ['pbkdf2_sha256', 'argon2', 'bcrypt'])
+    app.config.setdefault('PASSWORD_PBKDF2_ROUNDS', 260000)
+    app.config.setdefault('PASSWORD_BCRYPT_ROUNDS', 12)
+    app.config.setdefault('PASSWORD_ARGON2_TIME_COST', 3)
+    app.config.setdefault('PASSWORD_ARGON2_MEMORY_COST', 65536)
+    app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+    app.config.setdefault('PASSWORD_HASH_MAX_PENDING', 8)
+    app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+
+    hasher = PasswordHasher(
+        schemes=app.config['PASSWORD_SCHEMES'],
+        settings=context_settings(app.config),
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+        timeout=app.config['PASSWORD_HASH_TIMEOUT'],
+    )
+    app.extensions['password_hasher'] = hasher
+    return hasher
+
+
+def hash_password(password):
+    """
+    Hashes password with the current app's default scheme
+
+    :raises HashingBusy: if the hashing pool is saturated
+    """
+    return current_app.extensions['password_hasher'].hash(password)
+
+
+def verify_password(password, stored_hash):
+    """
+    :return: (matches, new_hash), see PasswordHasher.verify_and_update
+    :raises HashingBusy: if the hashing pool is saturated
+    """
+    return current_app.extensions['password_hasher'].verify_and_update(password, stored_hash)
@@ -0,0 +1,123 @@
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from flask.signals import Namespace
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised in testing mode when a request issues more SQL statements than its configured query budget
+    """
+
+
+# Sent in debug and testing mode with the statement count of every request, once its body has been sent (streamed
+# pages run queries after the headers, so they have no X-Query-Count header): sender=app, endpoint, count, streamed
+queries_counted = Namespace().signal('queries-counted')
+
+
+# ---------------------SQLAlchemy---------------------------------
+# The only SQL listeners of the app: they count and time the statements of each request in g.query_count and
+# g.query_time, and pass the time of every statement to the observers (the metrics, see observe_queries).
+
+_observers = []
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Counts every statement sent to the database during a request and notes when it started
+    """
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - conn.info['query_start'].pop()
+    if has_request_context():
+        g.query_time = g.get('query_time', 0.0) + elapsed
+    for observer in _observers:
+        observer(elapsed)
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute, drop its start time
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+def install_listeners():
+    """
+    Registers the SQL listeners, once per process however many apps are built
+    """
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+def observe_queries(observer):
+    """
+    Calls observer(seconds) after every successful SQL statement, inside a request or not
+
+    :param observer: function taking the statement's duration
+    """
+    install_listeners()
+    if observer not in _observers:
+        _observers.append(observer)
+
+
+def query_budget_for(app, endpoint):
+    """
+    Looks up the query budget of an endpoint
+
+    :param app: the Flask app holding the QUERY_BUDGET / QUERY_BUDGETS config
+    :param endpoint: the endpoint name e.g. 'show_post'
+    :return: the per-endpoint budget from QUERY_BUDGETS, else the global QUERY_BUDGET (None means unlimited)
+    """
+    return app.config['QUERY_BUDGETS'].get(endpoint, app.config['QUERY_BUDGET'])
+
+
+def init_app(app):
+    """
+    Registers the per-request query counter.
+
+    The counter is always on (it is a single integer increment per statement). In debug or testing mode every response
+    gets an 'X-Query-Count' header, and a request that goes over its budget is logged as a warning in debug mode and
+    raises QueryBudgetExceeded in testing mode, so an N+1 regression fails the test that renders the page. Streamed
+    responses are checked once their body has been sent: they have no header (it goes out before the body's queries),
+    tests read their count from the queries_counted signal, and an overrun raises when the response is closed.
+
+    :param app: the Flask app
+    """
+    app.config.setdefault('QUERY_BUDGET', None)
+    app.config.setdefault('QUERY_BUDGETS', {})
+
+    install_listeners()
+
+    def check(count, endpoint, streamed=False):
+        queries_counted.send(app, endpoint=endpoint, count=count, streamed=streamed)
+        budget = query_budget_for(app, endpoint)
+        if budget is not None and count > budget:
+            message = f"{endpoint} issued {count} queries, over its budget of {budget}"
+            if app.testing:
+                raise QueryBudgetExceeded(message)
+            app.logger.warning(message)
+
+    @app.after_request
+    def check_query_budget(response):
+        if not (app.debug or app.testing):
+            return response
+
+        if response.is_streamed:
+            # The body still has to run its queries (e.g. a post page's comments), count them once it has been sent
+            counter = g._get_current_object()
+            endpoint = request.endpoint
+            response.call_on_close(lambda: check(counter.get('query_count', 0), endpoint, streamed=True))
+            return response
+
+        count = g.get('query_count', 0)
+        response.headers['X-Query-Count'] = str(count)
+        check(count, request.endpoint)
+        return response
@@ -0,0 +1,283 @@
+from collections import OrderedDict
+from functools import wraps
+from math import ceil
+from threading import Lock, local
+import os
+import random
+import re
+import sqlite3
+import time
+
+from flask import current_app, request
+from werkzeug.exceptions import TooManyRequests
+
+import metrics
+
+
+# ---------------------Limits---------------------------------
+# A limit is a token bucket: 'N/period' holds up to N tokens, each request takes one, and N come back per period,
+# spread evenly. So '5/minute' allows a burst of 5, then one request every 12 seconds.
+# Every limited route has a bucket per client IP and, optionally, ones keyed on the account (the email posted in the
+# form): 'ip_account' per client IP and account, 'account' per account whatever the IP. An 'account' bucket is shared
+# by everyone, so an attacker emptying it locks the owner out: login keeps it well above what one IP can spend
+# (ip_account), as a ceiling on guessing one account's password from many IPs.
+
+KEY_TYPES = ('ip', 'ip_account', 'account')
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+LIMIT = re.compile(r"^\s*(\d+)\s*/\s*(second|minute|hour|day)\s*$")
+
+DEFAULT_LIMITS = {
+    'login': {'ip': '20/minute', 'ip_account': '5/minute', 'account': '30/minute'},
+    'register': {'ip': '5/minute'},
+    'contact': {'ip': '3/minute', 'account': '3/hour'},
+}
+
+
+def parse_limit(value):
+    """
+    :param value: e.g. '5/minute'
+    :return: (capacity, tokens refilled per second)
+    """
+    match = LIMIT.match(value)
+    if match is None:
+        raise ValueError(f"Invalid rate limit {value!r}, expected e.g. '5/minute'")
+    capacity = int(match.group(1))
+    return capacity, capacity / PERIODS[match.group(2)]
+
+
+def parse_limits(value):
+    """
+    Parses the limits of one route as written in an environment variable
+
+    :param value: e.g. 'ip=20/minute,ip_account=5/minute,account=30/minute'
+    :return: dict of key type -> limit, e.g. {'ip': '20/minute', 'ip_account': '5/minute', 'account': '30/minute'}
+    """
+    limits = {}
+    for part in value.split(","):
+        key_type, _, limit = part.partition("=")
+        key_type = key_type.strip()
+        if key_type not in KEY_TYPES:
+            raise ValueError(f"Invalid rate limit key {key_type!r}, expected one of {', '.join(KEY_TYPES)}")
+        parse_limit(limit)
+        limits[key_type] = limit.strip()
+    return limits
+
+
+# ---------------------Backends---------------------------------
+# take(key, capacity, rate) spends a token of the bucket 'key' and returns 0, or returns the seconds until a token
+# is available when the bucket is empty. A bucket that is not stored is full.
+
+class MemoryBackend:
+    """
+    In-process LRU backend. Every gunicorn worker counts on its own, so a client gets up to 'workers' times the limit
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+                return (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1, now)
+            self._buckets.move_to_end(key)
+            # Evicting a bucket refills it, so keep the table large enough for the clients of a few minutes
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return 0
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBackend:
+    """
+    Buckets in a SQLite file shared by every worker on the host, so the limits hold however many workers there are.
+    A take is one short write transaction on a local file
+    """
+
+    # Chance that a take also deletes the buckets that have been full for a while
+    PRUNE_PROBABILITY = 0.001
+
+    def __init__(self, path, max_age=PERIODS['day']):
+        self.path = path
+        self.max_age = max_age
+        self._local = local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads, nor between processes after a fork
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def take(self, key, capacity, rate):
+        # Wall clock, not monotonic: the timestamps are compared across processes
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + max(0, now - row[1]) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            connection.execute(
+                "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens - 1 if wait == 0 else tokens, now),
+            )
+            if random.random() < self.PRUNE_PROBABILITY:
+                connection.execute("DELETE FROM buckets WHERE updated < ?", (now - self.max_age,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+    def clear(self):
+        self._connection().execute("DELETE FROM buckets")
+
+
+# ---------------------Limiter---------------------------------
+
+class RateLimiter:
+    """
+    Applies the limits of RATE_LIMITS with a backend and counts its decisions
+    """
+
+    def __init__(self, backend, limits, proxy_count=0):
+        self.backend = backend
+        self.limits = {
+            name: {key_type: parse_limit(limit) for key_type, limit in route_limits.items()}
+            for name, route_limits in limits.items()
+        }
+        self.proxy_count = proxy_count
+        self.allowed = 0
+        self.rejected = 0
+        self.errors = 0
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'allowed': self.allowed,
+            'rejected': self.rejected,
+            'errors': self.errors,
+        }
+
+    def client_ip(self):
+        """
+        :return: the client's address. Behind RATE_LIMIT_PROXY_COUNT proxies it is the one the outermost proxy saw
+        """
+        if self.proxy_count:
+            route = request.access_route
+            return route[max(0, len(route) - self.proxy_count)]
+        return request.remote_addr or ""
+
+    def check(self, name, account=None):
+        """
+        Spends a token of every bucket of the route for the current request
+
+        :param name: the route's name in RATE_LIMITS
+        :param account: the account the request is about, e.g. the email of a login attempt
+        :return: seconds to wait when a bucket is empty, else 0
+        """
+        ip = self.client_ip()
+        keys = {'ip': ip}
+        if account:
+            keys['account'] = account.strip().lower()
+            keys['ip_account'] = f"{ip}|{keys['account']}"
+        for key_type, (capacity, rate) in self.limits.get(name, {}).items():
+            if key_type not in keys:
+                continue
+            try:
+                wait = self.backend.take(f"{name}:{key_type}:{keys[key_type]}", capacity, rate)
+            except (sqlite3.Error, OSError) as e:
+                # Fail open: a limiter problem must not lock everyone out, but it must be seen
+                self.errors += 1
+                metrics.RATE_LIMIT_DECISIONS.labels(name, key_type, 'error').inc()
+                metrics.RATE_LIMIT_FAIL_OPEN.labels(name).inc()
+                current_app.logger.warning(f"Rate limiter unavailable, allowing the '{name}' request unchecked: {e}")
+                return 0
+            if wait:
+                self.rejected += 1
+                metrics.RATE_LIMIT_DECISIONS.labels(name, key_type, 'rejected').inc()
+                return wait
+        self.allowed += 1
+        metrics.RATE_LIMIT_DECISIONS.labels(name, 'all', 'allowed').inc()
+        return 0
+
+
+def rate_limited(name, account_field=None, methods=('POST',)):
+    """
+    Decorator applying the RATE_LIMITS of 'name' to a view. Put it under @app.route. It runs before the view, so a
+    rejected request costs no form validation, database query, password hash or SMTP session: it gets a plain
+    429 Too Many Requests with a Retry-After header.
+
+    :param name: the route's name in RATE_LIMITS
+    :param account_field: form field holding the account the request is about, for the 'ip_account' and 'account'
+                          limits
+    :param methods: the limited methods, showing the form (GET) is cheap
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            limiter = current_app.extensions.get('rate_limit')
+            if limiter is not None and request.method in methods:
+                account = request.form.get(account_field) if account_field else None
+                wait = limiter.check(name, account)
+                if wait:
+                    raise TooManyRequests(retry_after=max(1, ceil(wait)))
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def init_app(app):
+    """
+    Sets up the rate limiter from RATE_LIMIT_BACKEND ('memory', 'sqlite' or 'none'), RATE_LIMIT_SIZE (memory
+    backend), RATE_LIMIT_SQLITE_PATH (sqlite backend, default instance/rate_limit.sqlite3), RATE_LIMITS (route name ->
+    {'ip': ..., 'ip_account': ..., 'account': ...}, merged over DEFAULT_LIMITS) and RATE_LIMIT_PROXY_COUNT (reverse
+    proxies in front of the app, whose X-Forwarded-For is trusted)
+
+    :param app: the Flask app
+    :return: the RateLimiter or None if disabled
+    """
+    app.config.setdefault('RATE_LIMIT_BACKEND', 'memory')
+    app.config.setdefault('RATE_LIMIT_SIZE', 10000)
+    app.config.setdefault('RATE_LIMIT_SQLITE_PATH', os.path.join(app.instance_path, 'rate_limit.sqlite3'))
+    app.config.setdefault('RATE_LIMITS', {})
+    app.config.setdefault('RATE_LIMIT_PROXY_COUNT', 0)
+
+    backend_name = app.config['RATE_LIMIT_BACKEND']
+    if backend_name == 'none':
+        app.extensions.pop('rate_limit', None)
+        return None
+    if backend_name == 'memory':
+        backend = MemoryBackend(maxsize=app.config['RATE_LIMIT_SIZE'])
+    elif backend_name == 'sqlite':
+        backend = SQLiteBackend(app.config['RATE_LIMIT_SQLITE_PATH'])
+    else:
+        raise ValueError(f"Unsupported rate limit backend: {backend_name}")
+
+    limits = {**DEFAULT_LIMITS, **app.config['RATE_LIMITS']}
+    limiter = RateLimiter(backend, limits, proxy_count=app.config['RATE_LIMIT_PROXY_COUNT'])
+    app.extensions['rate_limit'] = limiter
+    return limiter
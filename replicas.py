@@ -0,0 +1,93 @@
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+
+
+# ---------------------Routing---------------------------------
+# Reads of GET / HEAD requests go to a read replica, everything else to the primary (DB_URI):
+# - requests with another method, and anything outside a request (CLI, the mail queue worker),
+# - the rest of a request once it has written (flushed or run an INSERT / UPDATE / DELETE),
+# - for DB_REPLICA_STICKY_SECONDS after a user's last write, so they see their own new comment despite replication
+#   lag. The time of the write is kept in their session.
+# Anonymous visitors read the replicas too, page cache misses included: the page cache keeps a page rendered from a
+# replica shortly after an invalidation only for DB_REPLICA_STICKY_SECONDS, in case it predates the write.
+
+READ_METHODS = ('GET', 'HEAD')
+SESSION_KEY = 'db_written_at'
+
+
+def _replica_keys():
+    config = current_app.extensions.get('replicas')
+    return config['keys'] if config else ()
+
+
+def _reads_from_primary():
+    if request.method not in READ_METHODS:
+        return True
+    written_at = session.get(SESSION_KEY)
+    return written_at is not None and time.time() - written_at < current_app.config['DB_REPLICA_STICKY_SECONDS']
+
+
+def replica_lag():
+    """
+    :return: how long (seconds) a replica may lag behind the primary, DB_REPLICA_STICKY_SECONDS, or 0 without replicas
+    """
+    return current_app.config['DB_REPLICA_STICKY_SECONDS'] if _replica_keys() else 0
+
+
+def read_from_replica():
+    """
+    :return: True if the current request has read from a replica
+    """
+    return g.get('db_replica') is not None
+
+
+class RoutingSession(Session):
+    """
+    Flask-SQLAlchemy session sending the reads of GET requests to a replica, see the rules above.
+    A request sticks to one replica, so all its reads see the same snapshot
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            keys = _replica_keys()
+            if keys:
+                if self._flushing or getattr(clause, 'is_dml', False):
+                    g.db_wrote = True
+                elif not g.get('db_wrote'):
+                    if 'db_replica' not in g:
+                        g.db_replica = None if _reads_from_primary() else random.choice(keys)
+                    if g.db_replica is not None:
+                        return self._db.engines[g.db_replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def init_app(app):
+    """
+    Adds every URI of DB_REPLICA_URIS as a 'replica_<n>' bind. Call before db_config.init_app, which creates the
+    engines. Needs db = SQLAlchemy(session_options={'class_': RoutingSession}), see models.py
+
+    :param app: the Flask app
+    """
+    app.config.setdefault('DB_REPLICA_URIS', [])
+    app.config.setdefault('DB_REPLICA_STICKY_SECONDS', 10)
+
+    uris = app.config['DB_REPLICA_URIS']
+    if not uris:
+        app.extensions.pop('replicas', None)
+        return
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    keys = []
+    for number, uri in enumerate(uris):
+        key = f"replica_{number}"
+        binds[key] = uri
+        keys.append(key)
+    app.extensions['replicas'] = {'keys': tuple(keys)}
+
+    @app.after_request
+    def remember_write(response):
+        if g.get('db_wrote'):
+            session[SESSION_KEY] = time.time()
+        return response
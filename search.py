@@ -0,0 +1,295 @@
+from html.parser import HTMLParser
+from types import SimpleNamespace
+import re
+
+import click
+from markupsafe import escape, Markup
+from sqlalchemy import Date, text
+
+from models import db, Post, Comment
+
+
+# ---------------------Index schema---------------------------------
+# One search document per post: title, subtitle, body text and the text of all its comments. New comments are appended
+# to the document (index_comment), only edits and deletions rebuild it from the rows (index_post).
+# SQLite uses an FTS5 virtual table keyed by the post id (rowid), Postgres a weighted tsvector column with a GIN index.
+
+SQLITE_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(title, subtitle, body, comments, tokenize='porter unicode61')",
+]
+
+POSTGRES_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS post_search ("
+    " post_id INTEGER PRIMARY KEY REFERENCES blog_posts (id) ON DELETE CASCADE,"
+    " document tsvector NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS ix_post_search_document ON post_search USING GIN (document)",
+]
+
+# Relative weight of each column when ranking, title matches count the most
+SQLITE_RANK = "bm25(post_search, 10.0, 5.0, 1.0, 0.5)"
+
+POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('english', :title), 'A') || "
+    "setweight(to_tsvector('english', :subtitle), 'B') || "
+    "setweight(to_tsvector('english', :body), 'C') || "
+    "setweight(to_tsvector('english', :comments), 'D')"
+)
+
+# Snippet highlight markers, replaced with <mark> after HTML escaping the snippet
+_MARK_START, _MARK_END = "\x02", "\x03"
+
+
+class _TextExtractor(HTMLParser):
+    """
+    Collects the text content of an HTML fragment, skipping <script> and <style>
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('script', 'style'):
+            self._skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('script', 'style') and self._skipping:
+            self._skipping -= 1
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+
+def strip_html(html):
+    """
+    :param html: HTML fragment, e.g. a CKEditor post body
+    :return: its text content with whitespace collapsed
+    """
+    extractor = _TextExtractor()
+    extractor.feed(html or "")
+    extractor.close()
+    return " ".join(" ".join(extractor.parts).split())
+
+
+def dialect():
+    """
+    :return: 'sqlite' or 'postgresql' if full-text search is supported on the configured database, else None
+    """
+    name = db.engine.dialect.name
+    return name if name in ('sqlite', 'postgresql') else None
+
+
+def ensure_schema():
+    """
+    Creates the search index table if it does not exist yet
+
+    :return: True if the table was just created (and so needs 'flask search-reindex')
+    """
+    schema = {'sqlite': SQLITE_SCHEMA, 'postgresql': POSTGRES_SCHEMA}.get(dialect())
+    if schema is None:
+        return False
+    created = not db.inspect(db.engine).has_table('post_search')
+    with db.engine.begin() as connection:
+        for statement in schema:
+            connection.execute(text(statement))
+    return created
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """
+    Alembic autogenerate filter: the search index (and FTS5's shadow tables) is not a model, never drop it
+    """
+    return not (type_ == 'table' and reflected and compare_to is None and name.startswith('post_search'))
+
+
+# ---------------------Incremental indexing---------------------------------
+
+def index_post(post_id):
+    """
+    (Re)builds the search document of one post from its current row and comments. Runs in the caller's transaction,
+    so call it before db.session.commit() in every write path that changes a post or its comments (index_comment() is
+    enough for a new comment).
+
+    :param post_id: the post to index
+    """
+    kind = dialect()
+    if kind is None:
+        return
+    post = db.session.execute(
+        db.select(Post.title, Post.subtitle, Post.body).where(Post.id == post_id)
+    ).first()
+    if post is None:
+        remove_post(post_id)
+        return
+    comment_texts = db.session.execute(
+        db.select(Comment.text).where(Comment.post_id == post_id).order_by(Comment.id)
+    ).scalars()
+    params = {
+        'post_id': post_id,
+        'title': post.title,
+        'subtitle': post.subtitle,
+        'body': strip_html(post.body),
+        'comments': " ".join(strip_html(comment_text) for comment_text in comment_texts),
+    }
+
+    if kind == 'sqlite':
+        db.session.execute(text("DELETE FROM post_search WHERE rowid = :post_id"), params)
+        db.session.execute(text(
+            "INSERT INTO post_search (rowid, title, subtitle, body, comments) "
+            "VALUES (:post_id, :title, :subtitle, :body, :comments)"
+        ), params)
+    else:
+        db.session.execute(text(
+            f"INSERT INTO post_search (post_id, document) VALUES (:post_id, {POSTGRES_DOCUMENT}) "
+            "ON CONFLICT (post_id) DO UPDATE SET document = EXCLUDED.document"
+        ), params)
+
+
+def index_comment(post_id, comment_text):
+    """
+    Adds a new comment to the search document of its post without reloading the post's other comments. Runs in the
+    caller's transaction, like index_post().
+
+    :param post_id: the post commented on
+    :param comment_text: the comment as written (CKEditor HTML)
+    """
+    kind = dialect()
+    if kind is None:
+        return
+    params = {'post_id': post_id, 'text': strip_html(comment_text)}
+    if kind == 'sqlite':
+        result = db.session.execute(text(
+            "UPDATE post_search SET comments = comments || ' ' || :text WHERE rowid = :post_id"
+        ), params)
+    else:
+        result = db.session.execute(text(
+            "UPDATE post_search SET document = document || setweight(to_tsvector('english', :text), 'D') "
+            "WHERE post_id = :post_id"
+        ), params)
+    if result.rowcount == 0:
+        # Not indexed yet (e.g. before 'flask search-reindex'): build the whole document, new comment included
+        index_post(post_id)
+
+
+def remove_post(post_id):
+    """
+    Removes a deleted post from the search index, in the caller's transaction
+    """
+    kind = dialect()
+    if kind == 'sqlite':
+        db.session.execute(text("DELETE FROM post_search WHERE rowid = :post_id"), {'post_id': post_id})
+    elif kind == 'postgresql':
+        db.session.execute(text("DELETE FROM post_search WHERE post_id = :post_id"), {'post_id': post_id})
+
+
+def reindex_all(batch_size=500, after_id=0):
+    """
+    Rebuilds the whole index, committing after every batch of posts
+
+    :param batch_size: posts indexed per transaction
+    :param after_id: only index the posts with a higher id, e.g. the ones a bulk import added
+    :return: number of posts indexed
+    """
+    count = 0
+    last_id = after_id
+    while True:
+        post_ids = db.session.execute(
+            db.select(Post.id).where(Post.id > last_id).order_by(Post.id).limit(batch_size)
+        ).scalars().all()
+        if not post_ids:
+            return count
+        for post_id in post_ids:
+            index_post(post_id)
+        db.session.commit()
+        count += len(post_ids)
+        last_id = post_ids[-1]
+
+
+# ---------------------Querying---------------------------------
+
+def fts5_query(query):
+    """
+    Turns free text into a safe FTS5 query: every word must match, the last one as a prefix
+
+    :return: the FTS5 MATCH expression, or None if the query has no words
+    """
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def search_posts(query, limit=10, offset=0):
+    """
+    Ranked full-text search over posts and their comments
+
+    :param query: the user's search text
+    :param limit: page size
+    :param offset: rows to skip
+    :return: list of rows with id, title, subtitle, date, author_username and snippet (Markup or None)
+    """
+    kind = dialect()
+    summary_columns = (
+        "p.id, p.title, p.subtitle, p.date, u.username AS author_username"
+    )
+
+    if kind == 'sqlite':
+        match = fts5_query(query)
+        if match is None:
+            return []
+        rows = db.session.execute(text(
+            f"SELECT {summary_columns}, "
+            f"snippet(post_search, -1, '{_MARK_START}', '{_MARK_END}', '…', 24) AS snippet "
+            "FROM post_search "
+            "JOIN blog_posts p ON p.id = post_search.rowid "
+            "LEFT JOIN users u ON u.id = p.author_id "
+            f"WHERE post_search MATCH :match ORDER BY {SQLITE_RANK} LIMIT :limit OFFSET :offset"
+        ).columns(date=Date), {'match': match, 'limit': limit, 'offset': offset}).all()
+        return [_with_snippet(row) for row in rows]
+
+    if kind == 'postgresql':
+        if not query.strip():
+            return []
+        return db.session.execute(text(
+            f"SELECT {summary_columns}, NULL AS snippet "
+            "FROM post_search s "
+            "JOIN blog_posts p ON p.id = s.post_id "
+            "LEFT JOIN users u ON u.id = p.author_id, "
+            "websearch_to_tsquery('english', :query) q "
+            "WHERE s.document @@ q ORDER BY ts_rank_cd(s.document, q) DESC, p.id DESC LIMIT :limit OFFSET :offset"
+        ).columns(date=Date), {'query': query, 'limit': limit, 'offset': offset}).all()
+
+    return []
+
+
+def _with_snippet(row):
+    """
+    Escapes the snippet text and turns the match markers into <mark> tags
+    """
+    data = row._asdict()
+    if data['snippet']:
+        data['snippet'] = Markup(
+            str(escape(data['snippet'])).replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>")
+        )
+    return SimpleNamespace(**data)
+
+
+def init_app(app):
+    """
+    Registers the 'flask search-reindex' command. The index table itself is created by migration 0004,
+    or by ensure_schema() for databases bootstrapped with db.create_all()
+
+    :param app: the Flask app
+    """
+
+    @app.cli.command('search-reindex')
+    @click.option('--batch-size', default=500, show_default=True, help="Posts indexed per transaction.")
+    def search_reindex_command(batch_size):
+        """
+        Rebuilds the full-text search index of every post and its comments
+        """
+        print(f"Indexed {reindex_all(batch_size)} posts")
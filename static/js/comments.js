@@ -0,0 +1,68 @@
+/*
+* Infinite scroll for post comments: loads the next page from /post/<id>/comments?after=<last id> when the
+* "Load more comments" button scrolls into view (or is clicked), and appends it using #comment-template.
+*/
+window.addEventListener('DOMContentLoaded', () => {
+    const button = document.getElementById('load-more-comments');
+    const list = document.getElementById('comments');
+    const template = document.getElementById('comment-template');
+    if (!button || !list || !template) {
+        return;
+    }
+    let loading = false;
+
+    function renderComment(comment) {
+        const item = template.content.cloneNode(true);
+        item.querySelector('[data-field="avatar"]').src = comment.avatar_url;
+        // Comment bodies are the HTML the server renders with |safe in post.html
+        item.querySelector('[data-field="html"]').innerHTML = comment.html;
+        item.querySelector('[data-field="author"]').textContent = comment.author_username || '';
+        if (comment.delete_url) {
+            const deleteLink = item.querySelector('[data-field="delete"]');
+            deleteLink.href = comment.delete_url;
+            deleteLink.hidden = false;
+        }
+        return item;
+    }
+
+    function loadMore() {
+        if (loading) {
+            return;
+        }
+        loading = true;
+        button.disabled = true;
+        const url = `${button.dataset.url}?after=${encodeURIComponent(button.dataset.after)}`;
+        fetch(url, {headers: {'Accept': 'application/json'}, credentials: 'same-origin'})
+            .then((response) => {
+                if (!response.ok) {
+                    throw new Error(`Loading comments failed: ${response.status}`);
+                }
+                return response.json();
+            })
+            .then((page) => {
+                page.comments.forEach((comment) => list.appendChild(renderComment(comment)));
+                if (page.next_cursor === null) {
+                    observer.disconnect();
+                    button.parentElement.remove();
+                } else {
+                    button.dataset.after = page.next_cursor;
+                    button.disabled = false;
+                }
+            })
+            .catch(() => {
+                // Leave the button for a manual retry
+                button.disabled = false;
+            })
+            .finally(() => {
+                loading = false;
+            });
+    }
+
+    const observer = new IntersectionObserver((entries) => {
+        if (entries.some((entry) => entry.isIntersecting)) {
+            loadMore();
+        }
+    }, {rootMargin: '400px'});
+    observer.observe(button);
+    button.addEventListener('click', loadMore);
+});
@@ -0,0 +1,56 @@
+from flask import current_app, get_flashed_messages, render_template, stream_template
+from flask_wtf.csrf import generate_csrf
+
+from page_cache import cacheable_request
+
+
+def _coalesce(chunks, size):
+    """
+    Jinja yields every text fragment separately, group them into chunks of at least 'size' bytes so each write
+    (and each compression flush) carries a useful amount of HTML
+    """
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def render_page(template_name, **context):
+    """
+    Renders a page, streamed when STREAM_TEMPLATES is on so the top of the page goes out while the rest (e.g. the
+    comments, pulled lazily from the database) is still rendering.
+
+    Pages the page cache stores are rendered in full instead, since the cache needs the whole body anyway. Testing
+    mode streams too, the query budget (see query_counter) checks streamed pages once they are sent.
+
+    :param template_name: the template to render
+    :param context: the template variables, iterables in it are consumed while streaming
+    :return: a Response
+    """
+    if not current_app.config['STREAM_TEMPLATES'] or cacheable_request():
+        return render_template(template_name, **context)
+
+    # The session cookie is sent with the headers, before the template runs. Touch everything the template would
+    # change in the session now: pop the flashed messages (cached for the request) and create the CSRF token
+    get_flashed_messages(with_categories=True)
+    if current_app.config.get('WTF_CSRF_ENABLED', True):
+        generate_csrf()
+
+    # stream_template keeps the request context (and so the db session) alive until the last chunk is sent
+    chunks = _coalesce(stream_template(template_name, **context), current_app.config['STREAM_CHUNK_SIZE'])
+    return current_app.response_class(chunks, mimetype='text/html')
+
+
+def init_app(app):
+    """
+    :param app: the Flask app
+    """
+    app.config.setdefault('STREAM_TEMPLATES', True)
+    app.config.setdefault('STREAM_CHUNK_SIZE', 4096)
@@ -0,0 +1,99 @@
+from datetime import date
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SECRET_APP_KEY", "test-secret")
+
+from app import create_app, create_db
+from models import db, User, Post, Comment
+from query_counter import queries_counted
+
+
+@pytest.fixture
+def config(tmp_path):
+    """
+    Settings of the app under test, a test can change them before using the 'app' fixture
+    """
+    return {
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'blog.db'}",
+        'WTF_CSRF_ENABLED': False,
+        'RATE_LIMIT_BACKEND': 'none',
+        'PAGE_CACHE_BACKEND': 'none',
+        'MAIL_QUEUE_WORKER': 'none',
+        'PASSWORD_SCHEMES': ['pbkdf2_sha256'],
+        'PASSWORD_PBKDF2_ROUNDS': 1000,
+    }
+
+
+@pytest.fixture
+def app(config):
+    app = create_app(config)
+    with app.app_context():
+        create_db()
+    yield app
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_user(app):
+    def make_user(username, is_admin=False):
+        with app.app_context():
+            user = User(username=username, email=f"{username}@example.com", password="unused", agree_to_terms=True,
+                        is_admin=is_admin)
+            db.session.add(user)
+            db.session.commit()
+            return user.id
+
+    return make_user
+
+
+@pytest.fixture
+def make_post(app):
+    def make_post(author_id, title="A post", comments=0):
+        with app.app_context():
+            post = Post(title=title, subtitle="Subtitle", body="<p>Body</p>", img_url="https://example.com/a.jpg",
+                        author_id=author_id, date=date(2024, 1, 5), body_html="<p>Body</p>", excerpt="Body",
+                        reading_time=1, comment_count=comments)
+            db.session.add(post)
+            db.session.flush()
+            for number in range(comments):
+                db.session.add(Comment(text=f"Comment {number}", text_html=f"<p>Comment {number}</p>",
+                                       author_id=author_id, post_id=post.id))
+            db.session.commit()
+            return post.id
+
+    return make_post
+
+
+def log_in(client, user_id):
+    """
+    Logs the test client in as a user without going through the login form
+    """
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+
+@pytest.fixture
+def query_counts(app):
+    """
+    The (endpoint, count, streamed) of every request made during the test, see query_counter.queries_counted
+    """
+    counts = []
+
+    def record(sender, endpoint, count, streamed):
+        counts.append((endpoint, count, streamed))
+
+    with queries_counted.connected_to(record, app):
+        yield counts
@@ -0,0 +1,43 @@
+import pytest
+
+from conftest import log_in
+from models import db, Post
+
+
+@pytest.fixture
+def post_id(make_user, make_post):
+    return make_post(make_user('admin', is_admin=True))
+
+
+@pytest.mark.parametrize('method, path', [
+    ('GET', '/new-post'),
+    ('POST', '/new-post'),
+    ('GET', '/edit-post/{post_id}'),
+    ('POST', '/edit-post/{post_id}'),
+    ('GET', '/delete/{post_id}'),
+    ('POST', '/admin/manage'),
+])
+def test_non_admin_gets_403(client, make_user, post_id, method, path):
+    log_in(client, make_user('reader'))
+    response = client.open(path.format(post_id=post_id), method=method,
+                           data={'title': 'Hijacked', 'subtitle': 's', 'img_url': 'https://example.com/b.jpg',
+                                 'body': 'b', 'email': 'reader@example.com', 'make_admin': 'y'})
+    assert response.status_code == 403
+
+
+def test_anonymous_gets_403(client, post_id):
+    assert client.get(f'/delete/{post_id}').status_code == 403
+
+
+def test_non_admin_cannot_delete_post(app, client, make_user, post_id):
+    log_in(client, make_user('reader'))
+    client.get(f'/delete/{post_id}')
+    with app.app_context():
+        assert db.session.get(Post, post_id) is not None
+
+
+def test_admin_can_delete_post(app, client, make_user, post_id):
+    log_in(client, make_user('other-admin', is_admin=True))
+    assert client.get(f'/delete/{post_id}').status_code == 302
+    with app.app_context():
+        assert db.session.get(Post, post_id) is None
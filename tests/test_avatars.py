@@ -0,0 +1,31 @@
+import avatars
+
+
+NAME = "0123456789abcdef0123456789abcdef"
+
+
+def test_avatar_is_cached_as_immutable(client):
+    response = client.get(f'/avatars/{NAME}.svg')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/svg+xml'
+    assert response.headers['ETag'] == f'"{NAME}"'
+    cache_control = response.cache_control
+    assert cache_control.public and cache_control.immutable
+    assert cache_control.max_age == avatars.IMMUTABLE_MAX_AGE
+
+
+def test_revalidation_is_not_modified(client):
+    response = client.get(f'/avatars/{NAME}.svg', headers={'If-None-Match': f'"{NAME}"'})
+    assert response.status_code == 304
+    assert not response.data
+
+
+def test_rendered_identicons_are_reused(client):
+    avatars.identicon_svg.cache_clear()
+    first = client.get(f'/avatars/{NAME}.svg').data
+    assert client.get(f'/avatars/{NAME}.svg').data == first
+    assert avatars.identicon_svg.cache_info().hits == 1
+
+
+def test_unknown_names_are_not_found(client):
+    assert client.get('/avatars/not-a-name.svg').status_code == 404
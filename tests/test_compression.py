@@ -0,0 +1,29 @@
+import pytest
+
+
+@pytest.fixture
+def config(config):
+    config['WTF_CSRF_ENABLED'] = True
+    return config
+
+
+GZIP = {'Accept-Encoding': 'gzip'}
+
+
+def test_form_page_is_compressed(client):
+    response = client.get('/login', headers=GZIP)
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+
+def test_form_reflecting_input_is_not_compressed(client):
+    response = client.post('/login', data={'email': 'guess@example.com'}, headers=GZIP)
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    body = response.get_data(as_text=True)
+    assert 'guess@example.com' in body and 'csrf_token' in body
+
+
+def test_page_reflecting_input_without_a_token_is_compressed(client, make_user, make_post):
+    make_post(make_user('author'), title="Compressible " * 50)
+    response = client.get('/search', query_string={'q': 'compressible'}, headers=GZIP)
+    assert response.headers['Content-Encoding'] == 'gzip'
@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+
+from conftest import log_in
+from models import db, Post
+
+
+def test_unchanged_post_is_not_modified(client, make_user, make_post):
+    post_id = make_post(make_user('author'))
+    etag = client.get(f'/post/{post_id}', buffered=True).headers['ETag']
+    assert client.get(f'/post/{post_id}', headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_new_release_is_modified(app, client, make_user, make_post):
+    post_id = make_post(make_user('author'))
+    response = client.get(f'/post/{post_id}', buffered=True)
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+
+    # A deploy with other templates or assets
+    app.extensions['release'] = {'version': 'next', 'released_at': datetime.utcnow() + timedelta(seconds=5)}
+    assert client.get(f'/post/{post_id}', headers={'If-None-Match': etag}).status_code == 200
+    assert client.get(f'/post/{post_id}', headers={'If-Modified-Since': last_modified}).status_code == 200
+
+
+def test_deleting_the_newest_post_does_not_move_last_modified_back(app, client, make_user, make_post):
+    app.extensions['release'] = {'version': 'current', 'released_at': datetime(2024, 1, 1)}
+    author = make_user('author', is_admin=True)
+    for title, age in (("Older", 2), ("Newest", 1)):
+        post_id = make_post(author, title=title)
+        with app.app_context():
+            db.session.execute(db.update(Post).where(Post.id == post_id).values(
+                updated_at=datetime.utcnow() - timedelta(hours=age),
+                comments_updated_at=datetime.utcnow() - timedelta(hours=age),
+            ))
+            db.session.commit()
+    feed_modified = client.get('/', buffered=True).headers['Last-Modified']
+
+    log_in(client, author)
+    client.get(f'/delete/{post_id}')
+    client.get('/logout')
+
+    response = client.get('/', headers={'If-Modified-Since': feed_modified}, buffered=True)
+    assert response.status_code == 200
+    assert "Newest" not in response.get_data(as_text=True)
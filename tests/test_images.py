@@ -0,0 +1,81 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+import pytest
+
+import images
+
+
+@pytest.fixture
+def config(config, tmp_path):
+    config['IMAGE_CACHE_DIR'] = str(tmp_path / 'images')
+    config['IMAGE_WIDTHS'] = [100]
+    config['IMAGE_FORMATS'] = ['jpeg']
+    return config
+
+
+@pytest.fixture
+def local_server():
+    """
+    HTTP server on 127.0.0.1 redirecting every request to itself, records the paths it was asked for
+    """
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append(self.path)
+            self.send_response(302)
+            self.send_header('Location', f"http://127.0.0.1:{self.server.server_port}/secret")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_port, requested
+    server.shutdown()
+
+
+@pytest.mark.parametrize('host', ['127.0.0.1', 'localhost', '10.0.0.8', '192.168.1.1', '169.254.169.254', '::1',
+                                  '::ffff:127.0.0.1', '0.0.0.0'])
+def test_non_public_hosts_are_refused(host):
+    with pytest.raises(ValueError):
+        images.public_address(host, 80)
+
+
+def test_fetch_never_connects_to_a_private_host(local_server):
+    port, requested = local_server
+    with pytest.raises(ValueError):
+        images.fetch_image(f"http://127.0.0.1:{port}/a.jpg", timeout=2, max_bytes=1000)
+    assert requested == []
+
+
+def test_redirects_are_checked_again(local_server, monkeypatch):
+    port, requested = local_server
+    check = images.public_address
+    # 'images.test' stands for a public host that redirects to a private address
+    monkeypatch.setattr(images, 'public_address',
+                        lambda host, port: '127.0.0.1' if host == 'images.test' else check(host, port))
+    with pytest.raises(ValueError, match="non-public"):
+        images.fetch_image(f"http://images.test:{port}/a.jpg", timeout=2, max_bytes=1000)
+    assert requested == ['/a.jpg']
+
+
+def test_on_demand_route_builds_in_background(app, client):
+    pipeline = app.extensions['images']
+    source_id = images.source_id_for('assets/img/home-bg.jpg')
+    with app.test_request_context():
+        token = pipeline.signed_source(source_id)
+
+    response = client.get(f'/img/src/{token}/100.jpg')
+    # The original, right away
+    assert response.status_code == 302
+    assert '/static/' in response.location
+    pipeline.build_later(source_id).result(timeout=30)
+    assert pipeline._pending == {}
+
+    response = client.get(f'/img/src/{token}/100.jpg')
+    assert response.status_code == 302
+    assert response.location.startswith('/img/') and response.location.endswith('-100.jpg')
+    assert client.get(response.location).status_code == 200
@@ -0,0 +1,189 @@
+from datetime import datetime, timedelta
+from email import message_from_string
+import socketserver
+from threading import Thread
+
+import pytest
+
+from models import db, OutboundEmail
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Minimal SMTP server on 127.0.0.1 keeping the messages it accepts. Refuses the next 'refuse' messages with a
+    temporary error
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.messages = []
+        self.refuse = 0
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.reply("220 fake ready")
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply("250 fake")
+            elif command.startswith('MAIL FROM'):
+                if server.refuse:
+                    server.refuse -= 1
+                    self.reply("451 try again later")
+                else:
+                    self.reply("250 OK")
+            elif command.startswith(('RCPT TO', 'RSET', 'NOOP')):
+                self.reply("250 OK")
+            elif command == 'DATA':
+                self.reply("354 go ahead")
+                data = []
+                for data_line in self.rfile:
+                    if data_line == b".\r\n":
+                        break
+                    data.append(data_line.decode())
+                server.messages.append(message_from_string("".join(data)))
+                self.reply("250 queued")
+            elif command == 'QUIT':
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 not implemented")
+
+
+@pytest.fixture
+def smtp_server():
+    server = FakeSMTPServer()
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def config(config, smtp_server):
+    config.update({
+        'MAIL_ADDRESS': 'blog@example.com',
+        'MAIL_APP_PW': None,
+        'MAIL_SMTP_HOST': '127.0.0.1',
+        'MAIL_SMTP_PORT': smtp_server.server_address[1],
+        'MAIL_USE_TLS': False,
+        'MAIL_SMTP_TIMEOUT': 5,
+        'MAIL_QUEUE_MAX_ATTEMPTS': 3,
+        'MAIL_QUEUE_BACKOFF_SECONDS': 60,
+    })
+    return config
+
+
+@pytest.fixture
+def worker(app):
+    return app.extensions['mail_queue']
+
+
+def queued_emails(app):
+    with app.app_context():
+        return db.session.execute(db.select(OutboundEmail).order_by(OutboundEmail.id)).scalars().all()
+
+
+def make_due(app):
+    """
+    Moves every pending retry and lease into the past, as if time had passed
+    """
+    with app.app_context():
+        db.session.execute(db.update(OutboundEmail).values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1)))
+        db.session.commit()
+
+
+def contact(client, name="Ada"):
+    response = client.post('/contact', data={'name': name, 'email': f'{name.lower()}@example.com', 'phone': '1',
+                                             'message': 'Hello'})
+    assert response.status_code == 200
+
+
+def test_contact_form_is_delivered(app, client, worker, smtp_server):
+    contact(client)
+    # The request only queued it
+    assert smtp_server.messages == []
+
+    assert worker.process_batch() == 1
+    [email] = queued_emails(app)
+    assert email.status == 'sent'
+    [message] = smtp_server.messages
+    assert message['Subject'] == "Message from Ada"
+    assert message['Reply-To'] == "ada@example.com"
+
+
+def test_refused_message_is_retried_after_backoff(app, client, worker, smtp_server):
+    contact(client)
+    smtp_server.refuse = 1
+
+    assert worker.process_batch() == 1
+    [email] = queued_emails(app)
+    assert (email.status, email.attempts) == ('pending', 1)
+    assert '451' in email.last_error
+    assert email.next_attempt_at > datetime.utcnow() + timedelta(seconds=50)
+    # Not due until the backoff is over
+    assert worker.process_batch() == 0
+
+    make_due(app)
+    assert worker.process_batch() == 1
+    [email] = queued_emails(app)
+    assert email.status == 'sent'
+    assert len(smtp_server.messages) == 1
+
+
+def test_one_refusal_does_not_fail_the_batch(app, client, worker, smtp_server):
+    contact(client, "Ada")
+    contact(client, "Bob")
+    smtp_server.refuse = 1
+
+    assert worker.process_batch() == 2
+    assert [(email.status, email.attempts) for email in queued_emails(app)] == [('pending', 1), ('sent', 0)]
+
+
+def test_gives_up_after_max_attempts(app, client, worker, smtp_server):
+    contact(client)
+    smtp_server.refuse = 10
+    for _ in range(3):
+        make_due(app)
+        assert worker.process_batch() == 1
+    [email] = queued_emails(app)
+    assert (email.status, email.attempts) == ('failed', 3)
+    make_due(app)
+    assert worker.process_batch() == 0
+
+
+def test_lease_of_a_dead_worker_expires(app, client, worker, smtp_server):
+    contact(client)
+    # A worker claims the message, then dies before sending it
+    with app.app_context():
+        assert len(worker.claim_batch()) == 1
+        db.session.rollback()
+    [email] = queued_emails(app)
+    assert email.status == 'sending'
+
+    # Leased: nobody else picks it up
+    assert worker.process_batch() == 0
+    assert smtp_server.messages == []
+
+    make_due(app)
+    assert worker.process_batch() == 1
+    [email] = queued_emails(app)
+    assert email.status == 'sent'
+    assert len(smtp_server.messages) == 1
+
+
+def test_unreachable_server_counts_attempts(app, client, worker, smtp_server):
+    contact(client)
+    app.config['MAIL_SMTP_PORT'] = 1
+    assert worker.process_batch() == 1
+    [email] = queued_emails(app)
+    assert (email.status, email.attempts) == ('pending', 1)
+    assert smtp_server.messages == []
@@ -0,0 +1,49 @@
+import pytest
+
+import content
+from app import create_app
+from conftest import log_in
+from models import db, Post
+
+
+@pytest.fixture
+def config(config, tmp_path):
+    config['PAGE_CACHE_BACKEND'] = 'filesystem'
+    config['PAGE_CACHE_DIR'] = str(tmp_path / 'page_cache')
+    return config
+
+
+@pytest.fixture
+def other_worker(app, config):
+    """
+    A second app on the same database and cache directory, like another gunicorn worker
+    """
+    return create_app(config)
+
+
+def test_invalidation_reaches_every_worker(app, client, other_worker, make_user, make_post):
+    post_id = make_post(make_user('author'))
+    client.get(f'/post/{post_id}')
+    assert client.get(f'/post/{post_id}').headers['X-Query-Count'] == '0'
+
+    writer = other_worker.test_client()
+    log_in(writer, make_user('reader'))
+    response = writer.post(f'/post/{post_id}', data={'body': 'Seen by all workers'})
+    assert response.status_code == 302
+
+    assert 'Seen by all workers' in client.get(f'/post/{post_id}').get_data(as_text=True)
+
+
+def test_backfill_invalidates_cached_pages(app, client, make_user, make_post):
+    post_id = make_post(make_user('author'))
+    etag = client.get(f'/post/{post_id}').headers['ETag']
+    assert client.get(f'/post/{post_id}').headers['X-Query-Count'] == '0'
+
+    with app.app_context():
+        db.session.execute(db.update(Post).values(body="<p>Backfilled body</p>"))
+        db.session.commit()
+        assert content.backfill(everything=True) == (1, 0)
+
+    response = client.get(f'/post/{post_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'Backfilled body' in response.get_data(as_text=True)
@@ -0,0 +1,62 @@
+import pytest
+
+from conftest import log_in
+
+
+@pytest.fixture
+def config(config):
+    config['QUERY_BUDGET'] = 6
+    config['POSTS_PER_PAGE'] = 5
+    return config
+
+
+@pytest.fixture
+def authors(make_user):
+    return [make_user(f'author{number}') for number in range(3)]
+
+
+def log_in_reader(client, make_user):
+    log_in(client, make_user('reader'))
+    # Loads the user into the user cache, which later requests read it from
+    client.get('/about')
+
+
+def page_queries(client, query_counts, path):
+    del query_counts[:]
+    response = client.get(path, buffered=True)
+    assert response.status_code == 200
+    [(_, count, _)] = query_counts
+    return count
+
+
+@pytest.mark.parametrize('logged_in', [False, True])
+def test_index_queries_do_not_grow_with_posts(client, query_counts, make_user, make_post, authors, logged_in):
+    if logged_in:
+        log_in_reader(client, make_user)
+    make_post(authors[0], title="First")
+    few = page_queries(client, query_counts, '/')
+    for number in range(12):
+        make_post(authors[number % 3], title=f"Post {number}", comments=2)
+    assert page_queries(client, query_counts, '/') == few
+    assert page_queries(client, query_counts, '/?before=8') == few
+
+
+@pytest.mark.parametrize('logged_in', [False, True])
+def test_post_queries_do_not_grow_with_comments(client, query_counts, make_user, make_post, authors, logged_in):
+    if logged_in:
+        log_in_reader(client, make_user)
+    few = page_queries(client, query_counts, f'/post/{make_post(authors[0], title="Quiet", comments=1)}')
+    many = page_queries(client, query_counts, f'/post/{make_post(authors[1], title="Busy", comments=40)}')
+    assert many == few
+
+
+def test_budget_is_enforced(app, client, make_post, authors):
+    """
+    The budget fails the test that renders a page over it, so an N+1 regression cannot go unnoticed
+    """
+    from query_counter import QueryBudgetExceeded
+
+    app.config['QUERY_BUDGETS'] = {'get_all_posts': 0}
+    make_post(authors[0])
+    with pytest.raises(QueryBudgetExceeded):
+        client.get('/', buffered=True)
@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+from prometheus_client import REGISTRY
+
+import rate_limit
+
+
+@pytest.fixture
+def config(config):
+    config['RATE_LIMIT_BACKEND'] = 'memory'
+    return config
+
+
+def attempt(client, ip, email="victim@example.com"):
+    return client.post('/login', data={'email': email, 'password': 'guess'}, environ_base={'REMOTE_ADDR': ip})
+
+
+def test_one_ip_cannot_lock_an_account_out(client):
+    statuses = [attempt(client, '203.0.113.1').status_code for _ in range(10)]
+    assert 429 not in statuses[:5]
+    assert set(statuses[5:]) == {429}
+
+    # The owner, from their own address
+    assert attempt(client, '198.51.100.7').status_code != 429
+
+
+def test_account_ceiling_holds_across_ips(client):
+    statuses = [attempt(client, f'203.0.113.{number}').status_code for number in range(1, 41)]
+    assert statuses.count(429) == 10
+
+
+class BrokenBackend:
+    def take(self, key, capacity, rate):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_backend_failure_fails_open_and_is_counted(app, client):
+    app.extensions['rate_limit'].backend = BrokenBackend()
+    before = REGISTRY.get_sample_value('rate_limit_fail_open_total', {'limit': 'login'}) or 0
+
+    assert attempt(client, '203.0.113.1').status_code != 429
+
+    assert REGISTRY.get_sample_value('rate_limit_fail_open_total', {'limit': 'login'}) == before + 1
+    assert app.extensions['rate_limit'].errors == 1
+
+
+def test_parse_limits_accepts_ip_account():
+    assert rate_limit.parse_limits("ip=20/minute, ip_account=5/minute") == {'ip': '20/minute', 'ip_account': '5/minute'}
+    with pytest.raises(ValueError):
+        rate_limit.parse_limits("user=5/minute")
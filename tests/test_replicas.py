@@ -0,0 +1,106 @@
+import shutil
+import time
+
+import pytest
+
+import page_cache as page_cache_module
+from conftest import log_in
+from models import db, Comment, Post
+
+
+@pytest.fixture
+def config(config, tmp_path):
+    config['DB_REPLICA_URIS'] = [f"sqlite:///{tmp_path / 'replica.db'}"]
+    config['DB_REPLICA_STICKY_SECONDS'] = 60
+    return config
+
+
+@pytest.fixture
+def post_id(app, tmp_path, make_user, make_post):
+    """
+    A post on the primary and on the replica, whose copy of it is titled 'Replica title' to tell them apart
+    """
+    post_id = make_post(make_user('author'), title="Primary title")
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+    shutil.copy(tmp_path / 'blog.db', tmp_path / 'replica.db')
+    with app.app_context():
+        with db.engines['replica_0'].begin() as replica:
+            replica.execute(db.update(Post).values(title="Replica title"))
+    return post_id
+
+
+@pytest.fixture
+def reader(client, make_user):
+    log_in(client, make_user('reader'))
+
+
+def test_reads_of_get_requests_use_the_replica(client, post_id, reader):
+    body = client.get(f'/post/{post_id}', buffered=True).get_data(as_text=True)
+    assert "Replica title" in body
+    assert "Primary title" not in body
+
+
+def test_writes_and_reads_of_post_requests_use_the_primary(app, client, post_id, reader):
+    response = client.post(f'/post/{post_id}', data={'body': 'New comment', 'submit': 'y'})
+    assert response.status_code == 302
+    with app.app_context():
+        assert db.session.execute(db.select(Comment.text)).scalars().all() == ['New comment']
+        with db.engines['replica_0'].connect() as replica:
+            assert replica.execute(db.select(Comment.text)).scalars().all() == []
+
+
+def test_writer_reads_the_primary_while_sticky(app, client, make_user, post_id, reader):
+    client.post(f'/post/{post_id}', data={'body': 'New comment', 'submit': 'y'})
+    # The replica has not caught up, the writer still sees their comment
+    body = client.get(f'/post/{post_id}', buffered=True).get_data(as_text=True)
+    assert "Primary title" in body and "New comment" in body
+
+    # Other readers use the replica
+    other = app.test_client()
+    log_in(other, make_user('other'))
+    assert "Replica title" in other.get(f'/post/{post_id}', buffered=True).get_data(as_text=True)
+
+    app.config['DB_REPLICA_STICKY_SECONDS'] = 0
+    body = client.get(f'/post/{post_id}', buffered=True).get_data(as_text=True)
+    assert "Replica title" in body and "New comment" not in body
+
+
+def test_outside_requests_use_the_primary(app, post_id):
+    with app.app_context():
+        assert db.session.get(Post, post_id).title == "Primary title"
+
+
+@pytest.fixture
+def page_cache(app):
+    app.config['PAGE_CACHE_BACKEND'] = 'memory'
+    app.config['PAGE_CACHE_TTL'] = 300
+    return page_cache_module.init_app(app)
+
+
+def cached_for(cache, post_id):
+    """
+    :return: seconds until the cached page of the post expires
+    """
+    [(expires_at, _)] = [
+        item for (tag, key), item in cache.backend._entries.items()
+        if tag == f"post:{post_id}" and key != page_cache_module.RECENT_WRITE_KEY
+    ]
+    return expires_at - time.time()
+
+
+def test_anonymous_pages_are_rendered_from_the_replica(app, client, post_id, page_cache):
+    assert "Replica title" in client.get(f'/post/{post_id}').get_data(as_text=True)
+    assert cached_for(page_cache, post_id) > 60
+
+
+def test_page_rendered_from_the_replica_after_a_write_is_cached_for_the_lag(app, client, make_user, post_id,
+                                                                             page_cache):
+    writer = app.test_client()
+    log_in(writer, make_user('writer'))
+    writer.post(f'/post/{post_id}', data={'body': 'New comment', 'submit': 'y'})
+
+    # The replica has not caught up yet
+    assert "New comment" not in client.get(f'/post/{post_id}').get_data(as_text=True)
+    assert cached_for(page_cache, post_id) <= 60
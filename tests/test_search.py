@@ -0,0 +1,53 @@
+import pytest
+from sqlalchemy import event
+
+import search
+from conftest import log_in
+from models import db
+
+
+@pytest.fixture
+def indexed_post(app, make_user, make_post):
+    post_id = make_post(make_user('author'), comments=20)
+    with app.app_context():
+        search.reindex_all()
+    return post_id
+
+
+@pytest.fixture
+def statements(app):
+    seen = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        seen.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    yield seen
+    event.remove(engine, 'before_cursor_execute', record)
+
+
+def found(app, query):
+    with app.app_context():
+        return [row.id for row in search.search_posts(query)]
+
+
+def test_new_comment_is_searchable_without_reloading_the_others(app, client, make_user, indexed_post, statements):
+    log_in(client, make_user('reader'))
+    response = client.post(f'/post/{indexed_post}', data={'body': '<p>Marmalade</p>'})
+    assert response.status_code == 302
+
+    assert not [statement for statement in statements if 'SELECT comments.text' in statement]
+    assert found(app, 'marmalade') == [indexed_post]
+    # The earlier comments are still in the document
+    assert found(app, 'comment') == [indexed_post]
+
+
+def test_comment_on_unindexed_post_builds_its_document(app, client, make_user, make_post):
+    post_id = make_post(make_user('author'), comments=1)
+    log_in(client, make_user('reader'))
+    client.post(f'/post/{post_id}', data={'body': '<p>Marmalade</p>'})
+
+    assert found(app, 'marmalade') == [post_id]
+    assert found(app, 'comment') == [post_id]
@@ -0,0 +1,56 @@
+import re
+
+import pytest
+
+from conftest import log_in
+from models import db, Comment
+from query_counter import QueryBudgetExceeded
+
+
+@pytest.fixture
+def post_id(make_user, make_post):
+    return make_post(make_user('author'), comments=3)
+
+
+def csrf_token(body):
+    return re.search(rb'name="csrf_token" type="hidden" value="([^"]+)"', body).group(1).decode()
+
+
+def test_post_page_is_streamed(client, post_id, query_counts):
+    response = client.get(f'/post/{post_id}', buffered=True)
+    assert response.status_code == 200
+    assert 'X-Query-Count' not in response.headers
+    body = response.get_data(as_text=True)
+    assert 'A post' in body
+    assert [f"Comment {number}" in body for number in range(3)] == [True] * 3
+    # Counted once the body, and so the lazily loaded comments, had been sent
+    [(endpoint, count, streamed)] = query_counts
+    assert (endpoint, streamed) == ('show_post', True)
+    # Validators, the post with its author, the comments
+    assert count == 3
+
+
+def test_streamed_page_over_budget_fails(app, client, post_id):
+    app.config['QUERY_BUDGETS'] = {'show_post': 1}
+    with pytest.raises(QueryBudgetExceeded):
+        client.get(f'/post/{post_id}', buffered=True)
+
+
+def test_session_is_saved_before_streaming(app, client, make_user, post_id):
+    """
+    The CSRF token in a streamed page and the flashed messages it shows are in the session cookie sent with its
+    headers
+    """
+    app.config['WTF_CSRF_ENABLED'] = True
+    log_in(client, make_user('reader'))
+    token = csrf_token(client.get(f'/post/{post_id}', buffered=True).data)
+
+    response = client.post(f'/post/{post_id}', data={'csrf_token': token, 'comment_button': 'y'})
+    token = csrf_token(response.data)
+    response = client.post(f'/post/{post_id}', data={'csrf_token': token, 'body': 'Streamed reply', 'submit': 'y'})
+    assert response.status_code == 302
+    with app.app_context():
+        assert db.session.execute(db.select(Comment).where(Comment.text == 'Streamed reply')).scalar() is not None
+
+    assert 'Your comment has been added.' in client.get(f'/post/{post_id}', buffered=True).get_data(as_text=True)
+    assert 'Your comment has been added.' not in client.get(f'/post/{post_id}', buffered=True).get_data(as_text=True)
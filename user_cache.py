@@ -0,0 +1,141 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from flask import current_app
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+
+class UserCache:
+    """
+    Process-local TTL + LRU cache of users keyed by user id, used in front of Flask-Login's user_loader.
+
+    Entries are detached snapshots of the User row, so they never hold on to a db session. Callers turn a snapshot back
+    into a session-bound instance with db.session.merge(snapshot, load=False), which does not query the db.
+
+    Each gunicorn worker has its own cache, so an invalidation in one worker does not reach the others: keep the TTL
+    short so changes made through another worker show up within ttl seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=30, clock=time.monotonic):
+        """
+        :param maxsize: max number of users kept, the least recently used user is evicted first
+        :param ttl: seconds an entry stays valid, 0 disables the cache
+        :param clock: monotonic time source, injectable for tests
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.maxsize > 0
+
+    def get(self, user_id):
+        """
+        :param user_id: int user id
+        :return: the cached detached user snapshot, or None on a miss or expired entry
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, snapshot = entry
+            if expires_at <= self.clock():
+                del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return snapshot
+
+    def put(self, user):
+        """
+        Caches a detached snapshot of user's column values, leaving user itself untouched
+
+        :param user: a persistent User instance
+        """
+        if not self.enabled:
+            return
+        snapshot = _snapshot(user)
+        with self._lock:
+            self._entries[user.id] = (self.clock() + self.ttl, snapshot)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+        """
+        Drops one user, call after anything that changes the users row (e.g. is_admin)
+
+        :param user_id: int user id
+        """
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: dict of hit/miss/eviction/invalidation counters and the current size
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+            }
+
+
+def _snapshot(user):
+    """
+    Copies the loaded column attributes of user into a new detached instance of the same class
+    """
+    mapper = inspect(user).mapper
+    snapshot = mapper.class_manager.new_instance()
+    for attr in mapper.column_attrs:
+        setattr(snapshot, attr.key, getattr(user, attr.key))
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+
+def init_app(app):
+    """
+    Creates the app's user cache from USER_CACHE_SIZE and USER_CACHE_TTL
+
+    :param app: the Flask app
+    :return: the UserCache
+    """
+    app.config.setdefault('USER_CACHE_SIZE', 1024)
+    app.config.setdefault('USER_CACHE_TTL', 30)
+    cache = UserCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+    app.extensions['user_cache'] = cache
+    return cache
+
+
+def current_cache():
+    """
+    :return: the UserCache of the current app
+    """
+    return current_app.extensions['user_cache']
+
+
+def invalidate(user_id):
+    """
+    Drops user_id from the current app's user cache
+    """
+    current_cache().invalidate(user_id)
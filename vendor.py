@@ -0,0 +1,222 @@
+from urllib.request import Request, urlopen
+import json
+import os
+import re
+
+import click
+from flask import current_app
+from markupsafe import Markup, escape
+
+from assets import asset_url
+
+
+# ---------------------Sources---------------------------------
+# 'flask vendor build' downloads the third-party assets into static/vendor/ so pages load nothing from other origins.
+# 'flask assets build' then fingerprints them like every other static file.
+
+BOOTSTRAP_JS_URL = "https://cdn.jsdelivr.net/npm/bootstrap@5.2.3/dist/js/bootstrap.bundle.min.js"
+
+# Only the icons passed to icon() in the templates are vendored, e.g. icon('brands/github')
+FONT_AWESOME_SVG_URL = "https://cdn.jsdelivr.net/npm/@fortawesome/fontawesome-free@6.3.0/svgs/{name}.svg"
+ICON_CALL = re.compile(r"""\bicon\(\s*['"]((?:solid|regular|brands)/[a-z0-9-]+)['"]""")
+
+FONTS_CSS_URL = (
+    "https://fonts.googleapis.com/css2"
+    "?family=Lora:ital,wght@0,400;0,700;1,400;1,700"
+    "&family=Open+Sans:ital,wght@0,300;0,400;0,600;0,700;0,800;1,300;1,400;1,600;1,700;1,800"
+    "&display=swap"
+)
+# Google serves a file per unicode range ('latin', 'latin-ext', 'cyrillic', ...), the blog is English
+FONT_SUBSETS = ('latin',)
+# Google picks the font format by User-Agent, this one gets woff2
+FONTS_USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+FONT_FACE = re.compile(r"/\*\s*([\w-]+)\s*\*/\s*(@font-face\s*\{[^}]*\})")
+
+MANIFEST_NAME = 'vendor.json'
+
+
+def _fetch(url, user_agent="python-urllib"):
+    with urlopen(Request(url, headers={'User-Agent': user_agent}), timeout=30) as response:
+        return response.read()
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def template_icons(template_folder):
+    """
+    :return: sorted names of the icons the templates use, e.g. ['brands/github', 'solid/bars']
+    """
+    names = set()
+    for directory, _, filenames in os.walk(template_folder):
+        for filename in filenames:
+            if filename.endswith('.html'):
+                with open(os.path.join(directory, filename), encoding='utf-8') as f:
+                    names.update(ICON_CALL.findall(f.read()))
+    return sorted(names)
+
+
+def build_icons(names, fetch=_fetch):
+    """
+    Downloads the Font Awesome SVG of every icon
+
+    :return: dict of name -> {'viewBox': ..., 'paths': [d, ...]}, what icon() renders inline
+    """
+    icons = {}
+    for name in names:
+        svg = fetch(FONT_AWESOME_SVG_URL.format(name=name)).decode('utf-8')
+        view_box = re.search(r'viewBox="([^"]+)"', svg)
+        paths = re.findall(r'<path[^>]*\sd="([^"]+)"', svg)
+        if view_box is None or not paths:
+            raise ValueError(f"Unexpected SVG for icon {name}")
+        icons[name] = {'viewBox': view_box.group(1), 'paths': paths}
+    return icons
+
+
+def build_fonts(vendor_dir, fetch=_fetch):
+    """
+    Downloads the FONT_SUBSETS files of the Google Fonts stylesheet into vendor_dir/fonts/ and writes
+    vendor_dir/fonts.css pointing at them
+
+    :return: dict of 'Family weight style' (e.g. 'Lora 400 normal') -> file path relative to vendor_dir
+    """
+    css = fetch(FONTS_CSS_URL, user_agent=FONTS_USER_AGENT).decode('utf-8')
+    faces = []
+    files = {}
+    by_url = {}
+    for subset, face in FONT_FACE.findall(css):
+        if subset not in FONT_SUBSETS:
+            continue
+        family = re.search(r"font-family:\s*'([^']+)'", face).group(1)
+        style = re.search(r"font-style:\s*(\w+)", face).group(1)
+        weight = re.search(r"font-weight:\s*(\d+)", face).group(1)
+        url = re.search(r"url\(([^)]+)\)", face).group(1)
+        # Variable fonts share one file between all the weights of a style
+        if url not in by_url:
+            path = f"fonts/{family.lower().replace(' ', '-')}-{style}-{weight}-{subset}.woff2"
+            _write(os.path.join(vendor_dir, path), fetch(url))
+            by_url[url] = path
+        files[f"{family} {weight} {style}"] = by_url[url]
+        faces.append(f"/* {subset} */\n" + face.replace(url, by_url[url]))
+    if not faces:
+        raise ValueError("The Google Fonts stylesheet has no font of the vendored subsets")
+    _write(os.path.join(vendor_dir, 'fonts.css'), ("\n".join(faces) + "\n").encode('utf-8'))
+    return files
+
+
+def build(template_folder, vendor_dir, fetch=_fetch):
+    """
+    Downloads everything into vendor_dir and writes its manifest
+
+    :return: the manifest, {'icons': ..., 'fonts': ...}
+    """
+    _write(os.path.join(vendor_dir, 'bootstrap.bundle.min.js'), fetch(BOOTSTRAP_JS_URL))
+    manifest = {
+        'icons': build_icons(template_icons(template_folder), fetch=fetch),
+        'fonts': build_fonts(vendor_dir, fetch=fetch),
+    }
+    _write(os.path.join(vendor_dir, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+# ---------------------Templates---------------------------------
+
+def _manifest():
+    return current_app.extensions['vendor']
+
+
+def vendored():
+    """
+    :return: True if pages use the files in static/vendor/, False if they load them from the CDNs
+    """
+    return _manifest() is not None
+
+
+def icon(name, classes=""):
+    """
+    Template global rendering a Font Awesome icon, e.g. icon('brands/github', 'fa-stack-1x').
+    Vendored it is an inline <svg> (no script, no request), otherwise the <i> the Font Awesome script replaces.
+
+    :param name: '<style>/<icon>', style being solid, regular or brands
+    :param classes: extra classes
+    """
+    style, icon_name = name.split('/')
+    manifest = _manifest()
+    if manifest is None:
+        prefix = {'solid': 'fas', 'regular': 'far', 'brands': 'fab'}[style]
+        return Markup(f'<i class="{prefix} fa-{icon_name} {escape(classes)}"></i>')
+    data = manifest['icons'][name]
+    paths = "".join(f'<path fill="currentColor" d="{escape(d)}"></path>' for d in data['paths'])
+    return Markup(
+        f'<svg class="svg-inline--fa fa-{icon_name} {escape(classes)}" aria-hidden="true" focusable="false" '
+        f'role="img" xmlns="http://www.w3.org/2000/svg" viewBox="{escape(data["viewBox"])}">{paths}</svg>'
+    )
+
+
+def preload_links(app):
+    """
+    :return: the value of the Link header announcing the stylesheets and VENDOR_PRELOAD_FONTS of every page
+    """
+    links = [f"<{asset_url('css/styles.css')}>; rel=preload; as=style"]
+    manifest = app.extensions['vendor']
+    if manifest is not None:
+        links.append(f"<{asset_url('vendor/fonts.css')}>; rel=preload; as=style")
+        for font in app.config['VENDOR_PRELOAD_FONTS']:
+            if font in manifest['fonts']:
+                links.append(f"<{asset_url('vendor/' + manifest['fonts'][font])}>; rel=preload; as=font; "
+                             "type=\"font/woff2\"; crossorigin")
+    return ", ".join(links)
+
+
+def init_app(app):
+    """
+    With VENDOR_ASSETS on (the default) and 'flask vendor build' run, pages load Bootstrap's JS, the fonts, the icons
+    and CKEditor from this server instead of the CDNs. HTML responses get a Link header preloading the stylesheets and
+    the VENDOR_PRELOAD_FONTS fonts ('Family weight style'), which proxies such as Cloudflare also turn into
+    103 Early Hints (the WSGI servers cannot send those themselves).
+
+    :param app: the Flask app
+    """
+    app.config.setdefault('VENDOR_ASSETS', True)
+    app.config.setdefault('VENDOR_DIR', os.path.join(app.static_folder, 'vendor'))
+    app.config.setdefault('VENDOR_PRELOAD_FONTS', ['Lora 400 normal', 'Open Sans 800 normal'])
+
+    vendor_dir = app.config['VENDOR_DIR']
+    manifest_path = os.path.join(vendor_dir, MANIFEST_NAME)
+    manifest = None
+    if app.config['VENDOR_ASSETS']:
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+            # Flask-CKEditor ships CKEditor, serve that copy
+            app.config['CKEDITOR_SERVE_LOCAL'] = True
+        else:
+            app.logger.warning("VENDOR_ASSETS is on but nothing is vendored, run 'flask vendor build'. Using the CDNs")
+    app.extensions['vendor'] = manifest
+    app.add_template_global(vendored)
+    app.add_template_global(icon)
+
+    @app.after_request
+    def add_preload_links(response):
+        if response.status_code == 200 and response.mimetype == 'text/html':
+            response.headers.add('Link', preload_links(app))
+        return response
+
+    @app.cli.group('vendor')
+    def vendor_group():
+        """
+        Self-hosted third-party assets
+        """
+
+    @vendor_group.command('build')
+    def build_command():
+        """
+        Downloads Bootstrap's JS, the used Font Awesome icons and the latin subset of the fonts into VENDOR_DIR.
+        Run 'flask assets build' afterwards
+        """
+        built = build(os.path.join(app.root_path, app.template_folder), vendor_dir)
+        print(f"Vendored {len(built['icons'])} icons and {len(set(built['fonts'].values()))} font files "
+              f"into {vendor_dir}")